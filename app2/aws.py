@@ -0,0 +1,78 @@
+# aws.py
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from config import (
+    AWS_REGION,
+    AWS_MAX_POOL_CONNECTIONS,
+    AWS_CONNECT_TIMEOUT,
+    AWS_READ_TIMEOUT,
+    AWS_MAX_ATTEMPTS,
+)
+
+# boto3 sessions are not thread-safe, so clients are only created under this lock.
+# The clients themselves are, and are shared by every thread in the process.
+_lock = threading.Lock()
+_session = None
+_instances: Dict[Tuple[str, str, Optional[str], int], Any] = {}
+_creation_seconds: Dict[str, float] = {}
+_transfer_config = None
+
+def _boto_session():
+    global _session
+    if _session is None:
+        import boto3
+        _session = boto3.session.Session(region_name=AWS_REGION)
+    return _session
+
+def _config(max_attempts: int):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT,
+        retries={"max_attempts": max_attempts, "mode": "standard"},
+    )
+
+def _get(kind: str, service_name: str, endpoint_url: Optional[str], max_attempts: int):
+    key = (kind, service_name, endpoint_url, max_attempts)
+    instance = _instances.get(key)
+    if instance is not None:
+        return instance
+    with _lock:
+        if key not in _instances:
+            start = time.perf_counter()
+            factory = _boto_session().client if kind == "client" else _boto_session().resource
+            _instances[key] = factory(
+                service_name, endpoint_url=endpoint_url, config=_config(max_attempts)
+            )
+            _creation_seconds[f"{service_name} {kind}"] = time.perf_counter() - start
+        return _instances[key]
+
+def client(service_name: str, endpoint_url: Optional[str] = None, max_attempts: int = AWS_MAX_ATTEMPTS):
+    """Process-wide boto3 client, created on first use"""
+    return _get("client", service_name, endpoint_url, max_attempts)
+
+def resource(service_name: str, endpoint_url: Optional[str] = None, max_attempts: int = AWS_MAX_ATTEMPTS):
+    """
+    Process-wide boto3 resource, created on first use. Only share it for request
+    calls (Table.get_item, query, ...), not for lazily loaded attributes.
+    """
+    return _get("resource", service_name, endpoint_url, max_attempts)
+
+def transfer_config():
+    """S3 transfer settings: large files go up as concurrent 8 MB multipart parts"""
+    global _transfer_config
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=4,
+        )
+    return _transfer_config
+
+def creation_seconds() -> Dict[str, float]:
+    """Time spent creating each client and resource so far"""
+    with _lock:
+        return dict(_creation_seconds)
@@ -1,39 +1,131 @@
-import boto3
-from boto3.dynamodb.conditions import Key
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import os
+import threading
+import zlib
+import time
+import streamlit as st
 from dotenv import load_dotenv
-from botocore.exceptions import ClientError
+import aws
+import telemetry
+from config import (
+    DYNAMODB_MESSAGES_TABLE,
+    DYNAMODB_ENDPOINT_URL,
+    DYNAMODB_RECENT_SESSIONS_INDEX,
+    SESSION_OWNER,
+    SESSION_OWNER_SHARDS,
+    SESSION_LIST_CACHE_TTL,
+)
 
 load_dotenv()
 
+SESSION_TTL_SECONDS = 30 * 24 * 60 * 60
+# Message items expire this long after their session item, and are re-stamped once
+# the session's ttl catches up with theirs, so a live session never loses messages
+MESSAGE_TTL_MARGIN_SECONDS = 7 * 24 * 60 * 60
+
+def session_owner(session_id: str) -> str:
+    """
+    GSI partition a session is listed under. With SESSION_OWNER_SHARDS > 1 sessions are
+    spread over that many owner values so one partition doesn't take every write.
+    """
+    if SESSION_OWNER_SHARDS <= 1:
+        return SESSION_OWNER
+    shard = zlib.crc32(session_id.encode('utf-8')) % SESSION_OWNER_SHARDS
+    return f"{SESSION_OWNER}#{shard}"
+
+def session_owners() -> List[str]:
+    if SESSION_OWNER_SHARDS <= 1:
+        return [SESSION_OWNER]
+    return [f"{SESSION_OWNER}#{shard}" for shard in range(SESSION_OWNER_SHARDS)]
+
+def _newest(sessions: List[Dict[str, str]], limit: int, before: Optional[str]) -> List[Dict[str, str]]:
+    if before:
+        sessions = [session for session in sessions if session['last_updated'] < before]
+    sessions.sort(key=lambda session: session['last_updated'], reverse=True)
+    return sessions[:limit]
+
+def _missing_index(error: Exception) -> bool:
+    """True for the errors DynamoDB (and DynamoDB Local) raise when querying an index that isn't there"""
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code', '')
+    if code == 'ResourceNotFoundException':
+        return True
+    return code == 'ValidationException' and 'index' in str(error).lower()
+
+def create_tables(dynamodb, table_name: str, messages_table_name: str = DYNAMODB_MESSAGES_TABLE) -> None:
+    """Create the session and message tables, e.g. in DynamoDB Local or moto"""
+    dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': 'session_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'session_id', 'AttributeType': 'S'},
+            {'AttributeName': 'owner', 'AttributeType': 'S'},
+            {'AttributeName': 'last_updated', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': DYNAMODB_RECENT_SESSIONS_INDEX,
+            'KeySchema': [
+                {'AttributeName': 'owner', 'KeyType': 'HASH'},
+                {'AttributeName': 'last_updated', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=messages_table_name,
+        KeySchema=[
+            {'AttributeName': 'session_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'seq', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'session_id', 'AttributeType': 'S'},
+            {'AttributeName': 'seq', 'AttributeType': 'N'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
 class ChatHistoryManager:
-    def __init__(self):
+    """
+    Session metadata (s3_key, last_updated, ttl, message_count, messages_ttl) is one
+    item per session in DYNAMODB_TABLE. Messages are one item each in
+    DYNAMODB_MESSAGES_TABLE, keyed by session_id and a sequence number, so saving a
+    turn only writes the new messages. message_count is the next sequence number.
+    """
+
+    def __init__(self, dynamodb=None):
         self.table_name = os.getenv('DYNAMODB_TABLE')
         if not self.table_name:
             raise ValueError("DYNAMODB_TABLE_NAME environment variable is not set")
 
-        try:
-            self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-            self.table = self.dynamodb.Table(self.table_name)
-            self.table.table_status
-        except ClientError as e:
-            raise Exception(f"Failed to initialize DynamoDB connection: {str(e)}")
-
-    def _format_message_for_dynamodb(self, message: Dict[str, str]) -> Dict[str, Dict[str, str]]:
-        """Format a single message for DynamoDB storage"""
-        return {
-            "M": {
-                "message": {"S": message.get('content', '')},
-                "role": {"S": message.get('role', '')},
-                "timestamp": {"S": message.get('timestamp', datetime.now().isoformat())}
-            }
-        }
+        # Created on first use rather than with a describe call up front
+        self._dynamodb = dynamodb
+        self._table = None
+        self._messages_table = None
 
-    def _format_messages_for_dynamodb(self, messages: List[Dict[str, str]]) -> List[Dict[str, Dict[str, str]]]:
-        """Format all messages for DynamoDB storage"""
-        return [self._format_message_for_dynamodb(msg) for msg in messages]
+        # (expires_at, limit, sessions) for the first page shown in the sidebar
+        self._sessions_cache: Optional[Tuple[float, int, List[Dict[str, str]]]] = None
+        self._sessions_lock = threading.Lock()
+        # Cleared when the recent-sessions GSI turns out not to exist
+        self._use_index = True
+
+    @property
+    def dynamodb(self):
+        if self._dynamodb is None:
+            self._dynamodb = aws.resource('dynamodb', endpoint_url=DYNAMODB_ENDPOINT_URL)
+        return self._dynamodb
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.dynamodb.Table(self.table_name)
+        return self._table
+
+    @property
+    def messages_table(self):
+        if self._messages_table is None:
+            self._messages_table = self.dynamodb.Table(DYNAMODB_MESSAGES_TABLE)
+        return self._messages_table
 
     def _format_message_from_dynamodb(self, dynamo_message: Dict) -> Dict[str, str]:
         """Convert DynamoDB message format back to application format"""
@@ -46,34 +138,120 @@ class ChatHistoryManager:
             }
         return {}
 
-    def save_chat_history(self, session_id: str, s3_key: str, messages: List[Dict[str, str]]) -> bool:
-        """Save chat history to DynamoDB with the specified format"""
+    def _restamp_messages(self, session_id: str, ttl: int) -> None:
+        """Push back the expiry of every stored message of a session"""
+        from boto3.dynamodb.conditions import Key
+        query_args = {'KeyConditionExpression': Key('session_id').eq(session_id)}
+        with self.messages_table.batch_writer() as batch:
+            while True:
+                response = self.messages_table.query(**query_args)
+                for item in response.get('Items', []):
+                    batch.put_item(Item=dict(item, ttl=ttl))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @telemetry.traced("dynamodb.save_chat_history")
+    def save_chat_history(
+        self,
+        session_id: str,
+        s3_key: str,
+        messages: List[Dict[str, str]],
+        stored: int = 0
+    ) -> bool:
+        """
+        Append messages[stored:] and update the session's metadata item. `stored` is how
+        many of the caller's messages are already in the table, as reported by
+        get_chat_history's stored_messages; other tabs or processes may have appended
+        to the session since, so the new messages go after whatever is there now.
+        """
         try:
             if not isinstance(messages, list):
                 raise ValueError("Messages must be a list")
 
-            # Format messages for DynamoDB
-            formatted_messages = self._format_messages_for_dynamodb(messages)
-            
-            # Create the DynamoDB item
-            item = {
-                'session_id': session_id,
-                's3_key': s3_key,
-                'messages': formatted_messages,
-                'last_updated': datetime.now().isoformat(),
-                'ttl': int((datetime.now().timestamp() + (30 * 24 * 60 * 60)))
-            }
-            
-            # Save to DynamoDB
-            self.table.put_item(Item=item)
+            new_messages = messages[stored:]
+            now = datetime.now()
+            ttl = int(now.timestamp() + SESSION_TTL_SECONDS)
+
+            # Reserving the seqs with ADD gives concurrent savers disjoint ranges; dropping
+            # the legacy inline list completes a migration, its messages are in `messages`
+            response = self.table.update_item(
+                Key={'session_id': session_id},
+                UpdateExpression=(
+                    'SET s3_key = :s3_key, last_updated = :last_updated, #ttl = :ttl, #owner = :owner '
+                    'ADD message_count :count REMOVE messages'
+                ),
+                ExpressionAttributeNames={'#ttl': 'ttl', '#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':s3_key': s3_key,
+                    ':last_updated': now.isoformat(),
+                    ':ttl': ttl,
+                    ':count': len(new_messages),
+                    ':owner': session_owner(session_id)
+                },
+                ReturnValues='ALL_NEW'
+            )
+            item = response['Attributes']
+            first_seq = int(item['message_count']) - len(new_messages)
+
+            messages_ttl = int(item.get('messages_ttl', 0))
+            if messages_ttl < ttl:
+                # Messages must not expire before the session item that lists them
+                messages_ttl = ttl + MESSAGE_TTL_MARGIN_SECONDS
+                self._restamp_messages(session_id, messages_ttl)
+                self.table.update_item(
+                    Key={'session_id': session_id},
+                    UpdateExpression='SET messages_ttl = :messages_ttl',
+                    ExpressionAttributeValues={':messages_ttl': messages_ttl}
+                )
+
+            # One item per new message. A failure here leaves a gap in the seqs, which
+            # reads skip; a retried save reserves a new range
+            if new_messages:
+                with self.messages_table.batch_writer() as batch:
+                    for seq, message in enumerate(new_messages, start=first_seq):
+                        batch.put_item(Item={
+                            'session_id': session_id,
+                            'seq': seq,
+                            'role': message.get('role', ''),
+                            'content': message.get('content', ''),
+                            'timestamp': message.get('timestamp', now.isoformat()),
+                            'ttl': messages_ttl
+                        })
+            self.invalidate_sessions_cache()
             return True
             
         except Exception as e:
             print(f"Error saving chat history: {str(e)}")
+            telemetry.count("errors_total", stage="dynamodb.save_chat_history")
             return False
 
+    def _query_messages(self, session_id: str) -> List[Dict[str, str]]:
+        """All messages of a session in order, following DynamoDB pagination"""
+        from boto3.dynamodb.conditions import Key
+        messages = []
+        query_args = {
+            'KeyConditionExpression': Key('session_id').eq(session_id),
+            'ScanIndexForward': True
+        }
+        while True:
+            response = self.messages_table.query(**query_args)
+            for item in response.get('Items', []):
+                messages.append({
+                    'content': item.get('content', ''),
+                    'role': item.get('role', ''),
+                    'timestamp': item.get('timestamp', '')
+                })
+            if 'LastEvaluatedKey' not in response:
+                return messages
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @telemetry.traced("dynamodb.get_chat_history")
     def get_chat_history(self, session_id: str) -> Optional[Dict[str, Any]]:
-        """Retrieve and format chat history from DynamoDB"""
+        """
+        Retrieve and format chat history from DynamoDB. `stored_messages` is how many of
+        the returned messages are in the messages table, the `stored` to save them with.
+        """
         try:
             response = self.table.get_item(Key={'session_id': session_id})
             if 'Item' not in response:
@@ -81,33 +259,161 @@ class ChatHistoryManager:
 
             item = response['Item']
             
-            # Convert messages back to application format
             if 'messages' in item:
+                # Legacy layout: the whole conversation inline in the session item
                 item['messages'] = [
                     self._format_message_from_dynamodb(msg)
                     for msg in item['messages']
                 ]
+                # None of them are in the messages table: the next save copies them over
+                item['stored_messages'] = 0
+            else:
+                item['messages'] = self._query_messages(session_id)
+                item['stored_messages'] = len(item['messages'])
             
             return item
 
         except Exception as e:
             print(f"Error retrieving chat history: {str(e)}")
+            telemetry.count("errors_total", stage="dynamodb.get_chat_history")
             return None
 
-    def list_sessions(self, limit: int = 10) -> List[Dict[str, str]]:
-        """List available chat sessions"""
-        try:
-            response = self.table.scan(
+    @telemetry.traced("dynamodb.list_sessions")
+    def list_sessions_page(
+        self,
+        limit: int = 10,
+        before: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], Optional[str]]:
+        """
+        One page of unexpired sessions, most recently updated first, read from the
+        owner/last_updated GSI. Pass the returned cursor back in as `before` for the
+        next page; it is None once there are no older sessions.
+        """
+        # ttl is last_updated + SESSION_TTL_SECONDS, so this bound skips expired sessions
+        cutoff = datetime.fromtimestamp(datetime.now().timestamp() - SESSION_TTL_SECONDS).isoformat()
+        if self._use_index:
+            try:
+                sessions = self._query_recent_sessions(limit, cutoff, before)
+            except Exception as e:
+                if not _missing_index(e):
+                    raise
+                print(
+                    f"Index {DYNAMODB_RECENT_SESSIONS_INDEX} not found on {self.table_name}, "
+                    f"listing sessions with a table scan: {str(e)}"
+                )
+                self._use_index = False
+        if not self._use_index:
+            sessions = self._scan_recent_sessions(limit, cutoff, before)
+        cursor = sessions[-1]['last_updated'] if len(sessions) == limit else None
+        return sessions, cursor
+
+    def _query_recent_sessions(self, limit: int, cutoff: str, before: Optional[str]) -> List[Dict[str, str]]:
+        """Newest sessions across the owner shards, one GSI query per shard"""
+        from boto3.dynamodb.conditions import Key
+        if before:
+            updated = Key('last_updated').between(cutoff, before)
+        else:
+            updated = Key('last_updated').gt(cutoff)
+        sessions = []
+        for owner in session_owners():
+            response = self.table.query(
+                IndexName=DYNAMODB_RECENT_SESSIONS_INDEX,
+                KeyConditionExpression=Key('owner').eq(owner) & updated,
                 ProjectionExpression='session_id, last_updated',
-                Limit=limit,
-                FilterExpression=Key('ttl').gt(int(datetime.now().timestamp()))
+                ScanIndexForward=False,
+                # One extra so the cursor item, which BETWEEN includes, can be dropped
+                Limit=limit + 1 if before else limit
             )
-            
-            sessions = response.get('Items', [])
-            sessions.sort(key=lambda x: x.get('last_updated', ''), reverse=True)
-            return sessions
+            sessions.extend(response.get('Items', []))
+        return _newest(sessions, limit, before)
+
+    def _scan_recent_sessions(self, limit: int, cutoff: str, before: Optional[str]) -> List[Dict[str, str]]:
+        """Fallback for tables without the GSI: reads every session item"""
+        from boto3.dynamodb.conditions import Attr
+        scan_args = {
+            'ProjectionExpression': 'session_id, last_updated',
+            'FilterExpression': Attr('last_updated').gt(cutoff)
+        }
+        sessions = []
+        while True:
+            response = self.table.scan(**scan_args)
+            sessions.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return _newest(sessions, limit, before)
+
+    def backfill_owners(self) -> int:
+        """
+        Set owner on session items that lack it (written before the GSI existed) or that
+        carry a different shard than SESSION_OWNER/SESSION_OWNER_SHARDS now assign.
+        Returns the number of items updated.
+        """
+        scan_args = {'ProjectionExpression': 'session_id, #owner', 'ExpressionAttributeNames': {'#owner': 'owner'}}
+        updated = 0
+        while True:
+            response = self.table.scan(**scan_args)
+            for item in response.get('Items', []):
+                owner = session_owner(item['session_id'])
+                if item.get('owner') == owner:
+                    continue
+                try:
+                    self.table.update_item(
+                        Key={'session_id': item['session_id']},
+                        UpdateExpression='SET #owner = :owner',
+                        # Skip sessions that expired and were deleted since the scan
+                        ConditionExpression='attribute_exists(session_id)',
+                        ExpressionAttributeNames={'#owner': 'owner'},
+                        ExpressionAttributeValues={':owner': owner}
+                    )
+                    updated += 1
+                except Exception as e:
+                    print(f"Error backfilling owner for {item['session_id']}: {str(e)}")
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        self.invalidate_sessions_cache()
+        return updated
+
+    def list_sessions(self, limit: int = 10) -> List[Dict[str, str]]:
+        """List the most recent chat sessions, cached briefly so reruns don't hit DynamoDB"""
+        try:
+            with self._sessions_lock:
+                cached = self._sessions_cache
+                if cached and cached[0] > time.monotonic() and cached[1] == limit:
+                    telemetry.count("session_list_cache_hits")
+                    return list(cached[2])
+
+            sessions, _ = self.list_sessions_page(limit)
+            with self._sessions_lock:
+                self._sessions_cache = (time.monotonic() + SESSION_LIST_CACHE_TTL, limit, sessions)
+            return list(sessions)
 
         except Exception as e:
             print(f"Error listing sessions: {str(e)}")
+            telemetry.count("errors_total", stage="dynamodb.list_sessions")
             return []
-        #
\ No newline at end of file
+
+    def invalidate_sessions_cache(self) -> None:
+        with self._sessions_lock:
+            self._sessions_cache = None
+        #
+
+@st.cache_resource(show_spinner=False)
+def get_chat_history_manager() -> ChatHistoryManager:
+    """Single ChatHistoryManager shared by every browser session in this process"""
+    return ChatHistoryManager()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create or migrate the chat session tables")
+    parser.add_argument("--create-tables", action="store_true", help="create DYNAMODB_TABLE and DYNAMODB_MESSAGES_TABLE")
+    parser.add_argument("--backfill-owners", action="store_true", help="set the owner attribute the recent-sessions GSI is keyed on")
+    args = parser.parse_args()
+
+    manager = ChatHistoryManager()
+    if args.create_tables:
+        create_tables(manager.dynamodb, manager.table_name)
+        print(f"Created {manager.table_name} and {DYNAMODB_MESSAGES_TABLE}")
+    if args.backfill_owners:
+        print(f"Set owner on {manager.backfill_owners()} sessions in {manager.table_name}")
@@ -1,89 +1,248 @@
 # chat_interface.py
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from typing import List, Tuple
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence
 import numpy as np
+import telemetry
 from llm import get_llm
+from retrieval import HybridRetriever
+from segments import SegmentedIndex
+from response_cache import ResponseCache, get_response_cache
+from embedding_cache import QueryEmbeddingCache, get_query_embedding_cache
+from config import (
+    RESPONSE_CACHE_ENABLED,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    EMBEDDING_MODEL_ID,
+    EMBEDDING_MAX_IN_FLIGHT,
+)
+from conversation_memory import TokenBudgetMemory
+from chunking import load_token_counter
+
+# A plain format string: langchain's PromptTemplate added a slow import for the same result
+PROMPT_TEMPLATE = (
+    "You are an AI assistant helping with PDF document questions.\n"
+    "Previous conversation:\n{history}\n\n"
+    "Relevant PDF content:\n{context}\n\n"
+    "Human: {input}\n"
+    "Assistant: "
+)
 
 class ChatInterface:
-    def __init__(self, embeddings_data: dict):
-        self.chunks = embeddings_data['chunks']
-        self.faiss_index = embeddings_data['faiss_index']
-        self.embeddings = embeddings_data['embeddings']
-        self.embeddings_model = embeddings_data.get('embeddings_model')
-        self.memory = ConversationBufferMemory()
-        self.llm = get_llm()
-        
-    def _get_relevant_context(self, query: str, k: int = 3) -> str:
-        """Retrieve relevant context using FAISS similarity search"""
+    def __init__(
+        self,
+        embeddings_data,
+        embeddings_model=None,
+        document_id: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        llm=None,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+    ):
+        if not isinstance(embeddings_data, SegmentedIndex):
+            # A single data package, as built by EmbeddingsManager.build_embeddings
+            embeddings_model = embeddings_model or embeddings_data.get('embeddings_model')
+            embeddings_data = SegmentedIndex.from_data(embeddings_data)
+        self.set_index(embeddings_data)
+        self.embeddings_model = embeddings_model
+        self.document_id = document_id or self.index.session_id
+        if response_cache is None and RESPONSE_CACHE_ENABLED:
+            response_cache = get_response_cache()
+        self.response_cache = response_cache
+        if query_cache is None and QUERY_EMBEDDING_CACHE_SIZE > 0:
+            query_cache = get_query_embedding_cache()
+        self.query_cache = query_cache
+        self.model_id = getattr(embeddings_model, "model_id", None) or EMBEDDING_MODEL_ID
+        self.llm = llm or get_llm()
+        self.memory = TokenBudgetMemory(
+            summarize=self.llm.invoke,
+            embeddings_model=self.embeddings_model,
+        )
+        self._count_tokens = load_token_counter()
+        self.last_prompt_tokens = 0
+
+    def set_index(self, index: SegmentedIndex) -> None:
+        """Answer from this index from now on, keeping the conversation so far"""
+        self.index = index
+        self.chunks = index.chunks
+        self.embeddings = index.embeddings
+        self.retriever = HybridRetriever(index)
+
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        return self._embed_queries([query])
+
+    def _embed_queries(self, queries: Sequence[str]) -> Optional[np.ndarray]:
+        """
+        One row per query. Queries are looked up in the query embedding cache by
+        normalized text; only the misses go to the embeddings model, once each and
+        up to EMBEDDING_MAX_IN_FLIGHT at a time.
+        """
+        if not self.embeddings_model:
+            return None
+        keys = [QueryEmbeddingCache.normalize(query) for query in queries]
+        unique = list(dict.fromkeys(keys))
+        vectors: Dict[str, np.ndarray] = {}
+        if self.query_cache is not None:
+            vectors = self.query_cache.get_many(self.model_id, unique)
+            telemetry.count("query_embedding_cache_hits", len(vectors))
+            telemetry.count("query_embedding_cache_misses", len(unique) - len(vectors))
+        missing = {key: query for key, query in zip(keys, queries) if key not in vectors}
+        if missing:
+            with telemetry.span("bedrock.embed_query", queries=len(missing)):
+                if len(missing) == 1:
+                    rows = [self.embeddings_model.embed_query(next(iter(missing.values())))]
+                else:
+                    with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_IN_FLIGHT, len(missing))) as pool:
+                        rows = list(pool.map(
+                            telemetry.in_context(self.embeddings_model.embed_query), missing.values()
+                        ))
+            fresh = {key: np.asarray(row, dtype=np.float32) for key, row in zip(missing, rows)}
+            if self.query_cache is not None:
+                self.query_cache.put_many(self.model_id, fresh)
+            vectors.update(fresh)
+        return np.vstack([vectors[key] for key in keys])
+
+    def _get_relevant_context(
+        self,
+        query: str,
+        k: int = 3,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> str:
+        """
+        Retrieve relevant context by fusing FAISS similarity search with BM25 keyword matches.
+        Without an embeddings model the keyword matches are used alone.
+        nprobe / ef_search override the index's defaults for IVF / HNSW indexes.
+        """
+        return self.get_relevant_contexts([query], k, nprobe, ef_search, query_embedding)[0]
+
+    @telemetry.traced("retrieve")
+    def get_relevant_contexts(
+        self,
+        queries: Sequence[str],
+        k: int = 3,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        query_embeddings: Optional[np.ndarray] = None,
+    ) -> List[str]:
+        """
+        Context for several queries at once, such as rewrites of one question or an
+        evaluation set: the queries are embedded together and every vector goes
+        through a single FAISS search per segment.
+        """
         try:
-            # If we have the embeddings model in the data
-            if self.embeddings_model:
-                query_embedding = np.array(
-                    self.embeddings_model.embed_query(query)
-                ).reshape(1, -1)
-            else:
-                # Fall back to using the first embedding's dimension
-                dimension = len(self.embeddings[0])
-                query_embedding = np.zeros((1, dimension))
-            
-            D, I = self.faiss_index.search(query_embedding.astype('float32'), k)
-            relevant_chunks = [self.chunks[i] for i in I[0]]
-            return "\n".join(relevant_chunks)
+            if query_embeddings is None:
+                query_embeddings = self._embed_queries(queries)
+            # Row ids change when the index is compacted; hold it until the chunks are read
+            with self.index.lock:
+                batches = self.retriever.retrieve_batch(
+                    queries,
+                    query_embeddings,
+                    k,
+                    nprobe=nprobe,
+                    ef_search=ef_search,
+                )
+                return ["\n".join(self._format_chunk(i) for i in ids) for ids in batches]
         except Exception as e:
-            print(f"Error in _get_relevant_context: {str(e)}")
-            return ""
+            print(f"Error in get_relevant_contexts: {str(e)}")
+            telemetry.count("errors_total", stage="retrieve")
+            return ["" for _ in queries]
 
-    def generate_response(self, user_input: str) -> str:
+    def _format_chunk(self, i: int) -> str:
+        """Chunk text, labelled with its source document and page where known"""
+        name, page = self.index.source(i)
+        labels = []
+        if name and len(self.index.live_documents()) > 1:
+            labels.append(name)
+        if page is not None:
+            labels.append(f"Page {page}")
+        if not labels:
+            return self.chunks[i]
+        return f"[{', '.join(labels)}] {self.chunks[i]}"
+
+    def _build_prompt(
+        self,
+        user_input: str,
+        query_embedding: Optional[np.ndarray] = None,
+        history_str: Optional[str] = None,
+    ) -> str:
+        # Get relevant context
+        context = self._get_relevant_context(user_input, query_embedding=query_embedding)
+        
+        # Get conversation history, bounded by the memory's token budget
+        if history_str is None:
+            history_str = self.memory.render(query_embedding)
+        
+        # Format the prompt
+        prompt = PROMPT_TEMPLATE.format(
+            history=history_str,
+            input=user_input,
+            context=context
+        )
+        self.last_prompt_tokens = self._count_tokens([prompt])[0]
+        telemetry.count("prompt_tokens", self.last_prompt_tokens)
+        return prompt
+
+    def stream_response(self, user_input: str, use_cache: bool = True) -> Iterator[str]:
+        """
+        Yield the answer as the LLM produces it. The full text is saved to
+        memory once the stream completes. With use_cache, a near-identical
+        earlier question on the same document, asked with the same conversation
+        history in the prompt, is answered without the LLM.
+        """
+        parts: List[str] = []
         try:
-            # Get relevant context
-            context = self._get_relevant_context(user_input)
-            
-            # Create a prompt template for this specific interaction
-            prompt_template = PromptTemplate(
-                input_variables=["history", "input", "context"],
-                template=(
-                    "You are an AI assistant helping with PDF document questions.\n"
-                    "Previous conversation:\n{history}\n\n"
-                    "Relevant PDF content:\n{context}\n\n"
-                    "Human: {input}\n"
-                    "Assistant: "
-                )
+            start = time.perf_counter()
+            query_embedding = self._embed_query(user_input)
+            history_str = self.memory.render(query_embedding)
+            # Follow-ups like "what about the second one?" only mean the same thing after the same history
+            history_key = hashlib.sha256(history_str.encode("utf-8")).hexdigest()
+            cacheable = (
+                use_cache
+                and self.response_cache is not None
+                and self.document_id is not None
+                and query_embedding is not None
             )
-            
-            # Get conversation history
-            history = self.memory.load_memory_variables({})
-            history_str = history.get("history", "")
-            
-            # Format the prompt
-            prompt = prompt_template.format(
-                history=history_str,
-                input=user_input,
-                context=context
+            cached = (
+                self.response_cache.lookup(self.document_id, query_embedding, history_key) if cacheable else None
             )
-            
-            # Generate response
-            response = self.llm.predict(prompt)
-            
-            # Update memory
-            if history_str:
-                self.memory.save_context(
-                    {"input": user_input},
-                    {"output": response}
-                )
+            if cacheable:
+                telemetry.count("response_cache_hits" if cached is not None else "response_cache_misses")
+            if cached is not None:
+                self.last_prompt_tokens = 0
+                parts.append(cached)
+                yield cached
             else:
-                # First interaction
-                self.memory = ConversationBufferMemory(memory_key="history")
-                self.memory.save_context(
-                    {"input": user_input},
-                    {"output": response}
-                )
-            
-            return response
-            
+                prompt = self._build_prompt(user_input, query_embedding, history_str)
+                with telemetry.span("llm.generate") as span:
+                    for token in self.llm.stream(prompt):
+                        if not parts:
+                            span.set(first_token_ms=round((time.perf_counter() - start) * 1000, 1))
+                        parts.append(token)
+                        yield token
+                if telemetry.enabled():
+                    telemetry.count("completion_tokens", self._count_tokens(["".join(parts)])[0])
+                if cacheable:
+                    self.response_cache.store(
+                        self.document_id,
+                        query_embedding,
+                        "".join(parts),
+                        time.perf_counter() - start,
+                        history_key,
+                    )
         except Exception as e:
             print(f"Error generating response: {str(e)}")
-            return "I apologize, but I encountered an error processing your question. Please try again."
+            telemetry.count("errors_total", stage="generate")
+            if not parts:
+                yield "I apologize, but I encountered an error processing your question. Please try again."
+            return
+
+        # Update memory
+        self.memory.save_context(
+            {"input": user_input},
+            {"output": "".join(parts)}
+        )
 
-#
\ No newline at end of file
+    def generate_response(self, user_input: str, use_cache: bool = True) -> str:
+        """Blocking variant of stream_response"""
+        return "".join(self.stream_response(user_input, use_cache))
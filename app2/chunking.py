@@ -0,0 +1,178 @@
+# chunking.py
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+
+# Per-chunk metadata stored next to the index: source page and document char offsets
+CHUNK_META_DTYPE = np.dtype([("page", np.int32), ("start", np.int64), ("end", np.int64)])
+
+# A sentence ends at terminal punctuation followed by whitespace; a paragraph at a blank line
+_BOUNDARY = re.compile(r"\n[ \t]*\n\s*|(?<=[.!?])[\"')\]]*\s+")
+_WORD = re.compile(r"\S+\s*")
+
+@lru_cache(maxsize=None)
+def load_token_counter(encoding_name: str = "cl100k_base") -> Callable[[List[str]], List[int]]:
+    """Returns a function mapping a list of texts to their token counts"""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda texts: [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+    except Exception as e:
+        # tiktoken downloads its vocabularies on first use; degrade to ~4 chars per token offline
+        print(f"tiktoken unavailable, estimating token counts: {str(e)}")
+        return lambda texts: [max(1, len(text) // 4) for text in texts]
+
+def _token_splitter(encoding) -> Callable[[str, int], List[int]]:
+    def split(text: str, max_tokens: int) -> List[int]:
+        _, starts = encoding.decode_with_offsets(encoding.encode_ordinary(text))
+        # A token that starts inside a multi-byte character reports that character's offset
+        return sorted(set(starts[max_tokens::max_tokens]) - {0})
+    return split
+
+@lru_cache(maxsize=None)
+def load_token_splitter(encoding_name: str = "cl100k_base") -> Callable[[str, int], List[int]]:
+    """
+    Returns a function giving the character offsets at which to cut a text into
+    pieces of at most `max_tokens` tokens, consistent with load_token_counter
+    """
+    try:
+        import tiktoken
+        return _token_splitter(tiktoken.get_encoding(encoding_name))
+    except Exception:
+        return lambda text, max_tokens: list(range(4 * max_tokens, len(text), 4 * max_tokens))
+
+class _Unit:
+    """A sentence (or a word, or part of a word, of an oversized sentence) with its document offsets"""
+    __slots__ = ("text", "start", "end", "page", "tokens", "paragraph_end")
+
+    def __init__(self, text: str, start: int, end: int, page: int, tokens: int, paragraph_end: bool):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.page = page
+        self.tokens = tokens
+        self.paragraph_end = paragraph_end
+
+class TokenChunker:
+    """
+    Packs sentences into chunks of at most `max_tokens`, closing chunks early at
+    paragraph breaks and carrying up to `overlap_tokens` of trailing sentences
+    into the next chunk. Each sentence is copied a bounded number of times, so
+    chunking is linear in the document length.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = CHUNK_MAX_TOKENS,
+        overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+        encoding_name: str = "cl100k_base",
+    ):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens must be smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self._count_tokens = load_token_counter(encoding_name)
+        self._split_tokens = load_token_splitter(encoding_name)
+
+    def _split_word(self, text: str) -> List[Tuple[int, int, int]]:
+        """(start, end, tokens) pieces of a whitespace-free run longer than the budget"""
+        limit = self.max_tokens
+        while True:
+            bounds = [0] + self._split_tokens(text, limit) + [len(text)]
+            pieces = [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+            counts = self._count_tokens([text[start:end] for start, end in pieces])
+            over = max(counts) - self.max_tokens
+            if over <= 0 or limit == 1:
+                return [(start, end, tokens) for (start, end), tokens in zip(pieces, counts)]
+            # Encoding a piece on its own can take a token or two more than its share of the run
+            limit = max(1, limit - over)
+
+    def _page_units(self, text: str, page: int, offset: int) -> List[_Unit]:
+        spans: List[Tuple[int, int, bool]] = []
+        position = 0
+        for match in _BOUNDARY.finditer(text):
+            if match.start() > position:
+                # The unit keeps its trailing whitespace so joined chunks read naturally
+                spans.append((position, match.end(), match.group().count("\n") >= 2))
+            position = match.end()
+        if position < len(text):
+            spans.append((position, len(text), False))
+        spans = [(start, end, paragraph) for start, end, paragraph in spans if text[start:end].strip()]
+
+        texts = [text[start:end] for start, end, _ in spans]
+        counts = self._count_tokens(texts) if texts else []
+        units: List[_Unit] = []
+        for (start, end, paragraph), unit_text, tokens in zip(spans, texts, counts):
+            if tokens <= self.max_tokens:
+                units.append(_Unit(unit_text, offset + start, offset + end, page, tokens, paragraph))
+                continue
+            # Sentence longer than the budget: fall back to word boundaries
+            words = list(_WORD.finditer(unit_text))
+            word_counts = self._count_tokens([word.group() for word in words])
+            for i, (word, word_tokens) in enumerate(zip(words, word_counts)):
+                pieces = [(0, len(word.group()), word_tokens)]
+                if word_tokens > self.max_tokens:
+                    # No whitespace to break at (a URL, encoded data): cut between tokens
+                    pieces = self._split_word(word.group())
+                for j, (piece_start, piece_end, piece_tokens) in enumerate(pieces):
+                    units.append(_Unit(
+                        word.group()[piece_start:piece_end],
+                        offset + start + word.start() + piece_start,
+                        offset + start + word.start() + piece_end,
+                        page,
+                        piece_tokens,
+                        paragraph and i == len(words) - 1 and j == len(pieces) - 1,
+                    ))
+        return units
+
+    def _emit(self, units: Deque[_Unit]) -> Dict[str, Any]:
+        text = "".join(unit.text for unit in units)
+        stripped = text.rstrip()
+        return {
+            "text": stripped,
+            "page": units[0].page,
+            "start": units[0].start,
+            "end": units[0].start + len(stripped),
+        }
+
+    def chunk_pages(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Dict[str, Any]]:
+        """
+        Yields {"text", "page", "start", "end"} for each chunk. Offsets index the
+        document formed by joining page texts with a newline after each page,
+        which is what utils.read_pdf returns.
+        """
+        current: Deque[_Unit] = deque()
+        current_tokens = 0
+        offset = 0
+        for page, text in pages:
+            if not text:
+                continue
+            for unit in self._page_units(text + "\n", page, offset):
+                if current and current_tokens + unit.tokens > self.max_tokens:
+                    yield self._emit(current)
+                    # Keep trailing sentences as overlap, leaving room for the new unit
+                    while current and (
+                        current_tokens > self.overlap_tokens
+                        or current_tokens + unit.tokens > self.max_tokens
+                    ):
+                        current_tokens -= current.popleft().tokens
+                current.append(unit)
+                current_tokens += unit.tokens
+                if unit.paragraph_end and current_tokens >= self.max_tokens // 2:
+                    yield self._emit(current)
+                    current.clear()
+                    current_tokens = 0
+            offset += len(text) + 1
+        if current:
+            yield self._emit(current)
+
+def chunk_pages(
+    pages: Iterable[Tuple[int, str]],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> Iterator[Dict[str, Any]]:
+    """Token-budgeted, sentence-aligned chunks of a stream of (page number, text)"""
+    return TokenChunker(max_tokens, overlap_tokens).chunk_pages(pages)
@@ -1,6 +1,7 @@
 
 #config.py
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -16,4 +17,123 @@ GEMINI_API = os.getenv("GEMINI_API")
 
 # For MVP, we are not using DynamoDB; however, the variable is still available.
 DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "ChatSessions")
-#
\ No newline at end of file
+#
+# Embedding pipeline tuning
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v1")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "8"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+EMBEDDING_BACKOFF_BASE = float(os.getenv("EMBEDDING_BACKOFF_BASE", "0.5"))
+EMBEDDING_BACKOFF_CAP = float(os.getenv("EMBEDDING_BACKOFF_CAP", "20"))
+
+# Embedding cache: local SQLite tier, optional shared tier under an S3 prefix
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "embedding_cache.sqlite3")
+)
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+EMBEDDING_CACHE_S3_PREFIX = os.getenv("EMBEDDING_CACHE_S3_PREFIX", "")
+
+# Local directory holding memory-mapped copies of session indexes
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "rag_index_cache"))
+
+# Upper bound on loaded session indexes kept in memory per process
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Background workers uploading freshly built indexes to S3
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "4"))
+
+# FAISS index selection: auto, flat, ivf_flat, ivf_pq or hnsw; metric l2, ip or cosine
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+INDEX_METRIC = os.getenv("INDEX_METRIC", "l2")
+# Vector compression inside the FAISS index: none, fp16, sq8 (8-bit scalar) or pq. Compressed
+# indexes re-score INDEX_RERANK_FACTOR x k candidates against the float32 vectors; with
+# INDEX_RERANK off those vectors are stored as float16 and only used for MMR and compaction
+INDEX_COMPRESSION = os.getenv("INDEX_COMPRESSION", "none")
+INDEX_RERANK = os.getenv("INDEX_RERANK", "true").lower() == "true"
+INDEX_RERANK_FACTOR = int(os.getenv("INDEX_RERANK_FACTOR", "4"))
+
+# PDF extraction: worker processes, pages per task and per-page time budget (seconds)
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "10"))
+
+# Token-aware chunking (cl100k_base tokens)
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+# Semantic response cache: cosine similarity needed for a hit, entry lifetime (seconds), entries per document
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+# Query embeddings: in-process LRU keyed by model and normalized question text (0 disables)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+
+# Conversation memory: token budget for history in each prompt, earlier turns recalled by similarity
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "1500"))
+MEMORY_RECALL_K = int(os.getenv("MEMORY_RECALL_K", "2"))
+
+# Chat messages live one item per message in their own table (session_id + seq keys)
+DYNAMODB_MESSAGES_TABLE = os.getenv("DYNAMODB_MESSAGES_TABLE", f"{DYNAMODB_TABLE}Messages")
+# Point at DynamoDB Local (e.g. http://localhost:8000) for development
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+
+# Recent-sessions listing: owner partition of the GSI, how many shards to spread it over,
+# index name and in-process cache lifetime (seconds). Run `python app2/chat_history.py
+# --backfill-owners` after creating the index or changing the shard count.
+SESSION_OWNER = os.getenv("SESSION_OWNER", "default")
+SESSION_OWNER_SHARDS = int(os.getenv("SESSION_OWNER_SHARDS", "1"))
+DYNAMODB_RECENT_SESSIONS_INDEX = os.getenv("DYNAMODB_RECENT_SESSIONS_INDEX", "owner-last_updated-index")
+SESSION_LIST_CACHE_TTL = float(os.getenv("SESSION_LIST_CACHE_TTL", "5"))
+
+# Write-behind chat persistence retries
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "5"))
+PERSIST_BACKOFF_BASE = float(os.getenv("PERSIST_BACKOFF_BASE", "0.5"))
+PERSIST_BACKOFF_CAP = float(os.getenv("PERSIST_BACKOFF_CAP", "30"))
+
+# Hybrid retrieval: candidates per retriever, reciprocal-rank-fusion constant, MMR relevance weight,
+# and the fraction of the best BM25 score a keyword match needs to be a candidate
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7"))
+RETRIEVAL_KEYWORD_MIN_SCORE = float(os.getenv("RETRIEVAL_KEYWORD_MIN_SCORE", "0.1"))
+
+# Multi-document sessions: compact once a session has more segments than this,
+# or once this fraction of its rows belongs to deleted documents
+SEGMENT_COMPACT_MAX_SEGMENTS = int(os.getenv("SEGMENT_COMPACT_MAX_SEGMENTS", "8"))
+SEGMENT_COMPACT_DELETED_RATIO = float(os.getenv("SEGMENT_COMPACT_DELETED_RATIO", "0.25"))
+
+# Shared AWS clients: one connection pool per service for the whole process.
+# The pool must cover concurrent uploads, embedding requests and cache fetches.
+AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", "5"))
+AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", "60"))
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "3"))
+
+# Telemetry: per-stage spans, counters and histograms. Exporters are a comma-separated list of
+# prometheus (text endpoint on TELEMETRY_PROMETHEUS_PORT in the web process, and on the
+# following ports in ingest worker processes, one each), json (one line per span, to
+# TELEMETRY_JSON_LOG_PATH or stderr) and otel (needs opentelemetry-api and an SDK)
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "false").lower() == "true"
+TELEMETRY_EXPORTERS = os.getenv("TELEMETRY_EXPORTERS", "")
+TELEMETRY_PROMETHEUS_PORT = int(os.getenv("TELEMETRY_PROMETHEUS_PORT", "9464"))
+TELEMETRY_JSON_LOG_PATH = os.getenv("TELEMETRY_JSON_LOG_PATH", "")
+# Per-request stage breakdown in the Streamlit sidebar (requires TELEMETRY_ENABLED)
+TELEMETRY_DEBUG_PANEL = os.getenv("TELEMETRY_DEBUG_PANEL", "false").lower() == "true"
+
+# Ingestion: "queue" hands uploads to background workers (ingest_worker.py), "inline" processes
+# them in the Streamlit run. The queue is a SQLite file shared by web and worker processes on a
+# host; INGEST_LOCAL_WORKERS worker threads run inside the web process (0 when workers run separately)
+INGEST_MODE = os.getenv("INGEST_MODE", "queue")
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "ingest_jobs.sqlite3"))
+INGEST_LOCAL_WORKERS = int(os.getenv("INGEST_LOCAL_WORKERS", "1"))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "1"))
+# A job whose worker has not renewed its lease for this long (seconds) is handed to another worker;
+# running workers renew it every third of this
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", "120"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+# How often the UI polls the status of this session's jobs (seconds)
+INGEST_STATUS_REFRESH = float(os.getenv("INGEST_STATUS_REFRESH", "2"))
@@ -0,0 +1,148 @@
+# conversation_memory.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+from chunking import load_token_counter
+from config import MEMORY_MAX_TOKENS, MEMORY_RECALL_K
+
+# Summaries and turn embeddings are computed here, never on the request path
+_BACKGROUND = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-memory")
+
+# Share of the history budget given to each part of the rendered history
+_RECENT_SHARE = 0.6
+_SUMMARY_SHARE = 0.2
+
+_SUMMARY_PROMPT = (
+    "Progressively summarize the conversation between a human and an AI assistant "
+    "about a PDF document, adding the new lines to the current summary. "
+    "Keep names, numbers and open questions. Use at most {words} words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines:\n{lines}\n\n"
+    "New summary:"
+)
+
+def _format_turn(turn: Dict[str, Any]) -> str:
+    return f"Human: {turn['input']}\nAI: {turn['output']}"
+
+class TokenBudgetMemory:
+    """
+    Conversation history that never exceeds `max_tokens` in a prompt.
+    The most recent turns are kept verbatim; turns that fall out of that window
+    are folded into a rolling summary in the background and, when an embeddings
+    model is available, can be recalled by similarity to the current question.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = MEMORY_MAX_TOKENS,
+        summarize: Optional[Callable[[str], str]] = None,
+        embeddings_model=None,
+        recall_k: int = MEMORY_RECALL_K,
+    ):
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.embeddings_model = embeddings_model
+        self.recall_k = recall_k
+        self.turns: List[Dict[str, Any]] = []
+        self.summary = ""
+        self.summarized_upto = 0
+        self._summarizing = False
+        self._lock = threading.Lock()
+        self._count_tokens = load_token_counter()
+
+    def save_context(self, inputs: Dict[str, str], outputs: Dict[str, str]) -> None:
+        turn = {"input": inputs["input"], "output": outputs["output"], "vector": None}
+        turn["tokens"] = self._count_tokens([_format_turn(turn)])[0]
+        with self._lock:
+            turn["position"] = len(self.turns)
+            self.turns.append(turn)
+        if self.embeddings_model is not None and self.recall_k > 0:
+            _BACKGROUND.submit(self._embed_turn, turn)
+        self._schedule_summary()
+
+    def _recent_start(self) -> int:
+        """Index of the oldest turn that still fits in the verbatim window"""
+        budget = int(self.max_tokens * _RECENT_SHARE)
+        used = 0
+        start = len(self.turns)
+        while start > 0 and used + self.turns[start - 1]["tokens"] <= budget:
+            start -= 1
+            used += self.turns[start]["tokens"]
+        return start
+
+    def _embed_turn(self, turn: Dict[str, Any]) -> None:
+        try:
+            vector = np.array(self.embeddings_model.embed_query(_format_turn(turn)), dtype=np.float32)
+            turn["vector"] = vector / (np.linalg.norm(vector) or 1.0)
+        except Exception as e:
+            print(f"Error embedding conversation turn: {str(e)}")
+
+    def _schedule_summary(self) -> None:
+        if self.summarize is None:
+            return
+        with self._lock:
+            if self._summarizing or self.summarized_upto >= self._recent_start():
+                return
+            self._summarizing = True
+        _BACKGROUND.submit(self._update_summary)
+
+    def _update_summary(self) -> None:
+        try:
+            with self._lock:
+                end = self._recent_start()
+                turns = self.turns[self.summarized_upto:end]
+                summary = self.summary
+            if not turns:
+                return
+            words = max(20, int(self.max_tokens * _SUMMARY_SHARE * 0.75))
+            new_summary = self.summarize(_SUMMARY_PROMPT.format(
+                words=words,
+                summary=summary or "(none)",
+                lines="\n".join(_format_turn(turn) for turn in turns),
+            )).strip()
+            with self._lock:
+                self.summary = new_summary
+                self.summarized_upto = end
+        except Exception as e:
+            print(f"Error summarizing conversation: {str(e)}")
+        finally:
+            with self._lock:
+                self._summarizing = False
+        # Turns may have left the window while the LLM was summarizing
+        self._schedule_summary()
+
+    def render(self, query_embedding: Optional[np.ndarray] = None) -> str:
+        """History text for the next prompt: summary, recalled turns, then recent turns"""
+        with self._lock:
+            recent_start = self._recent_start()
+            recent = self.turns[recent_start:]
+            older = self.turns[:recent_start]
+            summary = self.summary
+
+        budget = self.max_tokens - sum(turn["tokens"] for turn in recent)
+        parts: List[str] = []
+        if summary:
+            summary_tokens = self._count_tokens([summary])[0]
+            if summary_tokens <= budget:
+                parts.append(f"Summary of earlier conversation: {summary}")
+                budget -= summary_tokens
+
+        if query_embedding is not None and self.recall_k > 0 and older:
+            candidates = [turn for turn in older if turn["vector"] is not None]
+            if candidates:
+                query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+                query = query / (np.linalg.norm(query) or 1.0)
+                scores = np.stack([turn["vector"] for turn in candidates]) @ query
+                recalled = []
+                for i in np.argsort(-scores)[:self.recall_k]:
+                    turn = candidates[int(i)]
+                    if turn["tokens"] <= budget:
+                        recalled.append(turn)
+                        budget -= turn["tokens"]
+                # Keep recalled turns in conversation order
+                recalled.sort(key=lambda turn: turn["position"])
+                parts.extend(_format_turn(turn) for turn in recalled)
+
+        parts.extend(_format_turn(turn) for turn in recent)
+        return "\n".join(parts)
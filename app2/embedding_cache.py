@@ -0,0 +1,243 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import streamlit as st
+from config import (
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_S3_PREFIX,
+    QUERY_EMBEDDING_CACHE_SIZE,
+)
+
+# SQLite caps the number of bound parameters per statement
+_SQL_BATCH = 500
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of chunk embeddings.
+    A size-bounded SQLite file is the local tier; an S3 prefix can be added
+    as a shared tier so containers reuse each other's embeddings.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        s3_client=None,
+        bucket_name: Optional[str] = None,
+        s3_prefix: str = EMBEDDING_CACHE_S3_PREFIX,
+        max_in_flight: int = 8,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_prefix = s3_prefix.strip("/")
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+            "nbytes INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_id: str, text: str) -> str:
+        """Hash of model id plus chunk text"""
+        digest = hashlib.sha256()
+        digest.update(model_id.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def s3_enabled(self) -> bool:
+        return bool(self.s3_client and self.bucket_name and self.s3_prefix)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Return the cached vectors for whichever keys are present"""
+        unique_keys = list(dict.fromkeys(keys))
+        found = self._get_local(unique_keys)
+
+        missing = [key for key in unique_keys if key not in found]
+        if missing and self.s3_enabled:
+            shared = self._get_s3(missing)
+            if shared:
+                self._put_local(shared)
+                found.update(shared)
+        return found
+
+    def put_many(self, vectors: Dict[str, np.ndarray]) -> None:
+        """Insert vectors into the local tier and, when configured, the shared tier"""
+        if not vectors:
+            return
+        self._put_local(vectors)
+        if self.s3_enabled:
+            self._put_s3(vectors)
+
+    def _get_local(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), _SQL_BATCH):
+                batch = keys[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _put_local(self, vectors: Dict[str, np.ndarray]) -> None:
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = np.ascontiguousarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, nbytes, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self) -> None:
+        """Drop least recently used rows until the cache is back under 90% of max_bytes"""
+        total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        cursor = self._conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_access")
+        evicted = []
+        for key, nbytes in cursor:
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= nbytes
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+
+    def _s3_key(self, key: str) -> str:
+        return f"{self.s3_prefix}/{key[:2]}/{key}"
+
+    def _get_s3(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        def fetch(key: str) -> Optional[np.ndarray]:
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._s3_key(key))
+                return np.frombuffer(response["Body"].read(), dtype=np.float32)
+            except Exception as e:
+                # Matched on the error code so botocore isn't imported with this module
+                response = getattr(e, "response", None)
+                code = response.get("Error", {}).get("Code") if isinstance(response, dict) else None
+                if code not in ("NoSuchKey", "404"):
+                    print(f"Error reading shared embedding cache: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            results = pool.map(fetch, keys)
+            return {key: vector for key, vector in zip(keys, results) if vector is not None}
+
+    def _put_s3(self, vectors: Dict[str, np.ndarray]) -> None:
+        def upload(item) -> None:
+            key, vector = item
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=self._s3_key(key),
+                    Body=np.ascontiguousarray(vector, dtype=np.float32).tobytes(),
+                )
+            except Exception as e:
+                print(f"Error writing shared embedding cache: {str(e)}")
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            list(pool.map(upload, vectors.items()))
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU of query embeddings, keyed by model id and normalized query
+    text, so a repeated question (a retry, a rerun, the same question in another
+    session) is not sent to the embeddings model again.
+    """
+
+    def __init__(self, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Case, Unicode form and whitespace don't change what a question asks"""
+        return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+    def get_many(self, model_id: str, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Cached vectors for whichever normalized texts are present"""
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for text in texts:
+                key = (model_id, text)
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[text] = vector
+                self.hits += 1
+        return found
+
+    def put_many(self, model_id: str, vectors: Dict[str, np.ndarray]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for text, vector in vectors.items():
+                vector = np.array(vector, dtype=np.float32).reshape(-1)
+                # Callers get the cached array itself; keep it from being changed in place
+                vector.setflags(write=False)
+                self._entries[(model_id, text)] = vector
+                self._entries.move_to_end((model_id, text))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """Single QueryEmbeddingCache shared by every browser session in this process"""
+    return QueryEmbeddingCache()
@@ -1,82 +1,714 @@
+import json
 import os
 import pickle
+import threading
+import random
+import shutil
 import tempfile
-import boto3
-from typing import List, Dict, Any
-import faiss
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple, Union
 import numpy as np
-from langchain.embeddings import BedrockEmbeddings
+import streamlit as st
 from dotenv import load_dotenv
+from config import (
+    EMBEDDING_MODEL_ID,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MAX_IN_FLIGHT,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDING_BACKOFF_BASE,
+    EMBEDDING_BACKOFF_CAP,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_S3_PREFIX,
+    INDEX_CACHE_DIR,
+    UPLOAD_MAX_WORKERS,
+    INDEX_TYPE,
+    INDEX_METRIC,
+    INDEX_COMPRESSION,
+    INDEX_RERANK,
+    INDEX_RERANK_FACTOR,
+)
+import aws
+import telemetry
+from embedding_cache import EmbeddingCache
+from chunking import CHUNK_META_DTYPE
+from index_factory import DEFAULT_INDEX_PARAMS, build_index, stored_vectors
+from retrieval import BM25Index
+from index_store import (
+    FORMAT_VERSION,
+    MANIFEST_FILE,
+    open_index_files,
+    read_head,
+    read_manifest,
+    build_index_payloads,
+)
+from segments import SegmentedIndex, make_segment
 
 load_dotenv()
 
+INDEX_PREFIX = "index"
+LEGACY_FILENAME = "document_embeddings.pkl"
+
+# Index uploads run off the request path
+_UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="index-upload")
+
+# Writes to one session's manifest are serialized; the upload pool may run several at once
+_SESSION_WRITE_LOCKS: Dict[str, threading.RLock] = {}
+_SESSION_WRITE_LOCKS_GUARD = threading.Lock()
+
+def _session_write_lock(session_id: str) -> threading.RLock:
+    with _SESSION_WRITE_LOCKS_GUARD:
+        return _SESSION_WRITE_LOCKS.setdefault(session_id, threading.RLock())
+
+_THROTTLING_MARKERS = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "Too many requests",
+    "Rate exceeded",
+)
+
+def _is_throttling_error(error: Exception) -> bool:
+    """Bedrock throttling surfaces either as a ClientError or wrapped in a ValueError by langchain"""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        if code in _THROTTLING_MARKERS:
+            return True
+    message = str(error)
+    return any(marker in message for marker in _THROTTLING_MARKERS)
+
+def _is_not_found(error: Exception) -> bool:
+    """S3 missing-object errors, matched on the code so botocore isn't imported with this module"""
+    response = getattr(error, "response", None)
+    return isinstance(response, dict) and response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+def _is_precondition_failed(error: Exception) -> bool:
+    """A conditional S3 write lost to another writer"""
+    response = getattr(error, "response", None)
+    return isinstance(response, dict) and response.get("Error", {}).get("Code") in (
+        "412", "PreconditionFailed", "ConditionalRequestConflict"
+    )
+
+class ManifestConflict(Exception):
+    """The session manifest changed in S3 since the index being written was loaded"""
+
 class EmbeddingsManager:
-    def __init__(self):
-        self.s3_client = boto3.client("s3", region_name="us-east-1")
+    def __init__(
+        self,
+        embeddings_model=None,
+        s3_client=None,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        embedding_cache: Optional[EmbeddingCache] = None,
+    ):
+        # Clients are created on first use; the Bedrock model also defers importing langchain
+        self._s3_client = s3_client
+        self._embeddings_model = embeddings_model
+        self._model_lock = threading.Lock()
         self.bucket_name = os.getenv("S3_BUCKET_NAME")
-        bedrock_client = boto3.client("bedrock-runtime", region_name="us-east-1")
-        self.embeddings_model = BedrockEmbeddings(
-            model_id="amazon.titan-embed-text-v1",
-            client=bedrock_client
-        )
-        
+        self.model_id = getattr(embeddings_model, "model_id", None) or EMBEDDING_MODEL_ID
+        if embedding_cache is None and EMBEDDING_CACHE_ENABLED:
+            try:
+                embedding_cache = EmbeddingCache(
+                    s3_client=self.s3_client if EMBEDDING_CACHE_S3_PREFIX else None,
+                    bucket_name=self.bucket_name,
+                )
+            except Exception as e:
+                print(f"Embedding cache disabled: {str(e)}")
+        self.embedding_cache = embedding_cache
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max(0, max_retries)
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = aws.client("s3")
+        return self._s3_client
+
+    @property
+    def embeddings_model(self):
+        if self._embeddings_model is None:
+            with self._model_lock:
+                if self._embeddings_model is None:
+                    from langchain.embeddings import BedrockEmbeddings
+                    self._embeddings_model = BedrockEmbeddings(
+                        model_id=EMBEDDING_MODEL_ID,
+                        # Standard retries cover transient errors on every call, embed_query
+                        # included; throttling that outlasts them is retried per text with
+                        # longer backoff in _embed_text_with_retry
+                        client=aws.client("bedrock-runtime"),
+                    )
+        return self._embeddings_model
+
+    def _embed_batch_with_retry(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed one batch. Titan takes a single text per request (langchain loops over
+        the batch), so texts are sent one at a time and a throttled request is retried
+        on its own with full-jitter exponential backoff; texts of the batch that were
+        already embedded are not sent again.
+        """
+        vectors = []
+        with telemetry.span("bedrock.embed_documents", texts=len(texts)):
+            for text in texts:
+                vectors.append(self._embed_text_with_retry(text))
+        return vectors
+
+    def _embed_text_with_retry(self, text: str) -> List[float]:
+        attempt = 0
+        while True:
+            try:
+                vector = self.embeddings_model.embed_documents([text])[0]
+                telemetry.count("chunks_embedded")
+                return vector
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_throttling_error(e):
+                    raise
+                telemetry.count("bedrock_throttled")
+                delay = min(EMBEDDING_BACKOFF_CAP, EMBEDDING_BACKOFF_BASE * (2 ** attempt))
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+
+    def _lookup_cache(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        if not self.embedding_cache or not keys:
+            return {}
+        try:
+            found = self.embedding_cache.get_many(keys)
+            telemetry.count("embedding_cache_hits", len(found))
+            telemetry.count("embedding_cache_misses", len(keys) - len(found))
+            return found
+        except Exception as e:
+            print(f"Error reading embedding cache: {str(e)}")
+            return {}
+
+    def embed_stream(
+        self,
+        chunks: Iterable[str],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Tuple[List[str], np.ndarray]:
+        """
+        Embed chunks as they arrive from a (possibly lazy) iterable, so Bedrock calls
+        overlap with PDF extraction. At most `max_in_flight` batches run at once and
+        texts that are cached or repeated earlier in the upload are not re-embedded.
+        Returns the chunks and a float32 matrix with one row per chunk, in order.
+        `on_progress(embedded, to_embed)` is called as Bedrock batches complete.
+        """
+        collected: List[str] = []
+        keys: List[str] = []
+        vectors: Dict[str, np.ndarray] = {}
+        waiting: Dict[str, str] = {}
+        submitted = set()
+        futures: Dict[Future, List[str]] = {}
+        pool = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+        def dispatch() -> None:
+            # Fail fast instead of extracting the rest of the document after Bedrock errors
+            for future in futures:
+                if future.done() and future.exception():
+                    raise future.exception()
+            vectors.update(self._lookup_cache(list(waiting)))
+            misses = [(key, text) for key, text in waiting.items() if key not in vectors]
+            waiting.clear()
+            for start in range(0, len(misses), self.batch_size):
+                batch = misses[start:start + self.batch_size]
+                future = pool.submit(
+                    telemetry.in_context(self._embed_batch_with_retry), [text for _, text in batch]
+                )
+                futures[future] = [key for key, _ in batch]
+                submitted.update(key for key, _ in batch)
+
+        fresh: Dict[str, np.ndarray] = {}
+        try:
+            for chunk in chunks:
+                key = EmbeddingCache.make_key(self.model_id, chunk)
+                collected.append(chunk)
+                keys.append(key)
+                if key in vectors or key in waiting or key in submitted:
+                    continue
+                waiting[key] = chunk
+                if len(waiting) >= self.batch_size * self.max_in_flight:
+                    dispatch()
+            dispatch()
+
+            for future in as_completed(futures):
+                rows = np.asarray(future.result(), dtype=np.float32)
+                fresh.update(zip(futures[future], rows))
+                if on_progress:
+                    on_progress(len(fresh), len(submitted))
+        except Exception:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown(wait=True)
+
+        if not collected:
+            raise ValueError("No text chunks to embed")
+
+        vectors.update(fresh)
+        if self.embedding_cache and fresh:
+            try:
+                self.embedding_cache.put_many(fresh)
+            except Exception as e:
+                print(f"Error writing embedding cache: {str(e)}")
+
+        dimension = len(next(iter(vectors.values())))
+        matrix = np.empty((len(collected), dimension), dtype=np.float32)
+        for row, key in enumerate(keys):
+            matrix[row] = vectors[key]
+        return collected, matrix
+
+    def embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        """Embed a list of chunks; rows of the returned float32 matrix are in chunk order"""
+        return self.embed_stream(chunks)[1]
+
+    def build_embeddings(
+        self,
+        chunks: Iterable[Union[str, Dict[str, Any]]],
+        session_id: str,
+        metric: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Generate embeddings for text chunks and build the in-memory FAISS and BM25 indexes.
+        `chunks` may be a generator; embedding starts before it is exhausted.
+        Chunks from chunking.chunk_pages keep their page and offsets as chunk_metadata.
+        """
+        metadata: List[Tuple[int, int, int]] = []
+
+        def texts() -> Iterator[str]:
+            for chunk in chunks:
+                if isinstance(chunk, dict):
+                    metadata.append((chunk.get("page", 0), chunk.get("start", 0), chunk.get("end", 0)))
+                    yield chunk["text"]
+                else:
+                    yield chunk
+
+        # PDF extraction and chunking happen inside this span, as the chunks are consumed
+        with telemetry.span("embed") as span:
+            chunk_texts, embeddings = self.embed_stream(texts())
+            span.set(chunks=len(chunk_texts))
+        telemetry.count("chunks", len(chunk_texts))
+        return self.index_embeddings(chunk_texts, embeddings, session_id, metadata, metric)
+
+    def index_embeddings(
+        self,
+        chunk_texts: List[str],
+        embeddings: np.ndarray,
+        session_id: str,
+        metadata: Optional[List[Tuple[int, int, int]]] = None,
+        metric: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Build the FAISS and BM25 indexes over already embedded chunks"""
+        with telemetry.span("index.build", rows=len(embeddings)):
+            # Row ids as FAISS labels keep them stable when a document is later removed
+            index, index_params = build_index(
+                embeddings,
+                INDEX_TYPE,
+                metric or INDEX_METRIC,
+                ids=np.arange(len(embeddings)),
+                compression=INDEX_COMPRESSION,
+                rerank=INDEX_RERANK,
+                rerank_factor=INDEX_RERANK_FACTOR,
+            )
+            bm25 = BM25Index.build(chunk_texts)
+
+        return {
+            'embeddings': stored_vectors(embeddings, index_params),
+            'chunks': chunk_texts,
+            'chunk_metadata': np.array(metadata, dtype=CHUNK_META_DTYPE) if metadata else None,
+            'bm25': bm25,
+            'faiss_index': index,
+            'index_params': index_params,
+            'session_id': session_id
+        }
+
     def generate_and_store_embeddings(self, chunks: List[str], session_id: str) -> str:
         """
         Generate embeddings for text chunks and store them in S3 with FAISS index
         """
         try:
-            # Generate embeddings
-            embeddings = self.embeddings_model.embed_documents(chunks)
-            
-            # Create FAISS index
-            dimension = len(embeddings[0])
-            index = faiss.IndexFlatL2(dimension)
-            index.add(np.array(embeddings, dtype=np.float32))
-            
-            # Package data
-            data_package = {
-                'embeddings': embeddings,
-                'chunks': chunks,
-                'faiss_index': index,
-                'session_id': session_id
-            }
-            
-            # Store in S3
+            data_package = self.build_embeddings(chunks, session_id)
             s3_key = self._store_in_s3(data_package, session_id)
             return s3_key
             
         except Exception as e:
             print(f"Error in generate_and_store_embeddings: {str(e)}")
             raise
-    
+
+    def store_embeddings_async(self, data_package: Dict[str, Any], session_id: str) -> Future:
+        """
+        Upload a data package in the background.
+        The future resolves to {"s3_key", "etag"} or raises the upload error.
+        """
+        return _UPLOAD_EXECUTOR.submit(self._upload_index, data_package, session_id)
+
+    def index_key(self, session_id: str) -> str:
+        """S3 key of the session's manifest, known before the upload finishes"""
+        return f"session_{session_id}/{INDEX_PREFIX}/{MANIFEST_FILE}"
+
+    def _local_index_dir(self, session_id: str) -> str:
+        return os.path.join(INDEX_CACHE_DIR, f"session_{session_id}")
+
+    def _publish_local(self, staging_dir: str, directory: str) -> str:
+        """
+        Move staged files into a local index directory.
+        os.replace keeps any mapping of the previous files valid; the manifest moves last.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in read_manifest(staging_dir)["files"] + [MANIFEST_FILE]:
+            os.replace(os.path.join(staging_dir, name), os.path.join(directory, name))
+        return directory
+
+    @telemetry.traced("s3.upload_index")
+    def _upload_index(self, data_package: Dict[str, Any], session_id: str) -> Dict[str, str]:
+        """Stream the serialized index files to S3 straight from memory, manifest last"""
+        try:
+            manifest, payloads = build_index_payloads(data_package)
+            prefix = f"session_{session_id}/{INDEX_PREFIX}"
+            for name in manifest["files"]:
+                self.s3_client.upload_fileobj(
+                    payloads[name], self.bucket_name, f"{prefix}/{name}", Config=aws.transfer_config()
+                )
+            response = self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=f"{prefix}/{MANIFEST_FILE}",
+                Body=payloads[MANIFEST_FILE].getvalue(),
+            )
+            return {"s3_key": f"{prefix}/{MANIFEST_FILE}", "etag": response.get("ETag"), "manifest": manifest}
+        except Exception as e:
+            print(f"Error uploading index for session {session_id}: {str(e)}")
+            raise
+
     def _store_in_s3(self, data_package: Dict[str, Any], session_id: str) -> str:
         """Store the data package in S3 using session-specific folder"""
-        filename = "document_embeddings.pkl"
-        temp_path = os.path.join(tempfile.gettempdir(), filename)
-        
-        with open(temp_path, "wb") as f:
-            pickle.dump(data_package, f)
-        
-        s3_key = f"session_{session_id}/{filename}"
-        self.s3_client.upload_file(temp_path, self.bucket_name, s3_key)
-        os.remove(temp_path)
-        return s3_key
-    
-    def load_embeddings(self, session_id: str) -> Dict[str, Any]:
-        """Load embeddings and FAISS index from S3"""
+        return self._upload_index(data_package, session_id)["s3_key"]
+
+    def get_index_etag(self, session_id: str) -> Optional[str]:
+        """ETag of the session's manifest in S3, or None if the session has no index yet"""
         try:
-            filename = "document_embeddings.pkl"
-            s3_key = f"session_{session_id}/{filename}"
-            temp_path = os.path.join(tempfile.gettempdir(), filename)
-            
-            self.s3_client.download_file(self.bucket_name, s3_key, temp_path)
-            
-            with open(temp_path, "rb") as f:
-                data = pickle.load(f)
-            os.remove(temp_path)
-            return data
+            response = self.s3_client.head_object(
+                Bucket=self.bucket_name,
+                Key=f"session_{session_id}/{INDEX_PREFIX}/{MANIFEST_FILE}",
+            )
+            return response.get("ETag")
+        except Exception as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    def has_index(self, session_id: str) -> bool:
+        """Whether the session has anything stored, in the current or the legacy format"""
+        if self.get_index_etag(session_id) is not None:
+            return True
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=f"session_{session_id}/{LEGACY_FILENAME}")
+            return True
+        except Exception as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+    @telemetry.traced("index.load")
+    def load_embeddings(self, session_id: str) -> SegmentedIndex:
+        """
+        Load a session's segments from S3. Segments never change once written,
+        so only those missing from the local index cache are downloaded.
+        """
+        try:
+            prefix = f"session_{session_id}/{INDEX_PREFIX}"
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(dir=INDEX_CACHE_DIR)
+            try:
+                try:
+                    # get_object rather than download_file: the ETag is what later writes expect
+                    response = self.s3_client.get_object(Bucket=self.bucket_name, Key=f"{prefix}/{MANIFEST_FILE}")
+                except Exception as e:
+                    if not _is_not_found(e):
+                        raise
+                    return self._migrate_legacy(session_id, staging_dir)
+                with open(os.path.join(staging_dir, MANIFEST_FILE), "wb") as f:
+                    f.write(response["Body"].read())
+                head = read_head(staging_dir)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+            if head["format_version"] == FORMAT_VERSION:
+                # A single index written before sessions held several documents
+                segment = self._load_segment(session_id, head.get("revision", "base"), "", head)
+                session_index = self._single_document_index(session_id, segment)
+            else:
+                segments = [
+                    self._load_segment(session_id, entry["id"], entry["prefix"], entry["manifest"])
+                    for entry in head["segments"]
+                ]
+                session_index = SegmentedIndex(
+                    session_id, segments, head["documents"], head.get("deleted", []), head.get("revision")
+                )
+            session_index.mark_committed(response.get("ETag"), session_index.revision)
+            return session_index
             
         except Exception as e:
             print(f"Error loading embeddings: {str(e)}")
             raise
-        #
\ No newline at end of file
+
+    def _load_segment(
+        self, session_id: str, segment_id: str, prefix: str, manifest: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        directory = os.path.join(self._local_index_dir(session_id), segment_id)
+        if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+            telemetry.count("index_segments_cached")
+        else:
+            telemetry.count("index_segments_downloaded")
+            key_prefix = "/".join(part for part in (f"session_{session_id}", INDEX_PREFIX, prefix) if part)
+            staging_dir = tempfile.mkdtemp(dir=INDEX_CACHE_DIR)
+            try:
+                with telemetry.span("s3.download_segment", files=len(manifest["files"])):
+                    for name in manifest["files"]:
+                        self.s3_client.download_file(
+                            self.bucket_name, f"{key_prefix}/{name}", os.path.join(staging_dir, name)
+                        )
+                with open(os.path.join(staging_dir, MANIFEST_FILE), "w") as f:
+                    json.dump(manifest, f)
+                self._publish_local(staging_dir, directory)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        return make_segment(open_index_files(directory), segment_id, prefix, manifest)
+
+    @staticmethod
+    def _single_document_index(session_id: str, segment: Dict[str, Any]) -> SegmentedIndex:
+        documents = {
+            session_id: {
+                "name": "document",
+                "sha256": None,
+                "segment": segment["segment_id"],
+                "start": 0,
+                "end": len(segment["chunks"]),
+            }
+        }
+        return SegmentedIndex(session_id, [segment], documents)
+
+    def _migrate_legacy(self, session_id: str, staging_dir: str) -> SegmentedIndex:
+        """Convert a pickled session from the original format and store it in the current one"""
+        legacy_path = os.path.join(staging_dir, LEGACY_FILENAME)
+        self.s3_client.download_file(
+            self.bucket_name, f"session_{session_id}/{LEGACY_FILENAME}", legacy_path
+        )
+        with open(legacy_path, "rb") as f:
+            data = pickle.load(f)
+        data["embeddings"] = np.asarray(data["embeddings"], dtype=np.float32)
+        data["index_params"] = dict(DEFAULT_INDEX_PARAMS)
+        data["bm25"] = BM25Index.build(data["chunks"])
+        uploaded = self._upload_index(data, session_id)
+        segment = make_segment(data, uploaded["manifest"]["revision"], "", uploaded["manifest"])
+        session_index = self._single_document_index(session_id, segment)
+        session_index.mark_committed(uploaded["etag"], session_index.revision)
+        return session_index
+
+    def add_document(
+        self,
+        chunks: Iterable[Union[str, Dict[str, Any]]],
+        session_id: str,
+        name: str,
+        session_index: Optional[SegmentedIndex] = None,
+        sha256: Optional[str] = None,
+        on_commit: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[SegmentedIndex, str, Future]:
+        """
+        Embed one document and add it to the session as a new segment; the other
+        documents are neither re-embedded nor re-uploaded. Returns the session index,
+        the new document's id and a future for the upload, which resolves like
+        store_embeddings_async. `on_commit` gets the manifest ETag after every write,
+        including any compaction the write triggers.
+        """
+        metric = session_index.metric if session_index and session_index.segments else None
+        data_package = self.build_embeddings(chunks, session_id, metric=metric)
+        return self.add_data_package(data_package, session_id, name, session_index, sha256, on_commit)
+
+    def add_data_package(
+        self,
+        data_package: Dict[str, Any],
+        session_id: str,
+        name: str,
+        session_index: Optional[SegmentedIndex] = None,
+        sha256: Optional[str] = None,
+        on_commit: Optional[Callable[[str], None]] = None,
+        before_commit: Optional[Callable[[], None]] = None,
+    ) -> Tuple[SegmentedIndex, str, Future]:
+        """
+        add_document for a document whose indexes are already built. `before_commit` runs
+        just before the manifest is written and can veto the write by raising; callers that
+        pass it compact the session themselves (compact), so no write happens unchecked.
+        """
+        if session_index is None:
+            session_index = SegmentedIndex(session_id, [], {})
+        document_id, segment = session_index.add_segment(data_package, name, sha256)
+        upload = _UPLOAD_EXECUTOR.submit(self._write_segment, session_index, segment, on_commit, before_commit)
+        return session_index, document_id, upload
+
+    def delete_document(
+        self,
+        session_index: SegmentedIndex,
+        document_id: str,
+        on_commit: Optional[Callable[[str], None]] = None,
+    ) -> Optional[Future]:
+        """Remove a document from the session; only the session manifest is rewritten"""
+        if not session_index.delete_document(document_id):
+            return None
+        return _UPLOAD_EXECUTOR.submit(self._write_manifest, session_index, on_commit, True)
+
+    @telemetry.traced("s3.upload_segment")
+    def _write_segment(
+        self,
+        session_index: SegmentedIndex,
+        segment: Dict[str, Any],
+        on_commit: Optional[Callable[[str], None]],
+        before_commit: Optional[Callable[[], None]] = None,
+    ) -> Dict[str, str]:
+        """Upload one segment's files, then a session manifest that includes it"""
+        session_id = session_index.session_id
+        try:
+            manifest, payloads = build_index_payloads(segment)
+            prefix = f"session_{session_id}/{INDEX_PREFIX}/{segment['prefix']}"
+            for name in manifest["files"]:
+                self.s3_client.upload_fileobj(
+                    payloads[name], self.bucket_name, f"{prefix}/{name}", Config=aws.transfer_config()
+                )
+            segment["manifest"] = manifest
+        except Exception as e:
+            print(f"Error uploading segment for session {session_id}: {str(e)}")
+            raise
+        try:
+            return self._write_manifest(session_index, on_commit, before_commit is None, before_commit)
+        except ManifestConflict:
+            # The manifest in S3 doesn't list the segment, so nothing else will clean it up
+            self._delete_segment_files(session_id, segment)
+            raise
+
+    def _write_manifest(
+        self,
+        session_index: SegmentedIndex,
+        on_commit: Optional[Callable[[str], None]],
+        compact: bool = False,
+        before_commit: Optional[Callable[[], None]] = None,
+    ) -> Dict[str, str]:
+        """
+        Write the session manifest, only if S3 still has the one the index expects: the lock
+        serializes writers in this process, the conditional put those in other processes.
+        Raises ManifestConflict if another writer got there first; reload and try again.
+        """
+        session_id = session_index.session_id
+        key = f"session_{session_id}/{INDEX_PREFIX}/{MANIFEST_FILE}"
+        with _session_write_lock(session_id), telemetry.span("s3.put_manifest"):
+            if before_commit:
+                before_commit()
+            manifest = session_index.manifest()
+            expected = session_index.expected_etag()
+            condition = {"IfMatch": expected} if expected else {"IfNoneMatch": "*"}
+            try:
+                response = self.s3_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Body=json.dumps(manifest).encode("utf-8"),
+                    **condition,
+                )
+            except Exception as e:
+                if _is_precondition_failed(e):
+                    telemetry.count("manifest_conflicts_total")
+                    raise ManifestConflict(f"Session {session_id} was changed by another writer") from e
+                raise
+            etag = response.get("ETag")
+            session_index.mark_committed(etag, manifest["revision"])
+        if on_commit:
+            on_commit(etag)
+        if compact and session_index.needs_compaction():
+            with session_index.lock:
+                start = not session_index.compacting
+                session_index.compacting = True
+            if start:
+                _UPLOAD_EXECUTOR.submit(self._compact, session_index, on_commit)
+        return {"s3_key": key, "etag": etag}
+
+    def compact(self, session_index: SegmentedIndex, before_commit: Optional[Callable[[], None]] = None) -> None:
+        """Compact the session on the calling thread, if it needs it and no compaction is running"""
+        with session_index.lock:
+            if session_index.compacting or not session_index.needs_compaction():
+                return
+            session_index.compacting = True
+        self._compact(session_index, None, before_commit)
+
+    @telemetry.traced("index.compact")
+    def _compact(
+        self,
+        session_index: SegmentedIndex,
+        on_commit: Optional[Callable[[str], None]],
+        before_commit: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Rewrite the live rows of every segment as one segment, rebuilding the FAISS
+        and BM25 indexes. Abandoned if the session changes while it runs.
+        """
+        session_id = session_index.session_id
+        try:
+            revision = session_index.revision
+            package, documents = session_index.live_package()
+            if package["embeddings"] is None:
+                return
+            index, index_params = build_index(
+                package["embeddings"],
+                INDEX_TYPE,
+                session_index.metric,
+                ids=np.arange(len(package["embeddings"])),
+                compression=INDEX_COMPRESSION,
+                rerank=INDEX_RERANK,
+                rerank_factor=INDEX_RERANK_FACTOR,
+            )
+            package.update(
+                embeddings=stored_vectors(package["embeddings"], index_params),
+                faiss_index=index,
+                index_params=index_params,
+                bm25=BM25Index.build(package["chunks"]),
+            )
+            segment = make_segment(package, writable=True)
+            manifest, payloads = build_index_payloads(segment)
+            prefix = f"session_{session_id}/{INDEX_PREFIX}"
+            for name in manifest["files"]:
+                self.s3_client.upload_fileobj(
+                    payloads[name], self.bucket_name, f"{prefix}/{segment['prefix']}/{name}",
+                    Config=aws.transfer_config(),
+                )
+            segment["manifest"] = manifest
+
+            with _session_write_lock(session_id):
+                replaced = session_index.replace_segments(segment, documents, revision)
+                if replaced is None:
+                    # A document was added or deleted meanwhile; the next write tries again
+                    self._delete_segment_files(session_id, segment)
+                    return
+                try:
+                    self._write_manifest(session_index, on_commit, before_commit=before_commit)
+                except ManifestConflict:
+                    self._delete_segment_files(session_id, segment)
+                    raise
+            for old in replaced:
+                self._delete_segment_files(session_id, old)
+        except Exception as e:
+            print(f"Error compacting session {session_id}: {str(e)}")
+            telemetry.count("errors_total", stage="index.compact")
+        finally:
+            session_index.compacting = False
+
+    def _delete_segment_files(self, session_id: str, segment: Dict[str, Any]) -> None:
+        if not segment.get("manifest"):
+            return
+        key_prefix = "/".join(
+            part for part in (f"session_{session_id}", INDEX_PREFIX, segment["prefix"]) if part
+        )
+        self.s3_client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={"Objects": [{"Key": f"{key_prefix}/{name}"} for name in segment["manifest"]["files"]]},
+        )
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings_manager() -> EmbeddingsManager:
+    """Single EmbeddingsManager, with its clients and embedding cache, shared by every browser session"""
+    return EmbeddingsManager()
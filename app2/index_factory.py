@@ -0,0 +1,283 @@
+# index_factory.py
+import math
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+import numpy as np
+
+if TYPE_CHECKING:
+    import faiss
+
+# faiss is imported where it is used, so importing this module (and the modules
+# built on it) doesn't load it until an index is built, searched or measured
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+METRICS = ("l2", "ip", "cosine")
+COMPRESSIONS = ("none", "fp16", "sq8", "pq")
+
+# faiss.ScalarQuantizer attribute of each scalar compression
+_SQ_TYPES = {
+    "fp16": "QT_fp16",
+    "sq8": "QT_8bit",
+}
+
+# Parameters describing indexes written before the factory existed
+DEFAULT_INDEX_PARAMS = {"index_type": "flat", "metric": "l2"}
+
+# FAISS wants roughly this many training points per IVF centroid / PQ code
+_MIN_POINTS_PER_CENTROID = 39
+_MAX_TRAINING_POINTS_PER_CENTROID = 256
+
+def choose_index_type(count: int) -> str:
+    """Default index type for a collection of `count` vectors"""
+    if count < 10_000:
+        return "flat"
+    if count < 100_000:
+        return "hnsw"
+    if count < 1_000_000:
+        return "ivf_flat"
+    return "ivf_pq"
+
+def _sq_type(compression: str) -> int:
+    import faiss
+    return getattr(faiss.ScalarQuantizer, _SQ_TYPES[compression])
+
+def _faiss_metric(metric: str) -> int:
+    import faiss
+    return faiss.METRIC_L2 if metric == "l2" else faiss.METRIC_INNER_PRODUCT
+
+def _prepare(vectors: np.ndarray, metric: str) -> np.ndarray:
+    """float32, C-contiguous and, for cosine, unit length (on a copy)"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if metric == "cosine":
+        import faiss
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def _training_sample(vectors: np.ndarray, centroids: int) -> np.ndarray:
+    limit = centroids * _MAX_TRAINING_POINTS_PER_CENTROID
+    if len(vectors) <= limit:
+        return vectors
+    rows = np.random.default_rng(0).choice(len(vectors), size=limit, replace=False)
+    return vectors[np.sort(rows)]
+
+def _default_nlist(count: int) -> int:
+    nlist = int(4 * math.sqrt(count))
+    return max(1, min(nlist, count // _MIN_POINTS_PER_CENTROID))
+
+def _default_pq_m(dimension: int, min_subdimension: int = 16) -> int:
+    """Largest divisor of the dimension that gives sub-vectors of at least `min_subdimension` dims"""
+    for m in range(max(1, dimension // min_subdimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def _cap_nbits(nbits: int, count: int) -> int:
+    """PQ code size no larger than `count` training points can fill"""
+    return max(1, min(nbits, int(math.log2(count))))
+
+def _train_pq(index: "faiss.Index", pq: "faiss.ProductQuantizer", vectors: np.ndarray, nbits: int) -> None:
+    # A session's few thousand chunks train usable codebooks; skip FAISS's too-few-points warning
+    pq.cp.min_points_per_centroid = 1
+    index.train(_training_sample(vectors, 2 ** nbits))
+
+def vector_dtype(params: Dict[str, Any]) -> type:
+    """
+    Dtype of the vectors stored next to an index. They stay float32 when they
+    re-rank a compressed index's candidates; otherwise they only feed MMR and
+    compaction, where float16 is plenty.
+    """
+    if params.get("compression", "none") != "none" and not params.get("rerank"):
+        return np.float16
+    return np.float32
+
+def stored_vectors(vectors: np.ndarray, params: Dict[str, Any]) -> np.ndarray:
+    return np.ascontiguousarray(vectors, dtype=vector_dtype(params))
+
+def code_bytes(index: "faiss.Index") -> int:
+    """Bytes of vector codes held by an index, leaving out graph links and id maps"""
+    import faiss
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if hasattr(index, "storage"):
+        index = faiss.downcast_index(index.storage)
+    return index.ntotal * int(getattr(index, "code_size", index.d * 4))
+
+def build_index(
+    vectors: np.ndarray,
+    index_type: str = "auto",
+    metric: str = "l2",
+    ids: Optional[np.ndarray] = None,
+    compression: str = "none",
+    **overrides: Any,
+) -> Tuple["faiss.Index", Dict[str, Any]]:
+    """
+    Build and fill a FAISS index. Returns the index and the parameters it was
+    built with, which are stored alongside it and needed again at query time.
+    With `ids`, search returns those labels and they stay stable under remove_ids.
+
+    `compression` stores the vectors inside flat, HNSW and IVF-flat indexes as
+    float16 or 8-bit scalar codes, or as PQ codes. A compressed index re-ranks
+    `rerank_factor` times the requested candidates at full precision when it is
+    searched with its stored vectors, unless built with rerank=False.
+    """
+    import faiss
+    if metric not in METRICS:
+        raise ValueError(f"Unknown index metric: {metric}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown index compression: {compression}")
+    count, dimension = vectors.shape
+    if index_type == "auto":
+        index_type = choose_index_type(count)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}")
+    if index_type == "ivf_pq" or (index_type == "ivf_flat" and compression == "pq"):
+        index_type, compression = "ivf_pq", "pq"
+    if compression == "pq" and count < 16:
+        # Too few vectors to train even a 4-bit codebook; IVF-PQ falls back to a flat index,
+        # whose 8-bit scalar codes need no codebook and IVF lists would be nearly empty anyway
+        compression = "sq8"
+        if index_type == "ivf_pq":
+            index_type = "flat"
+
+    vectors = _prepare(vectors, metric)
+    faiss_metric = _faiss_metric(metric)
+    params: Dict[str, Any] = {"index_type": index_type, "metric": metric}
+    if compression != "none":
+        params["compression"] = compression
+        params["rerank"] = bool(overrides.get("rerank", True))
+        params["rerank_factor"] = int(overrides.get("rerank_factor", 4))
+    if compression == "pq" and index_type != "ivf_pq":
+        # Without IVF the codes carry all of the accuracy: 4-dim sub-vectors, 8 bits each
+        # once there are enough vectors to fill the codebook
+        params["pq_m"] = int(overrides.get("pq_m", _default_pq_m(dimension, 4)))
+        params["pq_nbits"] = _cap_nbits(int(overrides.get("pq_nbits", 8 if count >= 256 else 4)), count)
+
+    if index_type == "flat":
+        if compression in _SQ_TYPES:
+            index = faiss.IndexScalarQuantizer(dimension, _sq_type(compression), faiss_metric)
+            index.train(vectors)
+        elif compression == "pq":
+            index = faiss.IndexPQ(dimension, params["pq_m"], params["pq_nbits"], faiss_metric)
+            _train_pq(index, index.pq, vectors, params["pq_nbits"])
+        else:
+            index = faiss.IndexFlatL2(dimension) if metric == "l2" else faiss.IndexFlatIP(dimension)
+
+    elif index_type == "hnsw":
+        params["hnsw_m"] = int(overrides.get("hnsw_m", 32))
+        params["ef_construction"] = int(overrides.get("ef_construction", 80))
+        params["ef_search"] = int(overrides.get("ef_search", 128))
+        if compression in _SQ_TYPES:
+            index = faiss.IndexHNSWSQ(dimension, _sq_type(compression), params["hnsw_m"], faiss_metric)
+            index.train(vectors)
+        elif compression == "pq":
+            index = faiss.IndexHNSWPQ(
+                dimension, params["pq_m"], params["hnsw_m"], params["pq_nbits"], faiss_metric
+            )
+            _train_pq(index, faiss.downcast_index(index.storage).pq, vectors, params["pq_nbits"])
+        else:
+            index = faiss.IndexHNSWFlat(dimension, params["hnsw_m"], faiss_metric)
+        index.hnsw.efConstruction = params["ef_construction"]
+        index.hnsw.efSearch = params["ef_search"]
+
+    else:
+        # Each centroid needs at least one training point
+        nlist = min(int(overrides.get("nlist", _default_nlist(count))), count)
+        params["nlist"] = nlist
+        params["nprobe"] = int(overrides.get("nprobe", max(1, nlist // 16)))
+        quantizer = faiss.IndexFlatL2(dimension) if metric == "l2" else faiss.IndexFlatIP(dimension)
+        if index_type == "ivf_flat" and compression in _SQ_TYPES:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, _sq_type(compression), faiss_metric
+            )
+            centroids = nlist
+        elif index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+            centroids = nlist
+        else:
+            params["pq_m"] = int(overrides.get("pq_m", _default_pq_m(dimension)))
+            # 8-bit codes need 256 * 39 points to train; shrink the codebook for small inputs
+            default_nbits = 8 if count >= 256 * _MIN_POINTS_PER_CENTROID else 4
+            params["pq_nbits"] = _cap_nbits(int(overrides.get("pq_nbits", default_nbits)), count)
+            index = faiss.IndexIVFPQ(
+                quantizer, dimension, nlist, params["pq_m"], params["pq_nbits"], faiss_metric
+            )
+            centroids = max(nlist, 2 ** params["pq_nbits"])
+        index.train(_training_sample(vectors, centroids))
+        index.nprobe = params["nprobe"]
+
+    if ids is None:
+        index.add(vectors)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        # Inverted lists store ids natively; IndexIDMap would renumber them on removal
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    else:
+        index = faiss.IndexIDMap(index)
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index, params
+
+def search(
+    index: "faiss.Index",
+    queries: np.ndarray,
+    k: int,
+    params: Optional[Dict[str, Any]] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    vectors: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search with per-query overrides of the index's nprobe / efSearch. Given the
+    index's full-precision `vectors` (rows matching its labels), a compressed
+    index built with rerank re-scores its candidates exactly.
+    """
+    params = params or DEFAULT_INDEX_PARAMS
+    metric = params.get("metric", "l2")
+    queries = _prepare(np.atleast_2d(queries), metric)
+    index_type = params.get("index_type", "flat")
+    rerank = vectors is not None and bool(params.get("rerank"))
+    fetch = max(k, min(index.ntotal, k * int(params.get("rerank_factor", 4)))) if rerank else k
+
+    search_params = None
+    if index_type in ("ivf_flat", "ivf_pq", "hnsw"):
+        import faiss
+    if index_type in ("ivf_flat", "ivf_pq"):
+        search_params = faiss.SearchParametersIVF(nprobe=int(nprobe or params.get("nprobe", 1)))
+    elif index_type == "hnsw":
+        search_params = faiss.SearchParametersHNSW(efSearch=int(ef_search or params.get("ef_search", 128)))
+
+    if search_params is None:
+        D, I = index.search(queries, fetch)
+    else:
+        D, I = index.search(queries, fetch, params=search_params)
+    if rerank:
+        return rerank_exact(queries, vectors, I, k, metric)
+    return D, I
+
+def rerank_exact(
+    queries: np.ndarray,
+    vectors: np.ndarray,
+    candidates: np.ndarray,
+    k: int,
+    metric: str,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Top k of each query's candidate labels by exact distance to `vectors[label]`; -1 pads"""
+    queries = _prepare(np.atleast_2d(queries), metric)
+    # FAISS pads missing results with the worst float32 distance
+    worst = np.finfo(np.float32).max if metric == "l2" else -np.finfo(np.float32).max
+    D = np.full((len(queries), k), worst, dtype=np.float32)
+    I = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, labels) in enumerate(zip(queries, candidates)):
+        labels = np.sort(labels[labels >= 0])
+        if not len(labels):
+            continue
+        # Only the candidate rows of a memory-mapped matrix are read
+        rows = _prepare(vectors[labels], metric)
+        if metric == "l2":
+            scores = ((rows - query) ** 2).sum(axis=1)
+            order = np.argsort(scores, kind="stable")[:k]
+        else:
+            scores = rows @ query
+            order = np.argsort(-scores, kind="stable")[:k]
+        D[row, :len(order)] = scores[order]
+        I[row, :len(order)] = labels[order]
+    return D, I
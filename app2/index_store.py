@@ -0,0 +1,164 @@
+# index_store.py
+import io
+import json
+import mmap
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+from index_factory import DEFAULT_INDEX_PARAMS, stored_vectors
+from chunking import CHUNK_META_DTYPE
+from retrieval import BM25Index
+
+FORMAT_VERSION = 2
+# Version of a session manifest that lists multiple FORMAT_VERSION indexes as segments
+SESSION_FORMAT_VERSION = 3
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.txt"
+OFFSETS_FILE = "chunks.idx.npy"
+CHUNK_META_FILE = "chunk_meta.npy"
+BM25_FILE = "bm25.npz"
+
+# Upload order matters: the manifest goes last so a reader never sees a partial index.
+# The manifest's "files" lists what a given index actually contains.
+DATA_FILES = [VECTORS_FILE, INDEX_FILE, CHUNKS_FILE, OFFSETS_FILE]
+
+def _read_index(path: str):
+    """Memory-map an index file, zero-copy for flat codes where the installed faiss supports it"""
+    import faiss
+    return faiss.read_index(path, getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP))
+
+class ChunkStore:
+    """Read-only list of chunk texts backed by a memory-mapped UTF-8 file and an offsets array"""
+
+    def __init__(self, chunks_path: str, offsets_path: str):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = open(chunks_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap refuses zero-length files
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self._data[start:end].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._data) + self.offsets.nbytes
+
+def _encode_chunks(chunks: Iterable[str]) -> Tuple[io.BytesIO, io.BytesIO]:
+    """Chunk texts back to back, plus the byte offset of each chunk boundary"""
+    text = io.BytesIO()
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + text.write(chunk.encode("utf-8")))
+    offsets_buffer = io.BytesIO()
+    np.save(offsets_buffer, np.asarray(offsets, dtype=np.uint64))
+    return text, offsets_buffer
+
+def build_index_payloads(data_package: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, io.BytesIO]]:
+    """Serialize a data package into in-memory files in the versioned format"""
+    vectors = stored_vectors(data_package["embeddings"], data_package.get("index_params", DEFAULT_INDEX_PARAMS))
+
+    vectors_buffer = io.BytesIO()
+    np.save(vectors_buffer, vectors)
+    import faiss
+    index_buffer = io.BytesIO()
+    faiss.write_index(data_package["faiss_index"], faiss.PyCallbackIOWriter(index_buffer.write))
+    chunks_buffer, offsets_buffer = _encode_chunks(data_package["chunks"])
+    files = list(DATA_FILES)
+    payloads = {
+        VECTORS_FILE: vectors_buffer,
+        INDEX_FILE: index_buffer,
+        CHUNKS_FILE: chunks_buffer,
+        OFFSETS_FILE: offsets_buffer,
+    }
+    chunk_metadata = data_package.get("chunk_metadata")
+    if chunk_metadata is not None:
+        meta_buffer = io.BytesIO()
+        np.save(meta_buffer, np.asarray(chunk_metadata, dtype=CHUNK_META_DTYPE))
+        payloads[CHUNK_META_FILE] = meta_buffer
+        files.append(CHUNK_META_FILE)
+    bm25 = data_package.get("bm25")
+    if bm25 is not None:
+        payloads[BM25_FILE] = bm25.to_bytes()
+        files.append(BM25_FILE)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "session_id": data_package.get("session_id"),
+        # Unique per write so the manifest's ETag changes whenever the index does
+        "revision": uuid.uuid4().hex,
+        "created_at": time.time(),
+        "count": int(vectors.shape[0]),
+        "dimension": int(vectors.shape[1]),
+        "index": data_package.get("index_params", DEFAULT_INDEX_PARAMS),
+        "files": files,
+    }
+    payloads[MANIFEST_FILE] = io.BytesIO(json.dumps(manifest).encode("utf-8"))
+    for buffer in payloads.values():
+        buffer.seek(0)
+    return manifest, payloads
+
+def read_head(directory: str) -> Dict[str, Any]:
+    """
+    The manifest at the root of a session's index: a single index in the format
+    above, or a segments.SegmentedIndex manifest listing several of them.
+    """
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") not in (FORMAT_VERSION, SESSION_FORMAT_VERSION):
+        raise ValueError(f"Unsupported index format version: {manifest.get('format_version')}")
+    return manifest
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format version: {manifest.get('format_version')}")
+    return manifest
+
+def open_index_files(directory: str) -> Dict[str, Any]:
+    """Open an on-disk index with vectors, FAISS index and chunks all memory-mapped"""
+    manifest = read_manifest(directory)
+    nbytes = sum(
+        os.path.getsize(os.path.join(directory, name)) for name in manifest["files"]
+    )
+    chunk_metadata = None
+    if CHUNK_META_FILE in manifest["files"]:
+        chunk_metadata = np.load(os.path.join(directory, CHUNK_META_FILE), mmap_mode="r")
+    # Indexes written before hybrid retrieval have no keyword index
+    bm25 = None
+    if BM25_FILE in manifest["files"]:
+        bm25 = BM25Index.load(os.path.join(directory, BM25_FILE))
+    return {
+        "embeddings": np.load(os.path.join(directory, VECTORS_FILE), mmap_mode="r"),
+        "chunks": ChunkStore(
+            os.path.join(directory, CHUNKS_FILE),
+            os.path.join(directory, OFFSETS_FILE),
+        ),
+        "chunk_metadata": chunk_metadata,
+        "bm25": bm25,
+        "faiss_index": _read_index(os.path.join(directory, INDEX_FILE)),
+        "index_params": manifest.get("index", DEFAULT_INDEX_PARAMS),
+        "session_id": manifest.get("session_id"),
+        "manifest": manifest,
+        "nbytes": nbytes,
+    }
@@ -0,0 +1,308 @@
+# ingest_worker.py
+"""
+Background ingestion of uploaded PDFs: extract -> chunk -> embed -> index -> store.
+
+The web app stores each upload in S3 and queues a job (job_queue.py); workers
+claim jobs and add the document to its session's index. Extract, chunk and embed
+save their output under the job's S3 checkpoint prefix, so a job picked up again
+after a worker dies resumes after the last finished stage. Index and store are
+rebuilt from the embeddings, and store skips documents the session already has.
+
+Workers run as threads in the web process (INGEST_LOCAL_WORKERS) or as separate
+processes on the same host, sharing the queue file:
+
+    python app2/ingest_worker.py --processes 4
+
+The queue is per host: each web host needs workers of its own. A worker renews its
+lease from a heartbeat thread while a job runs, and checks it still holds the lease
+before writing the session manifest, so a job handed to another worker is not
+stored twice. Manifest writes are conditional on the version the worker loaded; if
+the web app or another worker changed the session meanwhile, the worker reloads it
+and adds the document again.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import PyPDF2
+import streamlit as st
+import telemetry
+from chunking import chunk_pages
+from config import INGEST_LOCAL_WORKERS, INGEST_POLL_INTERVAL, TELEMETRY_PROMETHEUS_PORT
+from embeddings import EmbeddingsManager, ManifestConflict, get_embeddings_manager
+from job_queue import JobQueue, LeaseLost, get_job_queue
+from segments import SegmentedIndex
+from utils import iter_pdf_pages
+
+STAGES = ("extract", "chunk", "embed", "index", "store")
+# Each stage's share of a job's progress bar
+_STAGE_SPAN = {
+    "extract": (0.0, 0.2),
+    "chunk": (0.2, 0.25),
+    "embed": (0.25, 0.85),
+    "index": (0.85, 0.9),
+    "store": (0.9, 1.0),
+}
+# Minimum seconds between progress writes to the queue
+_PROGRESS_INTERVAL = 0.5
+# Times the store stage reloads the session after another writer changed it, before the job is retried
+_STORE_ATTEMPTS = 3
+
+class PermanentIngestError(Exception):
+    """The document can never be ingested as it is, so the job is failed without retries"""
+
+def source_key(session_id: str, sha256: str) -> str:
+    """S3 key of an uploaded PDF"""
+    return f"session_{session_id}/uploads/{sha256}.pdf"
+
+def submit_upload(
+    job_queue: JobQueue,
+    embeddings_manager: EmbeddingsManager,
+    session_id: str,
+    name: str,
+    data: bytes,
+    sha256: str,
+) -> str:
+    """Store an uploaded PDF in S3 and queue it for ingestion; returns the job id"""
+    key = source_key(session_id, sha256)
+    embeddings_manager.s3_client.put_object(Bucket=embeddings_manager.bucket_name, Key=key, Body=data)
+    return job_queue.submit(session_id, name, sha256, key)
+
+class IngestWorker:
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        embeddings_manager: EmbeddingsManager,
+        worker_id: Optional[str] = None,
+        poll_interval: float = INGEST_POLL_INTERVAL,
+    ):
+        self.job_queue = job_queue
+        self.embeddings_manager = embeddings_manager
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.poll_interval = poll_interval
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        """Process jobs until `stop` is set"""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                if not self.run_once():
+                    stop.wait(self.poll_interval)
+            except Exception as e:
+                print(f"Error in ingest worker {self.worker_id}: {str(e)}")
+                stop.wait(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """Claim and process one job; False if the queue had nothing to run"""
+        job = self.job_queue.claim(self.worker_id)
+        if job is None:
+            return False
+        stop_heartbeat = threading.Event()
+        threading.Thread(
+            target=self._heartbeat, args=(job, stop_heartbeat), name=f"{self.worker_id}-lease", daemon=True
+        ).start()
+        try:
+            with telemetry.request("ingest", document=job["name"]):
+                result = self.process(job)
+            stop_heartbeat.set()
+            self.job_queue.complete(job["id"], self.worker_id, result)
+            self._delete_checkpoints(job)
+        except LeaseLost:
+            print(f"Ingest job {job['id']} was handed to another worker; abandoning it")
+        except Exception as e:
+            print(f"Error ingesting {job['name']} (job {job['id']}): {str(e)}")
+            # A PDF without text or that cannot be parsed fails the same way every time;
+            # anything else, throttling included, may succeed on another attempt
+            retry = not isinstance(e, (PermanentIngestError, PyPDF2.errors.PdfReadError))
+            try:
+                self.job_queue.fail(job["id"], self.worker_id, str(e), retry=retry)
+            except LeaseLost:
+                pass
+        finally:
+            stop_heartbeat.set()
+        return True
+
+    def _heartbeat(self, job: Dict[str, Any], stop: threading.Event) -> None:
+        """Renew the job's lease while it runs, so long stages aren't mistaken for a dead worker"""
+        while not stop.wait(self.job_queue.lease_seconds / 3):
+            try:
+                self.job_queue.renew(job["id"], self.worker_id)
+            except LeaseLost:
+                return
+            except Exception as e:
+                print(f"Error renewing lease of ingest job {job['id']}: {str(e)}")
+
+    def _check_lease(self, job: Dict[str, Any]) -> None:
+        """Called before the session manifest is written: only the job's current worker may add it"""
+        self.job_queue.renew(job["id"], self.worker_id)
+
+    def _start_stage(self, job: Dict[str, Any], stage: str) -> Callable[[float], None]:
+        """Record that a stage has begun; returns its progress callback, taking the fraction done"""
+        start, end = _STAGE_SPAN[stage]
+        last = [0.0]
+
+        def report(fraction: float) -> None:
+            now = time.monotonic()
+            if now - last[0] >= _PROGRESS_INTERVAL:
+                last[0] = now
+                progress = start + (end - start) * min(1.0, fraction)
+                self.job_queue.progress(job["id"], self.worker_id, stage, progress)
+        report(0.0)
+        return report
+
+    def _checkpoint_key(self, job: Dict[str, Any], name: str) -> str:
+        return f"session_{job['session_id']}/ingest/{job['id']}/{name}"
+
+    def _save_checkpoint(self, job: Dict[str, Any], stage: str, name: str, body: bytes) -> None:
+        manager = self.embeddings_manager
+        manager.s3_client.put_object(Bucket=manager.bucket_name, Key=self._checkpoint_key(job, name), Body=body)
+        self.job_queue.progress(job["id"], self.worker_id, stage, _STAGE_SPAN[stage][1], checkpoint=stage)
+
+    def _load_checkpoint(self, job: Dict[str, Any], name: str) -> bytes:
+        manager = self.embeddings_manager
+        response = manager.s3_client.get_object(Bucket=manager.bucket_name, Key=self._checkpoint_key(job, name))
+        return response["Body"].read()
+
+    def _delete_checkpoints(self, job: Dict[str, Any]) -> None:
+        manager = self.embeddings_manager
+        try:
+            manager.s3_client.delete_objects(
+                Bucket=manager.bucket_name,
+                Delete={"Objects": [
+                    {"Key": self._checkpoint_key(job, name)}
+                    for name in ("pages.json", "chunks.json", "embeddings.npy")
+                ]},
+            )
+        except Exception as e:
+            print(f"Error deleting checkpoints of ingest job {job['id']}: {str(e)}")
+
+    def _extract(self, job: Dict[str, Any]) -> List[Tuple[int, str]]:
+        manager = self.embeddings_manager
+        data = manager.s3_client.get_object(Bucket=manager.bucket_name, Key=job["source_key"])["Body"].read()
+        page_count = len(PyPDF2.PdfReader(io.BytesIO(data)).pages)
+        report = self._start_stage(job, "extract")
+        pages = []
+        with telemetry.span("extract", pages=page_count):
+            for page in iter_pdf_pages(io.BytesIO(data)):
+                pages.append(page)
+                report(len(pages) / max(1, page_count))
+        return pages
+
+    def _load_session(self, session_id: str) -> SegmentedIndex:
+        manager = self.embeddings_manager
+        if not manager.has_index(session_id):
+            return SegmentedIndex(session_id, [], {})
+        return manager.load_embeddings(session_id)
+
+    def process(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Run the stages after the job's checkpoint; returns the job result"""
+        manager = self.embeddings_manager
+        done = STAGES.index(job["checkpoint"]) + 1 if job["checkpoint"] else 0
+        pages = chunks = embeddings = None
+
+        if done < 1:
+            pages = self._extract(job)
+            self._save_checkpoint(job, "extract", "pages.json", json.dumps(pages).encode("utf-8"))
+
+        if done < 2:
+            if pages is None:
+                pages = [tuple(page) for page in json.loads(self._load_checkpoint(job, "pages.json"))]
+            self._start_stage(job, "chunk")
+            with telemetry.span("chunk"):
+                chunks = list(chunk_pages(pages))
+            if not chunks:
+                raise PermanentIngestError("No text found in the PDF")
+            self._save_checkpoint(job, "chunk", "chunks.json", json.dumps(chunks).encode("utf-8"))
+        if chunks is None:
+            chunks = json.loads(self._load_checkpoint(job, "chunks.json"))
+        texts = [chunk["text"] for chunk in chunks]
+        metadata = [(chunk["page"], chunk["start"], chunk["end"]) for chunk in chunks]
+
+        if done < 3:
+            report = self._start_stage(job, "embed")
+            with telemetry.span("embed", chunks=len(texts)):
+                _, embeddings = manager.embed_stream(
+                    texts, on_progress=lambda embedded, total: report(embedded / max(1, total))
+                )
+            buffer = io.BytesIO()
+            np.save(buffer, embeddings)
+            self._save_checkpoint(job, "embed", "embeddings.npy", buffer.getvalue())
+        if embeddings is None:
+            embeddings = np.load(io.BytesIO(self._load_checkpoint(job, "embeddings.npy")))
+
+        for attempt in range(_STORE_ATTEMPTS):
+            self._start_stage(job, "index")
+            session_index = self._load_session(job["session_id"])
+            existing = session_index.find_document(job["sha256"])
+            if existing:
+                # An earlier attempt stored the document before its worker died
+                return {"document_id": existing, "chunks": len(texts)}
+            metric = session_index.metric if session_index.segments else None
+            data_package = manager.index_embeddings(texts, embeddings, job["session_id"], metadata, metric)
+            if metric and data_package["index_params"].get("metric") != metric:
+                raise PermanentIngestError(f"Index metric does not match the session's ({metric})")
+
+            self._start_stage(job, "store")
+            _, document_id, upload = manager.add_data_package(
+                data_package, job["session_id"], job["name"], session_index, sha256=job["sha256"],
+                before_commit=lambda: self._check_lease(job),
+            )
+            try:
+                committed = upload.result()
+                break
+            except ManifestConflict:
+                if attempt + 1 == _STORE_ATTEMPTS:
+                    raise
+                print(f"Session {job['session_id']} changed while storing {job['name']}; reloading it")
+        # Still under this job's lease, so the compacted manifest can't overwrite another worker's
+        manager.compact(session_index, before_commit=lambda: self._check_lease(job))
+        return {"document_id": document_id, "etag": committed["etag"], "chunks": len(texts)}
+
+@st.cache_resource(show_spinner=False)
+def start_local_workers(count: int = INGEST_LOCAL_WORKERS) -> List[threading.Thread]:
+    """Worker threads inside the web process, started once per process"""
+    threads = []
+    for i in range(count):
+        worker = IngestWorker(get_job_queue(), get_embeddings_manager())
+        thread = threading.Thread(target=worker.run, name=f"ingest-worker-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def _run_process(poll_interval: float, number: int = 0) -> None:
+    # The web process serves metrics on TELEMETRY_PROMETHEUS_PORT; worker processes on the ports after it
+    telemetry.start(prometheus_port=TELEMETRY_PROMETHEUS_PORT + 1 + number)
+    worker = IngestWorker(JobQueue(), EmbeddingsManager(), poll_interval=poll_interval)
+    print(f"Ingest worker {worker.worker_id} polling {worker.job_queue.path}")
+    worker.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--poll-interval", type=float, default=INGEST_POLL_INTERVAL)
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        _run_process(args.poll_interval)
+    else:
+        # Not daemonic: large PDFs are extracted on a process pool of their own
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_run_process, args=(args.poll_interval, i), name=f"ingest-worker-{i}")
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
@@ -0,0 +1,196 @@
+# job_queue.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+import streamlit as st
+from config import INGEST_QUEUE_PATH, INGEST_LEASE_SECONDS, INGEST_MAX_ATTEMPTS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class LeaseLost(Exception):
+    """The job was reclaimed by another worker after this worker's lease expired"""
+
+class JobQueue:
+    """
+    Ingestion jobs in a SQLite file shared by the web and worker processes on a host.
+    Workers claim jobs under a lease that every progress update and a heartbeat renew;
+    a job whose lease runs out (the worker died) is handed to the next worker, which resumes
+    from the job's last checkpoint. Only one job per session runs at a time, since
+    each one rewrites the session's manifest.
+    """
+
+    def __init__(
+        self,
+        path: str = INGEST_QUEUE_PATH,
+        lease_seconds: float = INGEST_LEASE_SECONDS,
+        max_attempts: int = INGEST_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit; claims open their own IMMEDIATE transaction
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, session_id TEXT NOT NULL, name TEXT NOT NULL, "
+            "sha256 TEXT NOT NULL, source_key TEXT NOT NULL, status TEXT NOT NULL, "
+            "stage TEXT, checkpoint TEXT, progress REAL NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, result TEXT, "
+            "worker TEXT, lease_expires REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, created_at)")
+
+    @staticmethod
+    def _to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(self, session_id: str, name: str, sha256: str, source_key: str) -> str:
+        """
+        Queue a document for ingestion and return the job id. A document already
+        queued or running for the session returns the existing job; one ingested
+        earlier is queued again, since it may have been deleted from the session since.
+        """
+        now = time.time()
+        with self._lock:
+            existing = self._conn.execute(
+                "SELECT id FROM jobs WHERE session_id = ? AND sha256 = ? AND status IN (?, ?)",
+                (session_id, sha256, QUEUED, RUNNING),
+            ).fetchone()
+            if existing:
+                return existing["id"]
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, session_id, name, sha256, source_key, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, name, sha256, source_key, QUEUED, now, now),
+            )
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Lease the oldest runnable job to this worker, or None if there is nothing to do"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    row = self._conn.execute(
+                        "SELECT * FROM jobs AS j WHERE "
+                        "(j.status = ? OR (j.status = ? AND j.lease_expires < ?)) "
+                        "AND NOT EXISTS (SELECT 1 FROM jobs AS r WHERE r.session_id = j.session_id "
+                        "AND r.id != j.id AND r.status = ? AND r.lease_expires >= ?) "
+                        "ORDER BY j.created_at LIMIT 1",
+                        (QUEUED, RUNNING, now, RUNNING, now),
+                    ).fetchone()
+                    if row is None:
+                        self._conn.execute("COMMIT")
+                        return None
+                    if row["attempts"] >= self.max_attempts:
+                        # Its workers keep dying on it; stop handing it out
+                        self._conn.execute(
+                            "UPDATE jobs SET status = ?, error = ?, worker = NULL, updated_at = ? WHERE id = ?",
+                            (FAILED, row["error"] or "Worker stopped responding", now, row["id"]),
+                        )
+                        continue
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, "
+                        "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (RUNNING, worker_id, now + self.lease_seconds, now, row["id"]),
+                    )
+                    self._conn.execute("COMMIT")
+                    job = self._to_dict(row)
+                    job.update(status=RUNNING, worker=worker_id, attempts=row["attempts"] + 1)
+                    return job
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _update_owned(self, job_id: str, worker_id: str, assignments: str, values: tuple) -> None:
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                values + (time.time(), job_id, worker_id, RUNNING),
+            )
+        if cursor.rowcount == 0:
+            raise LeaseLost(job_id)
+
+    def progress(
+        self,
+        job_id: str,
+        worker_id: str,
+        stage: str,
+        progress: float,
+        checkpoint: Optional[str] = None,
+    ) -> None:
+        """Record progress (0-1) and, once a stage's output is saved, its checkpoint; renews the lease"""
+        self._update_owned(
+            job_id,
+            worker_id,
+            "stage = ?, progress = ?, checkpoint = COALESCE(?, checkpoint), lease_expires = ?",
+            (stage, progress, checkpoint, time.time() + self.lease_seconds),
+        )
+
+    def renew(self, job_id: str, worker_id: str) -> None:
+        """Extend the worker's lease on a running job; raises LeaseLost if it is no longer the worker's"""
+        self._update_owned(job_id, worker_id, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> None:
+        self._update_owned(
+            job_id,
+            worker_id,
+            "status = ?, progress = 1, result = ?, error = NULL, worker = NULL, lease_expires = NULL",
+            (DONE, json.dumps(result)),
+        )
+
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = True) -> None:
+        """Put the job back in the queue, or mark it failed once it is out of attempts"""
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        status = QUEUED if retry and row is not None and row["attempts"] < self.max_attempts else FAILED
+        self._update_owned(
+            job_id, worker_id, "status = ?, error = ?, worker = NULL, lease_expires = NULL", (status, error)
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def session_jobs(self, session_id: str) -> List[Dict[str, Any]]:
+        """All jobs of a session, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE session_id = ? ORDER BY created_at", (session_id,)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue() -> JobQueue:
+    """Single connection to the job queue shared by every browser session in this process"""
+    return JobQueue()
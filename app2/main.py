@@ -1,36 +1,65 @@
+import time
+_SCRIPT_STARTED = time.perf_counter()
 import streamlit as st
+import hashlib
 import uuid
-from utils import read_pdf, split_text
-from embeddings import EmbeddingsManager
+import aws
+import telemetry
+from utils import iter_pdf_pages
+from chunking import chunk_pages
+from embeddings import ManifestConflict, get_embeddings_manager
 from chat_interface import ChatInterface
-from chat_history import ChatHistoryManager
+from chat_history import get_chat_history_manager
+from session_cache import get_session_cache
+from response_cache import get_response_cache
+from persistence import get_write_behind_queue
+from segments import SegmentedIndex
+from job_queue import get_job_queue, DONE, FAILED, QUEUED, RUNNING
+from ingest_worker import start_local_workers, submit_upload
+from config import TELEMETRY_DEBUG_PANEL, INGEST_MODE, INGEST_STATUS_REFRESH
 from datetime import datetime
-import time
-from typing import Optional
+from typing import Any, Dict, Optional
+
+# Only the first run of the script in a process imports anything; reruns find the modules loaded
+_IMPORT_SECONDS = time.perf_counter() - _SCRIPT_STARTED
+
+SESSIONS_PAGE_SIZE = 10
 
 def initialize_session() -> None:
     """Initialize session state variables with error handling"""
     try:
         if "initialization_complete" not in st.session_state:
             st.session_state.session_id = str(uuid.uuid4())
-            st.session_state.embeddings_manager = EmbeddingsManager()
             st.session_state.chat_interface = None
-            st.session_state.chat_history_manager = ChatHistoryManager()
             st.session_state.current_s3_key = None
+            st.session_state.pending_uploads = []
+            st.session_state.processed_uploads = set()
+            st.session_state.uploader_key = 0
+            st.session_state.ingest_jobs = []
             st.session_state.messages = []
+            # How many of the messages have been handed to the write-behind queue
+            st.session_state.saved_messages = 0
             st.session_state.error_message = None
             st.session_state.initialization_complete = True
     except Exception as e:
         st.error(f"Failed to initialize session: {str(e)}")
         st.session_state.error_message = "Session initialization failed"
 
+def create_chat_interface(embeddings_data: Dict[str, Any], session_id: str) -> ChatInterface:
+    """Chat interface over a session's index, embedding queries with this session's model"""
+    return ChatInterface(
+        embeddings_data,
+        embeddings_model=get_embeddings_manager().embeddings_model,
+        document_id=session_id,
+    )
+
 def load_chat_session(session_id: str) -> bool:
     """Load a previous chat session with validation and error handling"""
     try:
         if not session_id:
             raise ValueError("Invalid session ID")
 
-        history = st.session_state.chat_history_manager.get_chat_history(session_id)
+        history = get_chat_history_manager().get_chat_history(session_id)
         if not history:
             st.warning("Chat history not found")
             return False
@@ -41,13 +70,21 @@ def load_chat_session(session_id: str) -> bool:
             raise ValueError("Invalid chat history format")
 
         # Load embeddings with error handling
-        embeddings_data = st.session_state.embeddings_manager.load_embeddings(session_id)
+        embeddings_data = get_session_cache().get_or_load(
+            session_id, get_embeddings_manager()
+        )
         if not embeddings_data:
             raise ValueError("Failed to load embeddings")
 
         # Update session state
         st.session_state.messages = history.get('messages', [])
-        st.session_state.chat_interface = ChatInterface(embeddings_data)
+        st.session_state.saved_messages = history.get('stored_messages', 0)
+        st.session_state.chat_interface = create_chat_interface(embeddings_data, session_id)
+        if st.session_state.session_id != session_id:
+            # Uploads seen in the previous session have not been added to this one,
+            # and a fresh uploader key stops its files being added on the next rerun
+            st.session_state.processed_uploads = set()
+            st.session_state.uploader_key += 1
         st.session_state.session_id = session_id
         st.session_state.current_s3_key = history.get('s3_key')
         return True
@@ -56,8 +93,8 @@ def load_chat_session(session_id: str) -> bool:
         st.error(f"Error loading chat session: {str(e)}")
         return False
 
-def handle_file_upload(uploaded_file) -> Optional[str]:
-    """Handle PDF file upload with validation and error handling"""
+def handle_file_upload(uploaded_file) -> Optional[SegmentedIndex]:
+    """Add an uploaded PDF to the current session as a new document"""
     try:
         if not uploaded_file:
             return None
@@ -67,31 +104,214 @@ def handle_file_upload(uploaded_file) -> Optional[str]:
             st.error("File size exceeds 10MB limit")
             return None
 
-        # Process PDF
-        pdf_text = read_pdf(uploaded_file)
-        if not pdf_text:
-            st.error("Failed to extract text from PDF")
+        # The uploader returns the same files on every rerun; add each one once
+        digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        if digest in st.session_state.processed_uploads:
+            return None
+        session_id = st.session_state.session_id
+        chat_interface = st.session_state.chat_interface
+        session_index = chat_interface.index if chat_interface else SegmentedIndex(session_id, [], {})
+        if session_index.find_document(digest):
+            st.session_state.processed_uploads.add(digest)
             return None
 
-        chunks = split_text(pdf_text)
-        if not chunks:
-            st.error("Failed to process PDF content")
+        if INGEST_MODE == "queue":
+            # Workers process the document; show_ingest_progress follows the job
+            job_id = submit_upload(
+                get_job_queue(),
+                get_embeddings_manager(),
+                session_id,
+                uploaded_file.name,
+                uploaded_file.getvalue(),
+                digest,
+            )
+            if job_id not in st.session_state.ingest_jobs:
+                st.session_state.ingest_jobs.append(job_id)
+            st.session_state.processed_uploads.add(digest)
             return None
 
-        # Generate and store embeddings
-        s3_key = st.session_state.embeddings_manager.generate_and_store_embeddings(
-            chunks, st.session_state.session_id
+        # Stream pages into chunks; embedding starts while later pages are still being extracted
+        chunks = chunk_pages(iter_pdf_pages(uploaded_file))
+        # The cached index is shared with other browser sessions; change a copy
+        session_index = session_index.copy()
+
+        session_cache = get_session_cache()
+
+        def cache_session_index(etag: str) -> None:
+            # Runs on the upload thread; later loads of this session become cache hits
+            session_cache.put(session_id, session_index, etag)
+
+        # Only the new document is embedded and uploaded, as a segment of the session's index
+        session_index, _, upload = get_embeddings_manager().add_document(
+            chunks,
+            session_id,
+            uploaded_file.name,
+            session_index,
+            sha256=digest,
+            on_commit=cache_session_index,
         )
-        return s3_key
+        st.session_state.pending_uploads.append(upload)
+        st.session_state.processed_uploads.add(digest)
+        # Cached answers predate the new document
+        get_response_cache().invalidate(session_id)
+        return session_index
 
     except Exception as e:
         st.error(f"Error processing PDF: {str(e)}")
         return None
 
+def delete_document(document_id: str) -> None:
+    """Remove a document from the current session's index"""
+    try:
+        session_id = st.session_state.session_id
+        # The cached index is shared with other browser sessions; change a copy
+        session_index = st.session_state.chat_interface.index.copy()
+        session_cache = get_session_cache()
+
+        def cache_session_index(etag: str) -> None:
+            session_cache.put(session_id, session_index, etag)
+
+        upload = get_embeddings_manager().delete_document(
+            session_index, document_id, on_commit=cache_session_index
+        )
+        if upload:
+            st.session_state.chat_interface.set_index(session_index)
+            st.session_state.pending_uploads.append(upload)
+        get_response_cache().invalidate(session_id)
+    except Exception as e:
+        st.error(f"Error removing document: {str(e)}")
+
+@st.cache_resource(show_spinner=False)
+def get_startup_report() -> Dict[str, Any]:
+    """Cold-start timings of this process, filled in by the first run of the script"""
+    return {"imports": _IMPORT_SECONDS, "script_started": _SCRIPT_STARTED, "first_run": None}
+
+def report_startup() -> None:
+    """Log how long the process took to import and render its first page, once per process"""
+    report = get_startup_report()
+    if report["first_run"] is not None:
+        return
+    report["first_run"] = time.perf_counter() - report["script_started"]
+    report["clients"] = aws.creation_seconds()
+    clients = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in report["clients"].items())
+    print(
+        f"Startup: imports {report['imports']:.2f}s, first page {report['first_run']:.2f}s"
+        f"{', clients: ' + clients if clients else ''}"
+    )
+
+def remember_trace(request) -> None:
+    """Keep the stage breakdown of the latest upload or question for the debug panel"""
+    if request.trace is not None:
+        st.session_state.last_trace = request.trace
+
+def render_debug_panel() -> None:
+    """Per-stage timings and counters of the latest traced request"""
+    trace = st.session_state.get("last_trace")
+    with st.expander("Debug: last request"):
+        if trace is None:
+            st.caption("No request traced yet")
+            return
+        st.caption(f"{trace.name}: {trace.duration * 1000:.0f} ms")
+        rows = []
+        for span in trace.breakdown():
+            details = {
+                k: v for k, v in span.items()
+                if k not in ("stage", "depth", "offset_ms", "duration_ms", "error")
+            }
+            rows.append({
+                "stage": "\u2003" * span["depth"] + span["stage"],
+                "start ms": round(span["offset_ms"], 1),
+                "ms": round(span["duration_ms"], 1),
+                "details": ", ".join(f"{k}={v}" for k, v in details.items()),
+                "error": span["error"] or "",
+            })
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        if trace.counters:
+            st.json(trace.counters)
+
+def refresh_session_index() -> None:
+    """Pick up the documents ingestion workers have added to the current session"""
+    session_id = st.session_state.session_id
+    session_index = get_session_cache().get_or_load(session_id, get_embeddings_manager())
+    st.session_state.current_s3_key = get_embeddings_manager().index_key(session_id)
+    chat_interface = st.session_state.chat_interface
+    if chat_interface is None:
+        st.session_state.chat_interface = create_chat_interface(session_index, session_id)
+        st.session_state.messages = []
+        st.session_state.saved_messages = 0
+    else:
+        chat_interface.set_index(session_index)
+    # Cached answers predate the new documents
+    get_response_cache().invalidate(session_id)
+
+def report_ingest_jobs() -> None:
+    """Apply this session's finished ingestion jobs and report failed ones"""
+    pending = []
+    refresh = False
+    for job_id in st.session_state.get("ingest_jobs", []):
+        job = get_job_queue().get(job_id)
+        if job is None or job["session_id"] != st.session_state.session_id:
+            continue
+        if job["status"] == DONE:
+            refresh = True
+            st.success(f"Added {job['name']}")
+        elif job["status"] == FAILED:
+            st.error(f"Error processing {job['name']}: {job['error']}")
+        else:
+            pending.append(job_id)
+    st.session_state.ingest_jobs = pending
+    if refresh:
+        try:
+            refresh_session_index()
+        except Exception as e:
+            st.error(f"Error loading new documents: {str(e)}")
+
+@st.fragment(run_every=INGEST_STATUS_REFRESH)
+def show_ingest_progress() -> None:
+    """Progress of queued uploads, polled until one finishes and the whole page reruns"""
+    finished = False
+    for job_id in st.session_state.ingest_jobs:
+        job = get_job_queue().get(job_id)
+        if job is None or job["status"] not in (QUEUED, RUNNING):
+            finished = True
+            continue
+        stage = job["stage"] if job["status"] == RUNNING and job["stage"] else "waiting"
+        st.progress(job["progress"], text=f"{job['name']}: {stage}")
+    if finished:
+        st.rerun()
+
+def report_pending_upload() -> None:
+    """Surface the outcome of background index uploads once they have finished"""
+    pending = []
+    conflict = False
+    for upload in st.session_state.get("pending_uploads", []):
+        if not upload.done():
+            pending.append(upload)
+            continue
+        error = upload.exception()
+        if isinstance(error, ManifestConflict):
+            conflict = True
+        elif error:
+            st.error(f"Failed to save document to S3: {str(error)}")
+        else:
+            st.toast("Document saved to S3")
+    st.session_state.pending_uploads = pending
+    if conflict:
+        st.warning("This session was changed elsewhere while saving; reloaded it, so check your last change")
+        # Files still in the uploader are added again unless the reloaded session has them
+        st.session_state.processed_uploads = set()
+        try:
+            refresh_session_index()
+        except Exception as e:
+            st.error(f"Error reloading the session: {str(e)}")
+
 def main():
     try:
         st.set_page_config(page_title="PDF Chat Assistant", layout="wide")
         st.title("AI-Powered PDF Chat Assistant")
+        telemetry.start()
+        if INGEST_MODE == "queue":
+            start_local_workers()
         
         initialize_session()
         
@@ -103,30 +323,86 @@ def main():
         # Sidebar
         with st.sidebar:
             st.header("Upload PDF Document")
-            uploaded_pdf = st.file_uploader("Select a PDF file", type=["pdf"])
+            uploaded_pdfs = st.file_uploader(
+                "Select PDF files", type=["pdf"], accept_multiple_files=True,
+                key=f"uploader_{st.session_state.uploader_key}"
+            )
+            
+            report_pending_upload()
+            report_ingest_jobs()
             
-            if uploaded_pdf:
-                with st.spinner("Processing PDF..."):
-                    s3_key = handle_file_upload(uploaded_pdf)
-                    if s3_key:
-                        st.session_state.current_s3_key = s3_key
-                        embeddings_data = st.session_state.embeddings_manager.load_embeddings(
-                            st.session_state.session_id
+            for uploaded_pdf in uploaded_pdfs or []:
+                with st.spinner(f"Processing {uploaded_pdf.name}..."):
+                    with telemetry.request("upload", document=uploaded_pdf.name) as request:
+                        session_index = handle_file_upload(uploaded_pdf)
+                if session_index:
+                    remember_trace(request)
+                    st.session_state.current_s3_key = get_embeddings_manager().index_key(
+                        st.session_state.session_id
+                    )
+                    chat_interface = st.session_state.chat_interface
+                    if chat_interface is None:
+                        st.session_state.chat_interface = create_chat_interface(
+                            session_index, st.session_state.session_id
                         )
-                        st.session_state.chat_interface = ChatInterface(embeddings_data)
                         st.session_state.messages = []
-                        st.success("PDF processed successfully!")
+                        st.session_state.saved_messages = 0
+                    else:
+                        chat_interface.set_index(session_index)
+                    st.success(f"Added {uploaded_pdf.name}")
+            
+            if st.session_state.ingest_jobs:
+                show_ingest_progress()
+            
+            # Documents in the current session
+            if st.session_state.chat_interface:
+                st.header("Documents")
+                for document_id, document in st.session_state.chat_interface.index.live_documents():
+                    name_col, delete_col = st.columns([4, 1])
+                    name_col.write(document["name"])
+                    if delete_col.button("🗑", key=f"delete_{document_id}", help="Remove this document"):
+                        delete_document(document_id)
+                        st.rerun()
+            
+            # Answer cache
+            st.checkbox(
+                "Reuse cached answers",
+                value=True,
+                key="use_response_cache",
+                help="Answer near-identical questions about the same document without calling the LLM"
+            )
+            cache_stats = get_response_cache().stats()
+            st.caption(
+                f"Answer cache: {cache_stats['hits']} hits "
+                f"({cache_stats['hit_rate']:.0%}), {cache_stats['seconds_saved']:.1f}s saved"
+            )
+            persist_stats = get_write_behind_queue().stats()
+            st.caption(
+                f"History saves: {persist_stats['depth']} pending, "
+                f"{persist_stats['lag_seconds']:.1f}s behind, {persist_stats['failed']} failed"
+            )
             
             # Chat History Section
             st.header("Chat History")
             col1, col2 = st.columns([4, 1])
             with col2:
                 if st.button("🔄 Refresh"):
+                    get_chat_history_manager().invalidate_sessions_cache()
+                    st.session_state.older_sessions = []
+                    st.session_state.pop("more_sessions", None)
                     time.sleep(0.1)  # Prevent button spam
                     st.rerun()
             
             # Display available sessions with error handling
-            sessions = st.session_state.chat_history_manager.list_sessions()
+            chat_history_manager = get_chat_history_manager()
+            older_sessions = st.session_state.setdefault("older_sessions", [])
+            first_page = chat_history_manager.list_sessions(SESSIONS_PAGE_SIZE)
+            # A session saved since its page was fetched has moved to the first page
+            on_first_page = {session['session_id'] for session in first_page}
+            sessions = first_page + [
+                session for session in older_sessions if session['session_id'] not in on_first_page
+            ]
+            more_sessions = st.session_state.get("more_sessions", len(first_page) == SESSIONS_PAGE_SIZE)
             if sessions:
                 for session in sessions:
                     try:
@@ -144,13 +420,27 @@ def main():
                                     st.rerun()
                     except Exception as e:
                         st.error(f"Error displaying session: {str(e)}")
+                if more_sessions and st.button("Show older sessions"):
+                    page, cursor = chat_history_manager.list_sessions_page(
+                        SESSIONS_PAGE_SIZE, before=sessions[-1]['last_updated']
+                    )
+                    older_sessions.extend(page)
+                    st.session_state.more_sessions = cursor is not None
+                    st.rerun()
             else:
                 st.info("No previous chat sessions found")
+            
+            # Filled in at the end of the run, so it shows the question just answered
+            debug_panel = st.empty() if TELEMETRY_DEBUG_PANEL and telemetry.enabled() else None
         
         # Main chat area
         if st.session_state.chat_interface:
             st.header("Chat with Your PDF")
             
+            save_error = get_write_behind_queue().pop_error(st.session_state.session_id)
+            if save_error:
+                st.warning(f"Failed to save chat history: {save_error}")
+            
             # Display chat history
             for message in st.session_state.messages:
                 try:
@@ -176,34 +466,48 @@ def main():
                     with st.chat_message("user"):
                         st.markdown(prompt)
                     
-                    # Generate response
+                    # Stream the response token by token
                     with st.chat_message("assistant"):
-                        with st.spinner("Thinking..."):
-                            response = st.session_state.chat_interface.generate_response(prompt)
-                            st.markdown(response)
-                            
-                            # Add assistant message
-                            st.session_state.messages.append({
-                                "role": "assistant",
-                                "content": response,
-                                "timestamp": datetime.now().isoformat()
-                            })
+                        with telemetry.request("question") as request:
+                            response = st.write_stream(
+                                st.session_state.chat_interface.stream_response(
+                                    prompt, use_cache=st.session_state.use_response_cache
+                                )
+                            )
+                        remember_trace(request)
+                        
+                        st.caption(
+                            f"Prompt: {st.session_state.chat_interface.last_prompt_tokens} tokens"
+                        )
+                        
+                        # Add assistant message
+                        st.session_state.messages.append({
+                            "role": "assistant",
+                            "content": response,
+                            "timestamp": datetime.now().isoformat()
+                        })
                     
-                    # Save chat history
+                    # Save chat history in the background
                     if st.session_state.current_s3_key:
-                        success = st.session_state.chat_history_manager.save_chat_history(
+                        get_write_behind_queue().enqueue(
                             st.session_state.session_id,
                             st.session_state.current_s3_key,
-                            st.session_state.messages
+                            st.session_state.messages[st.session_state.saved_messages:]
                         )
-                        if not success:
-                            st.warning("Failed to save chat history")
+                        st.session_state.saved_messages = len(st.session_state.messages)
+                        get_chat_history_manager().invalidate_sessions_cache()
                 
                 except Exception as e:
                     st.error(f"Error processing message: {str(e)}")
         
         else:
             st.info("Please upload a PDF to start chatting.")
+        
+        if debug_panel is not None:
+            with debug_panel.container():
+                render_debug_panel()
+        
+        report_startup()
 
     except Exception as e:
         st.error(f"Application error: {str(e)}")
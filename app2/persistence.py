@@ -0,0 +1,157 @@
+# persistence.py
+import atexit
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import streamlit as st
+import telemetry
+from chat_history import ChatHistoryManager, get_chat_history_manager
+from config import (
+    PERSIST_MAX_RETRIES,
+    PERSIST_BACKOFF_BASE,
+    PERSIST_BACKOFF_CAP,
+)
+
+class WriteBehindQueue:
+    """
+    Saves chat history on a background thread so the UI never waits on DynamoDB.
+    Callers enqueue only the messages they have not handed over before; waiting
+    messages of the same session, from any browser tab, are appended in one save.
+    Failed saves are retried with jittered exponential backoff, and pending saves
+    are flushed at interpreter exit.
+    """
+
+    def __init__(
+        self,
+        chat_history_manager: ChatHistoryManager,
+        max_retries: int = PERSIST_MAX_RETRIES,
+    ):
+        self.chat_history_manager = chat_history_manager
+        self.max_retries = max_retries
+        self._pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._in_flight = 0
+        self._errors: Dict[str, str] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.saved = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+        telemetry.gauge("chat_persist_queue_depth", lambda: self.stats()["depth"])
+        telemetry.gauge("chat_persist_lag_seconds", lambda: self.stats()["lag_seconds"])
+
+    def enqueue(self, session_id: str, s3_key: str, messages: List[Dict[str, str]]) -> None:
+        """Schedule new messages to be appended, after any of the session's still waiting"""
+        new_messages = [dict(message) for message in messages]
+        with self._cond:
+            existing = self._pending.pop(session_id, None)
+            if existing:
+                self.coalesced += 1
+                new_messages = existing["messages"] + new_messages
+            self._pending[session_id] = {
+                "s3_key": s3_key,
+                "messages": new_messages,
+                # Lag is measured from the oldest unsaved change
+                "enqueued_at": existing["enqueued_at"] if existing else time.time(),
+                "attempts": existing["attempts"] if existing else 0,
+                "not_before": 0.0,
+            }
+            self._cond.notify()
+
+    def _next_ready(self) -> Optional[str]:
+        now = time.time()
+        for session_id, entry in self._pending.items():
+            if entry["not_before"] <= now:
+                return session_id
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    session_id = self._next_ready()
+                    if session_id is not None or (self._closed and not self._pending):
+                        break
+                    if self._pending:
+                        wake_at = min(entry["not_before"] for entry in self._pending.values())
+                        self._cond.wait(max(0.0, wake_at - time.time()))
+                    else:
+                        self._cond.wait()
+                if session_id is None:
+                    return
+                entry = self._pending.pop(session_id)
+                self._in_flight += 1
+
+            ok = self.chat_history_manager.save_chat_history(
+                session_id, entry["s3_key"], entry["messages"]
+            )
+
+            with self._cond:
+                self._in_flight -= 1
+                if ok:
+                    self.saved += 1
+                    self._errors.pop(session_id, None)
+                else:
+                    entry["attempts"] += 1
+                    if entry["attempts"] > self.max_retries:
+                        self.failed += 1
+                        self._errors[session_id] = f"Gave up after {self.max_retries} retries"
+                    else:
+                        self.retries += 1
+                        delay = min(PERSIST_BACKOFF_CAP, PERSIST_BACKOFF_BASE * (2 ** entry["attempts"]))
+                        entry["not_before"] = time.time() + random.uniform(0, delay)
+                        newer = self._pending.pop(session_id, None)
+                        if newer:
+                            # Messages enqueued meanwhile go after the ones being retried
+                            entry["messages"] += newer["messages"]
+                            entry["s3_key"] = newer["s3_key"]
+                        self._pending[session_id] = entry
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every pending save has been attempted; False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # Retries waiting on backoff go out immediately when flushing
+                for entry in self._pending.values():
+                    entry["not_before"] = 0.0
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout: float = 30) -> None:
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def pop_error(self, session_id: str) -> Optional[str]:
+        """Most recent permanent save failure for the session, if any"""
+        with self._cond:
+            return self._errors.pop(session_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            oldest = min((entry["enqueued_at"] for entry in self._pending.values()), default=None)
+            return {
+                "depth": len(self._pending) + self._in_flight,
+                "lag_seconds": time.time() - oldest if oldest else 0.0,
+                "saved": self.saved,
+                "coalesced": self.coalesced,
+                "retries": self.retries,
+                "failed": self.failed,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_write_behind_queue() -> WriteBehindQueue:
+    """Single writer thread shared by every browser session in this process"""
+    return WriteBehindQueue(get_chat_history_manager())
@@ -0,0 +1,135 @@
+# response_cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import numpy as np
+import streamlit as st
+from config import (
+    RESPONSE_CACHE_THRESHOLD,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+)
+
+class _DocumentResponses:
+    """Past query vectors for one document, in an ID-mapped inner-product index"""
+
+    def __init__(self, dimension: int):
+        import faiss
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+        self.entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.next_id = 0
+
+    def remove(self, entry_id: int) -> None:
+        self.entries.pop(entry_id, None)
+        self.index.remove_ids(np.array([entry_id], dtype=np.int64))
+
+class ResponseCache:
+    """
+    Semantic cache of LLM answers per document. A question is answered from the
+    cache when a previous question on the same document has cosine similarity of
+    at least `threshold`, was asked with the same `context` (a fingerprint of the
+    conversation history in the prompt) and its answer is younger than `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries_per_document: int = RESPONSE_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries_per_document = max_entries_per_document
+        self._documents: Dict[str, _DocumentResponses] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def _normalize(query_vector: np.ndarray) -> np.ndarray:
+        import faiss
+        vector = np.array(query_vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, document_id: str, query_vector: np.ndarray, context: str = "") -> Optional[str]:
+        """Cached answer for a sufficiently similar earlier question in the same context, or None"""
+        start = time.perf_counter()
+        vector = self._normalize(query_vector)
+        with self._lock:
+            try:
+                document = self._documents.get(document_id)
+                if document is None or not document.entries:
+                    self.misses += 1
+                    return None
+                # Every earlier question above the threshold; the best one asked in this context wins
+                _, scores, ids = document.index.range_search(vector, self.threshold)
+                entry_id, entry = None, None
+                for i in np.argsort(-scores):
+                    candidate = document.entries.get(int(ids[i]))
+                    if candidate is not None and candidate["context"] == context:
+                        entry_id, entry = int(ids[i]), candidate
+                        break
+                if entry is None:
+                    self.misses += 1
+                    return None
+                if time.time() - entry["created"] > self.ttl:
+                    document.remove(entry_id)
+                    self.misses += 1
+                    return None
+                document.entries.move_to_end(entry_id)
+                self.hits += 1
+                self.seconds_saved += entry["latency"]
+                return entry["response"]
+            finally:
+                self.lookup_seconds += time.perf_counter() - start
+
+    def store(
+        self,
+        document_id: str,
+        query_vector: np.ndarray,
+        response: str,
+        latency: float,
+        context: str = "",
+    ) -> None:
+        """Remember an answer along with how long the LLM took to produce it"""
+        vector = self._normalize(query_vector)
+        with self._lock:
+            document = self._documents.get(document_id)
+            if document is None:
+                document = self._documents[document_id] = _DocumentResponses(vector.shape[1])
+            entry_id = document.next_id
+            document.next_id += 1
+            document.index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            document.entries[entry_id] = {
+                "response": response,
+                "context": context,
+                "created": time.time(),
+                "latency": latency,
+            }
+            while len(document.entries) > self.max_entries_per_document:
+                document.remove(next(iter(document.entries)))
+
+    def invalidate(self, document_id: str) -> None:
+        with self._lock:
+            self._documents.pop(document_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "seconds_saved": self.seconds_saved,
+                "mean_lookup_ms": 1000 * self.lookup_seconds / lookups if lookups else 0.0,
+                "entries": sum(len(document.entries) for document in self._documents.values()),
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """Single ResponseCache shared by every browser session in this process"""
+    return ResponseCache()
@@ -0,0 +1,203 @@
+# retrieval.py
+import io
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+import numpy as np
+import telemetry
+from config import (
+    RETRIEVAL_CANDIDATES,
+    RETRIEVAL_RRF_K,
+    RETRIEVAL_MMR_LAMBDA,
+    RETRIEVAL_KEYWORD_MIN_SCORE,
+)
+
+# Words plus joined identifiers such as part numbers ("AX-4410", "v2.1")
+_TOKEN = re.compile(r"\w+(?:[-./]\w+)*")
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+def top_scores(scores: np.ndarray, k: int, min_score_ratio: float = 0.0) -> np.ndarray:
+    """
+    Ids of the top-k scores, best first. Scores below `min_score_ratio` of the
+    best one (matches on words that occur almost everywhere) are dropped.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[scores[top] > max(0.0, min_score_ratio * float(scores[top[0]]))]
+
+class BM25Index:
+    """
+    Inverted index with BM25 weights precomputed at ingest, stored as CSR arrays:
+    the postings of term t are doc_ids[indptr[t]:indptr[t + 1]] with matching weights.
+    A query is scored by summing the weights of its terms' postings.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], indptr: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray, doc_count: int):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_count = doc_count
+
+    @classmethod
+    def build(cls, chunks: Iterable[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        vocabulary: Dict[str, int] = {}
+        term_ids: List[int] = []
+        docs: List[int] = []
+        tfs: List[int] = []
+        doc_lengths: List[int] = []
+        for doc, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                docs.append(doc)
+                tfs.append(tf)
+
+        doc_count = len(doc_lengths)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        docs = np.asarray(docs, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        average_length = float(lengths.mean()) if doc_count and lengths.mean() > 0 else 1.0
+
+        document_frequency = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.float32)
+        idf = np.log1p((doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = k1 * (1 - b + b * lengths[docs] / average_length)
+        weights = (idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequency.astype(np.int64), out=indptr[1:])
+        return cls(vocabulary, indptr, docs[order], weights[order], doc_count)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query: str, k: int, min_score_ratio: float = 0.0) -> np.ndarray:
+        """Ids of the top-k documents, best first"""
+        return top_scores(self.scores(query), k, min_score_ratio)
+
+    def search_batch(self, queries: Sequence[str], k: int, min_score_ratio: float = 0.0) -> List[np.ndarray]:
+        return [self.search(query, k, min_score_ratio) for query in queries]
+
+    def to_bytes(self) -> io.BytesIO:
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            terms=np.array(terms, dtype=str),
+            indptr=self.indptr,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            doc_count=np.array([self.doc_count]),
+        )
+        buffer.seek(0)
+        return buffer
+
+    @classmethod
+    def load(cls, path_or_file: Any) -> "BM25Index":
+        with np.load(path_or_file, allow_pickle=False) as data:
+            vocabulary = {term: i for i, term in enumerate(data["terms"].tolist())}
+            return cls(vocabulary, data["indptr"], data["doc_ids"], data["weights"], int(data["doc_count"][0]))
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[int]], k: int = RETRIEVAL_RRF_K) -> Dict[int, float]:
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            doc = int(doc)
+            if doc >= 0:
+                fused[doc] = fused.get(doc, 0.0) + 1.0 / (k + rank + 1)
+    return fused
+
+class HybridRetriever:
+    """
+    Vector search and BM25 candidates fused with reciprocal-rank fusion, then
+    diversified with maximal marginal relevance so overlapping chunks don't
+    crowd out the context. Works over a segments.SegmentedIndex.
+    """
+
+    def __init__(
+        self,
+        index,
+        candidates: int = RETRIEVAL_CANDIDATES,
+        mmr_lambda: float = RETRIEVAL_MMR_LAMBDA,
+        keyword_min_score: float = RETRIEVAL_KEYWORD_MIN_SCORE,
+    ):
+        self.index = index
+        self.candidates = candidates
+        self.mmr_lambda = mmr_lambda
+        self.keyword_min_score = keyword_min_score
+
+    def _mmr(self, fused: Dict[int, float], k: int) -> List[int]:
+        ranked = sorted(fused, key=fused.get, reverse=True)[:max(k * 3, k)]
+        if len(ranked) <= 1 or self.mmr_lambda >= 1:
+            return ranked[:k]
+        vectors = np.array(self.index.embeddings[ranked], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        similarity = vectors @ vectors.T
+        relevance = np.array([fused[doc] for doc in ranked])
+        relevance /= relevance.max()
+
+        selected = [0]
+        max_similarity = similarity[0].copy()
+        while len(selected) < min(k, len(ranked)):
+            score = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * max_similarity
+            score[selected] = -np.inf
+            best = int(np.argmax(score))
+            selected.append(best)
+            max_similarity = np.maximum(max_similarity, similarity[best])
+        return [ranked[i] for i in selected]
+
+    def retrieve_batch(
+        self,
+        queries: Sequence[str],
+        query_embeddings: Optional[np.ndarray],
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+    ) -> List[List[int]]:
+        """
+        Row ids for each query. All query vectors go through one search per segment;
+        without embeddings, retrieval falls back to BM25 alone.
+        """
+        with self.index.lock:
+            vector_hits = [[] for _ in queries]
+            if query_embeddings is not None and len(queries):
+                with telemetry.span("faiss.search", queries=len(queries)):
+                    _, ids = self.index.search(
+                        np.asarray(query_embeddings, dtype=np.float32).reshape(len(queries), -1),
+                        self.candidates,
+                        nprobe=nprobe,
+                        ef_search=ef_search,
+                    )
+                vector_hits = [row[row >= 0] for row in ids]
+            with telemetry.span("bm25.search", queries=len(queries)):
+                keyword_hits = self.index.keyword_search_batch(queries, self.candidates, self.keyword_min_score)
+
+            return [
+                self._mmr(reciprocal_rank_fusion([vector, keyword]), k)
+                for vector, keyword in zip(vector_hits, keyword_hits)
+            ]
+
+    def retrieve(
+        self,
+        query: str,
+        query_embedding: Optional[np.ndarray],
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+    ) -> List[int]:
+        return self.retrieve_batch([query], query_embedding, k, nprobe, ef_search)[0]
@@ -0,0 +1,426 @@
+# segments.py
+import bisect
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from index_factory import DEFAULT_INDEX_PARAMS, code_bytes, search
+from retrieval import BM25Index, top_scores
+from chunking import CHUNK_META_DTYPE
+from index_store import SESSION_FORMAT_VERSION
+from config import SEGMENT_COMPACT_MAX_SEGMENTS, SEGMENT_COMPACT_DELETED_RATIO
+
+SEGMENTS_PREFIX = "segments"
+
+def estimate_nbytes(data: Any) -> int:
+    """Approximate footprint of a loaded session or segment: vectors, chunk texts and FAISS codes"""
+    if isinstance(data, SegmentedIndex):
+        return data.nbytes
+    if "nbytes" in data:
+        return int(data["nbytes"])
+    embeddings = data.get("embeddings")
+    total = getattr(embeddings, "nbytes", 0)
+    chunks = data.get("chunks", [])
+    total += getattr(chunks, "nbytes", None) or sum(len(chunk) for chunk in chunks)
+    index = data.get("faiss_index")
+    if index is not None:
+        total += code_bytes(index)
+    return total
+
+def make_segment(
+    data_package: Dict[str, Any],
+    segment_id: Optional[str] = None,
+    prefix: Optional[str] = None,
+    manifest: Optional[Dict[str, Any]] = None,
+    writable: bool = False,
+) -> Dict[str, Any]:
+    """
+    A segment is a data package plus where it lives in S3. Only segments built in
+    this process are writable: loaded FAISS indexes are memory-mapped read-only.
+    """
+    segment = dict(data_package)
+    segment["segment_id"] = segment_id or uuid.uuid4().hex
+    segment["prefix"] = f"{SEGMENTS_PREFIX}/{segment['segment_id']}" if prefix is None else prefix
+    segment["manifest"] = manifest
+    segment["writable"] = writable
+    segment.setdefault("index_params", dict(DEFAULT_INDEX_PARAMS))
+    if segment.get("bm25") is None:
+        # Indexes written before hybrid retrieval have no keyword index
+        segment["bm25"] = BM25Index.build(segment["chunks"])
+    return segment
+
+class _Rows:
+    """Read-only view of one per-chunk field across all segments, indexed by row id"""
+
+    def __init__(self, index: "SegmentedIndex", field: str):
+        self._index = index
+        self._field = field
+
+    def __len__(self) -> int:
+        return self._index.count
+
+    def __getitem__(self, row: Union[int, Sequence[int], np.ndarray]):
+        if isinstance(row, (list, tuple, np.ndarray)):
+            rows = [self[int(r)] for r in row]
+            return np.stack(rows) if self._field == "embeddings" else rows
+        segment, local = self._index.locate(row)
+        return segment[self._field][local]
+
+    def __iter__(self):
+        for segment in self._index.segments:
+            yield from segment[self._field]
+
+class SegmentedIndex:
+    """
+    A session's documents, stored as a list of immutable segments. Adding a
+    document appends a segment; deleting one masks its rows at query time and,
+    where the FAISS index allows it, removes them by id. Compaction rewrites the
+    live rows into a single segment.
+
+    Rows are numbered across segments in order. `documents` maps a document id to
+    {"name", "sha256", "segment", "start", "end"}, with rows local to its segment.
+    """
+
+    def __init__(
+        self,
+        session_id: Optional[str],
+        segments: List[Dict[str, Any]],
+        documents: Dict[str, Dict[str, Any]],
+        deleted: Iterable[str] = (),
+        revision: Optional[str] = None,
+    ):
+        self.session_id = session_id
+        self.lock = threading.RLock()
+        self.revision = revision or uuid.uuid4().hex
+        # The session manifest this index was loaded from or last wrote, and the revision
+        # it held; a write expects S3 to still have that ETag (expected_etag)
+        self.etag: Optional[str] = None
+        self.committed_revision = self.revision
+        self._base: Optional["SegmentedIndex"] = None
+        self.compacting = False
+        self._removed: set = set()
+        self._set_segments(segments, documents, set(deleted))
+
+    @classmethod
+    def from_data(cls, data_package: Dict[str, Any], name: str = "document") -> "SegmentedIndex":
+        """A single data package as a one-document index"""
+        segment = make_segment(data_package)
+        session_id = data_package.get("session_id")
+        documents = {
+            session_id or "document": {
+                "name": name,
+                "sha256": None,
+                "segment": segment["segment_id"],
+                "start": 0,
+                "end": len(segment["chunks"]),
+            }
+        }
+        return cls(session_id, [segment], documents)
+
+    def copy(self) -> "SegmentedIndex":
+        """
+        A copy to modify while readers keep using this one, e.g. when the index is shared
+        through the session cache. Vectors, chunks and FAISS indexes are shared, not copied,
+        so deleting from the copy masks rows instead of removing them from a shared index.
+        """
+        with self.lock:
+            segments = [dict(segment, writable=False) for segment in self.segments]
+            index = SegmentedIndex(
+                self.session_id,
+                segments,
+                {document_id: dict(document) for document_id, document in self.documents.items()},
+                self.deleted,
+                self.revision,
+            )
+            index._removed = set(self._removed)
+            index._refresh_mask()
+            index.etag = self.etag
+            index.committed_revision = self.committed_revision
+            # Changes not yet written will be, by this index, before the copy writes its own
+            index._base = self if self.revision != self.committed_revision else self._base
+            return index
+
+    def mark_committed(self, etag: Optional[str], revision: str) -> None:
+        """Record that the session manifest at `revision` was written with this ETag"""
+        with self.lock:
+            self.etag = etag
+            self.committed_revision = revision
+            self._base = None
+
+    def expected_etag(self) -> Optional[str]:
+        """
+        ETag the session manifest must still have for this index to overwrite it, or None
+        if it must not exist yet. A copy taken while the original still had a write in
+        flight expects whatever that write produces.
+        """
+        index = self
+        while index._base is not None:
+            index = index._base
+        return index.etag
+
+    def _set_segments(
+        self,
+        segments: List[Dict[str, Any]],
+        documents: Dict[str, Dict[str, Any]],
+        deleted: set,
+    ) -> None:
+        self.segments = segments
+        self.documents = documents
+        self.deleted = deleted
+        self._starts: List[int] = []
+        count = 0
+        for segment in segments:
+            segment["id_start"] = count
+            self._starts.append(count)
+            count += len(segment["chunks"])
+        self.count = count
+        self._refresh_mask()
+
+    def _refresh_mask(self) -> None:
+        by_id = {segment["segment_id"]: segment for segment in self.segments}
+        mask = np.zeros(self.count, dtype=bool)
+        for segment in self.segments:
+            segment["masked"] = 0
+            segment["documents"] = []
+        for document_id, document in self.documents.items():
+            segment = by_id.get(document["segment"])
+            if segment is None:
+                continue
+            segment["documents"].append((document["start"], document_id))
+            if document_id in self.deleted:
+                start = segment["id_start"]
+                mask[start + document["start"]:start + document["end"]] = True
+                if document_id not in self._removed:
+                    segment["masked"] += document["end"] - document["start"]
+        for segment in self.segments:
+            segment["documents"].sort()
+        self.mask = mask
+
+    @property
+    def metric(self) -> str:
+        if not self.segments:
+            return DEFAULT_INDEX_PARAMS["metric"]
+        return self.segments[0]["index_params"].get("metric", "l2")
+
+    @property
+    def chunks(self) -> _Rows:
+        return _Rows(self, "chunks")
+
+    @property
+    def embeddings(self) -> _Rows:
+        return _Rows(self, "embeddings")
+
+    @property
+    def deleted_rows(self) -> int:
+        return int(self.mask.sum())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(estimate_nbytes(segment) for segment in self.segments)
+
+    def live_documents(self) -> List[Tuple[str, Dict[str, Any]]]:
+        return [
+            (document_id, document) for document_id, document in self.documents.items()
+            if document_id not in self.deleted
+        ]
+
+    def find_document(self, sha256: str) -> Optional[str]:
+        for document_id, document in self.live_documents():
+            if document.get("sha256") == sha256:
+                return document_id
+        return None
+
+    def locate(self, row: int) -> Tuple[Dict[str, Any], int]:
+        """The segment holding a row, and the row's position within it"""
+        if not 0 <= row < self.count:
+            raise IndexError("row out of range")
+        position = bisect.bisect_right(self._starts, row) - 1
+        segment = self.segments[position]
+        return segment, row - segment["id_start"]
+
+    def source(self, row: int) -> Tuple[Optional[str], Optional[int]]:
+        """Name of the document a row belongs to and its page, where known"""
+        segment, local = self.locate(row)
+        name = None
+        starts = [start for start, _ in segment["documents"]]
+        position = bisect.bisect_right(starts, local) - 1
+        if position >= 0:
+            name = self.documents[segment["documents"][position][1]]["name"]
+        page = None
+        if segment.get("chunk_metadata") is not None:
+            page = int(segment["chunk_metadata"][local]["page"])
+        return name, page
+
+    def add_segment(
+        self,
+        data_package: Dict[str, Any],
+        name: str,
+        sha256: Optional[str] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Append one document's data package as a new segment; returns the document id and segment"""
+        segment = make_segment(data_package, writable=True)
+        if self.segments and segment["index_params"].get("metric") != self.metric:
+            raise ValueError(f"Segment metric does not match the session's ({self.metric})")
+        document_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            documents = dict(self.documents)
+            documents[document_id] = {
+                "name": name,
+                "sha256": sha256,
+                "segment": segment["segment_id"],
+                "start": 0,
+                "end": len(segment["chunks"]),
+                "added_at": time.time(),
+            }
+            self._set_segments(self.segments + [segment], documents, self.deleted)
+            self.revision = uuid.uuid4().hex
+        return document_id, segment
+
+    def delete_document(self, document_id: str) -> bool:
+        """Hide a document's rows from search; False if there is no such live document"""
+        with self.lock:
+            document = self.documents.get(document_id)
+            if document is None or document_id in self.deleted:
+                return False
+            self.deleted = self.deleted | {document_id}
+            segment = next(s for s in self.segments if s["segment_id"] == document["segment"])
+            if segment["writable"] and segment["index_params"].get("index_type") != "hnsw":
+                # ID-mapped flat and IVF indexes drop the vectors; HNSW graphs can't, so they stay masked
+                ids = np.arange(document["start"], document["end"], dtype=np.int64)
+                segment["faiss_index"].remove_ids(ids)
+                self._removed.add(document_id)
+            self._refresh_mask()
+            self.revision = uuid.uuid4().hex
+            return True
+
+    def needs_compaction(
+        self,
+        max_segments: int = SEGMENT_COMPACT_MAX_SEGMENTS,
+        deleted_ratio: float = SEGMENT_COMPACT_DELETED_RATIO,
+    ) -> bool:
+        with self.lock:
+            if len(self.segments) > max_segments:
+                return True
+            return bool(self.count) and self.deleted_rows / self.count > deleted_ratio
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """FAISS search of every segment, merged by distance; deleted rows come back as -1"""
+        queries = np.atleast_2d(queries)
+        with self.lock:
+            distances, ids = [], []
+            for segment in self.segments:
+                # Over-fetch by the masked rows still inside this segment's index
+                fetch = min(len(segment["chunks"]), k + segment["masked"])
+                if fetch <= 0:
+                    continue
+                D, I = search(
+                    segment["faiss_index"], queries, fetch, segment["index_params"], nprobe, ef_search,
+                    vectors=segment["embeddings"],
+                )
+                distances.append(D)
+                ids.append(np.where(I >= 0, I + segment["id_start"], -1))
+            if not ids:
+                return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+            D = np.hstack(distances)
+            I = np.hstack(ids)
+            valid = I >= 0
+            valid[valid] = ~self.mask[I[valid]]
+
+        # L2 distances rank ascending; inner-product and cosine similarities descending
+        keys = D if self.metric == "l2" else -D
+        keys = np.where(valid, keys, np.inf)
+        order = np.argsort(keys, axis=1, kind="stable")[:, :k]
+        D = np.take_along_axis(D, order, axis=1)
+        I = np.where(np.take_along_axis(valid, order, axis=1), np.take_along_axis(I, order, axis=1), -1)
+        return D, I
+
+    def keyword_search_batch(self, queries: Sequence[str], k: int, min_score_ratio: float = 0.0) -> List[np.ndarray]:
+        """BM25 top-k rows per query; each segment scores with its own term statistics"""
+        results = []
+        with self.lock:
+            for query in queries:
+                scores = np.concatenate(
+                    [segment["bm25"].scores(query) for segment in self.segments]
+                ) if self.segments else np.zeros(0, dtype=np.float32)
+                scores[self.mask] = 0
+                results.append(top_scores(scores, k, min_score_ratio))
+        return results
+
+    def live_package(self) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        """Vectors, chunks and chunk metadata of the live rows, and documents renumbered to match"""
+        with self.lock:
+            vectors: List[np.ndarray] = []
+            chunks: List[str] = []
+            metadata: List[np.ndarray] = []
+            documents: Dict[str, Dict[str, Any]] = {}
+            row = 0
+            by_id = {segment["segment_id"]: segment for segment in self.segments}
+            for document_id, document in self.live_documents():
+                segment = by_id[document["segment"]]
+                start, end = document["start"], document["end"]
+                vectors.append(np.asarray(segment["embeddings"][start:end], dtype=np.float32))
+                chunks.extend(segment["chunks"][start:end])
+                if segment.get("chunk_metadata") is not None:
+                    metadata.append(np.asarray(segment["chunk_metadata"][start:end], dtype=CHUNK_META_DTYPE))
+                else:
+                    metadata.append(np.zeros(end - start, dtype=CHUNK_META_DTYPE))
+                documents[document_id] = dict(document, start=row, end=row + end - start)
+                row += end - start
+            package = {
+                "embeddings": np.vstack(vectors) if vectors else None,
+                "chunks": chunks,
+                "chunk_metadata": np.concatenate(metadata) if metadata else None,
+                "session_id": self.session_id,
+            }
+            return package, documents
+
+    def replace_segments(
+        self,
+        segment: Dict[str, Any],
+        documents: Dict[str, Dict[str, Any]],
+        expected_revision: str,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Swap every segment for one compacted segment, unless the index changed since
+        `expected_revision`. Returns the replaced segments, or None if nothing was swapped.
+        """
+        with self.lock:
+            if self.revision != expected_revision:
+                return None
+            old_segments = self.segments
+            documents = {
+                document_id: dict(document, segment=segment["segment_id"])
+                for document_id, document in documents.items()
+            }
+            self._removed = set()
+            self._set_segments([segment], documents, set())
+            self.revision = uuid.uuid4().hex
+            return old_segments
+
+    def manifest(self) -> Dict[str, Any]:
+        """Session manifest listing the segments that have been uploaded"""
+        with self.lock:
+            stored = [segment for segment in self.segments if segment.get("manifest")]
+            stored_ids = {segment["segment_id"] for segment in stored}
+            return {
+                "format_version": SESSION_FORMAT_VERSION,
+                "session_id": self.session_id,
+                "revision": self.revision,
+                "created_at": time.time(),
+                "segments": [
+                    {"id": segment["segment_id"], "prefix": segment["prefix"], "manifest": segment["manifest"]}
+                    for segment in stored
+                ],
+                "documents": {
+                    document_id: document for document_id, document in self.documents.items()
+                    if document["segment"] in stored_ids
+                },
+                "deleted": sorted(self.deleted),
+            }
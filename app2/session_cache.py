@@ -0,0 +1,91 @@
+# session_cache.py
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import streamlit as st
+from config import SESSION_CACHE_MAX_BYTES
+from segments import estimate_nbytes
+import telemetry
+
+class SessionCache:
+    """
+    Process-wide LRU of loaded session indexes, bounded by total bytes.
+    Entries are revalidated against the S3 manifest ETag before being served,
+    so every Streamlit session in the container shares one copy of each index.
+    """
+
+    def __init__(self, max_bytes: int = SESSION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get_or_load(self, session_id: str, embeddings_manager) -> Any:
+        """Return the session's SegmentedIndex, loading it from S3 on a miss or stale ETag"""
+        with self._lock:
+            load_lock = self._load_locks.setdefault(session_id, threading.Lock())
+
+        # One loader per session; concurrent callers wait and then hit the fresh entry
+        with load_lock:
+            etag = embeddings_manager.get_index_etag(session_id)
+            with self._lock:
+                entry = self._entries.get(session_id)
+                if entry and etag and entry["etag"] == etag:
+                    self._entries.move_to_end(session_id)
+                    self.hits += 1
+                    telemetry.count("session_cache_hits")
+                    return entry["data"]
+                self.misses += 1
+                telemetry.count("session_cache_misses")
+                if entry:
+                    self.stale += 1
+
+            data = embeddings_manager.load_embeddings(session_id)
+            if etag is None:
+                # Legacy sessions only get a manifest once they have been migrated
+                etag = embeddings_manager.get_index_etag(session_id)
+            self.put(session_id, data, etag)
+            return data
+
+    def put(self, session_id: str, data: Any, etag: Optional[str]) -> None:
+        nbytes = estimate_nbytes(data)
+        with self._lock:
+            self._remove_locked(session_id)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[session_id] = {"data": data, "etag": etag, "nbytes": nbytes}
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self.evictions += 1
+
+    def invalidate(self, session_id: str) -> None:
+        with self._lock:
+            self._remove_locked(session_id)
+
+    def _remove_locked(self, session_id: str) -> None:
+        entry = self._entries.pop(session_id, None)
+        if entry:
+            self._total_bytes -= entry["nbytes"]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_session_cache() -> SessionCache:
+    """Single SessionCache shared by every browser session in this process"""
+    return SessionCache()
@@ -0,0 +1,414 @@
+# telemetry.py
+"""
+Spans, counters and histograms for the ingest and query stages.
+
+    with telemetry.span("s3.upload", files=3):
+        ...
+    telemetry.count("chunks_embedded", len(texts))
+
+Every span adds its duration to the stage_seconds histogram (labelled by stage)
+and, when it ends with an exception, to errors_total. Spans opened inside
+telemetry.request() are also collected into that request's Trace for the
+sidebar debug panel. When TELEMETRY_ENABLED is false every call returns
+immediately and span() hands back a shared no-op object.
+"""
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from config import (
+    TELEMETRY_ENABLED,
+    TELEMETRY_EXPORTERS,
+    TELEMETRY_PROMETHEUS_PORT,
+    TELEMETRY_JSON_LOG_PATH,
+)
+
+# Histogram bucket upper bounds in seconds, from a FAISS search to a slow LLM answer
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+class Registry:
+    """Process-wide counters, gauges and histograms, keyed by metric name and sorted labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, _Labels], float] = {}
+        # Read when the registry is rendered, e.g. a queue's current depth
+        self.gauges: Dict[Tuple[str, _Labels], Callable[[], float]] = {}
+        # (name, labels) -> [count per bucket (not cumulative), sum, count]
+        self.histograms: Dict[Tuple[str, _Labels], List[Any]] = {}
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.gauges[key] = read
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        bucket = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render_prometheus(self, namespace: str = "rag") -> str:
+        """Prometheus text exposition format"""
+        def labels_text(labels: _Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            escaped = (
+                (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs
+            )
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in self.histograms.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{namespace}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{labels_text(labels)} {value:g}")
+        for (name, labels), read in gauges:
+            try:
+                value = float(read())
+            except Exception as e:
+                print(f"Error reading gauge {name}: {str(e)}")
+                continue
+            metric = f"{namespace}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{labels_text(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in histograms:
+            metric = f"{namespace}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + (float("inf"),), buckets):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{metric}_bucket{labels_text(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{metric}_sum{labels_text(labels)} {total:g}")
+            lines.append(f"{metric}_count{labels_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+class Trace:
+    """The spans and counters of one user request (an upload or a question)"""
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.spans: List["Span"] = []
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, span: "Span") -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def add_count(self, name: str, value: float) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        """Finished spans in start order, with their offset into the request and nesting depth"""
+        with self._lock:
+            spans = sorted((s for s in self.spans if s.duration is not None), key=lambda s: s.started)
+        return [
+            {
+                "stage": span.name,
+                "depth": span.depth,
+                "offset_ms": (span.started - self.started) * 1000,
+                "duration_ms": span.duration * 1000,
+                "error": span.error,
+                **span.attributes,
+            }
+            for span in spans
+        ]
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("telemetry_trace", default=None)
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("telemetry_span", default=None)
+
+class Span:
+    __slots__ = ("name", "attributes", "parent", "trace", "depth", "started", "started_ns",
+                 "duration", "error", "exporter_state", "_token")
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self.exporter_state: Dict[str, Any] = {}
+
+    def set(self, **attributes: Any) -> None:
+        """Attach attributes known only once the stage has run, e.g. result sizes"""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self.parent = _current_span.get()
+        self.trace = _current_trace.get()
+        self.depth = self.parent.depth + 1 if self.parent is not None else 0
+        self._token = _current_span.set(self)
+        self.started_ns = time.time_ns()
+        self.started = time.perf_counter()
+        for exporter in _exporters:
+            exporter.on_start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.duration = time.perf_counter() - self.started
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+            registry.count("errors_total", stage=self.name)
+        registry.observe("stage_seconds", self.duration, stage=self.name)
+        if self.trace is not None:
+            self.trace.add_span(self)
+        for exporter in _exporters:
+            try:
+                exporter.on_end(self)
+            except Exception as e:
+                print(f"Error exporting span {self.name}: {str(e)}")
+        return False
+
+class _NoopSpan:
+    """Returned by span() and request() while telemetry is disabled"""
+    trace = None
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+_NOOP = _NoopSpan()
+
+class _Request(Span):
+    """Root span of a request; collects the spans opened under it into a Trace"""
+    __slots__ = ("_trace_token",)
+
+    def __enter__(self) -> "_Request":
+        trace = Trace(self.name, self.attributes)
+        self._trace_token = _current_trace.set(trace)
+        super().__enter__()
+        trace.started = self.started
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        super().__exit__(exc_type, exc, tb)
+        self.trace.duration = self.duration
+        _current_trace.reset(self._trace_token)
+        return False
+
+class PrometheusExporter:
+    """
+    Serves this process's registry as Prometheus text on http://0.0.0.0:<port>/metrics.
+    Counters are per process, so every process needs its own port and scrape target.
+    """
+
+    def __init__(self, port: int = TELEMETRY_PROMETHEUS_PORT):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="telemetry-prometheus", daemon=True).start()
+
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        pass
+
+class JsonLogExporter:
+    """One JSON line per finished span, to a file or stderr"""
+
+    def __init__(self, path: str = TELEMETRY_JSON_LOG_PATH):
+        self._stream = open(path, "a", buffering=1) if path else sys.stderr
+        self._lock = threading.Lock()
+
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        record = {
+            "ts": span.started_ns / 1e9,
+            "span": span.name,
+            "duration_ms": round(span.duration * 1000, 3),
+            "parent": span.parent.name if span.parent is not None else None,
+            "request": span.trace.name if span.trace is not None else None,
+            "error": span.error,
+            **span.attributes,
+        }
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._stream.write(line + "\n")
+
+class OpenTelemetryExporter:
+    """
+    Mirrors spans into OpenTelemetry with their parent links, plus a duration
+    histogram. Needs opentelemetry-api, and an SDK with an exporter configured
+    (e.g. by opentelemetry-instrument) for the data to go anywhere.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics, trace
+        self._trace = trace
+        self._tracer = trace.get_tracer("rag")
+        self._duration = metrics.get_meter("rag").create_histogram(
+            "rag.stage.duration", unit="s", description="Duration of each pipeline stage"
+        )
+
+    def on_start(self, span: Span) -> None:
+        parent = span.parent.exporter_state.get("otel") if span.parent is not None else None
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        span.exporter_state["otel"] = self._tracer.start_span(
+            span.name, context=context, start_time=span.started_ns
+        )
+
+    def on_end(self, span: Span) -> None:
+        otel_span = span.exporter_state.pop("otel", None)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                otel_span.set_attribute(key, value)
+        if span.error:
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=span.started_ns + int(span.duration * 1e9))
+        self._duration.record(span.duration, {"stage": span.name})
+
+_EXPORTERS = {
+    "prometheus": PrometheusExporter,
+    "json": JsonLogExporter,
+    "otel": OpenTelemetryExporter,
+}
+
+registry = Registry()
+_enabled = TELEMETRY_ENABLED
+_exporters: List[Any] = []
+_started = False
+_start_lock = threading.Lock()
+
+def enabled() -> bool:
+    return _enabled
+
+def start(
+    exporters: Optional[str] = None,
+    enable: Optional[bool] = None,
+    prometheus_port: Optional[int] = None,
+) -> None:
+    """
+    Create the configured exporters, once per process. `exporters` (a comma-separated
+    list like TELEMETRY_EXPORTERS), `enable` and `prometheus_port` override the configuration.
+    """
+    global _enabled, _started
+    with _start_lock:
+        if enable is not None:
+            _enabled = enable
+        if _started or not _enabled:
+            return
+        _started = True
+        names = TELEMETRY_EXPORTERS if exporters is None else exporters
+        for name in filter(None, (part.strip().lower() for part in names.split(","))):
+            try:
+                if name == "prometheus" and prometheus_port is not None:
+                    _exporters.append(PrometheusExporter(prometheus_port))
+                else:
+                    _exporters.append(_EXPORTERS[name]())
+            except KeyError:
+                print(f"Unknown telemetry exporter: {name}")
+            except Exception as e:
+                print(f"Telemetry exporter {name} disabled: {str(e)}")
+
+def span(name: str, **attributes: Any):
+    """Context manager timing one stage"""
+    if not _enabled:
+        return _NOOP
+    return Span(name, attributes)
+
+def request(name: str, **attributes: Any):
+    """Context manager for a whole user request; `.trace` holds its breakdown afterwards"""
+    if not _enabled:
+        return _NOOP
+    return _Request(name, attributes)
+
+def traced(name: Optional[str] = None) -> Callable:
+    """Decorator form of span(), named after the function unless given a name"""
+    def decorate(func: Callable) -> Callable:
+        stage = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(stage, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name: str, value: float = 1, **labels: Any) -> None:
+    """Add to a counter, and to the current request's totals"""
+    if not _enabled:
+        return
+    registry.count(name, value, **labels)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_count(name, value)
+
+def gauge(name: str, read: Callable[[], float], **labels: Any) -> None:
+    """Export the value `read` returns as a gauge; it is called each time metrics are exported"""
+    registry.gauge(name, read, **labels)
+
+def in_context(func: Callable) -> Callable:
+    """
+    Wrap `func` to run in the caller's request and span when submitted to a thread pool,
+    so work done on worker threads still shows up in the request's breakdown. Each call
+    runs in its own copy of the caller's context, so the wrapper can be handed to
+    pool.map or submitted any number of times, concurrently.
+    """
+    if not _enabled or _current_trace.get() is None:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
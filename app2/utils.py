@@ -1,19 +1,103 @@
 #utils.py
 
+import io
+import multiprocessing
+import signal
+import threading
 import PyPDF2
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+from config import PDF_EXTRACT_WORKERS, PDF_PAGES_PER_TASK, PDF_PAGE_TIMEOUT
+
+# Set in each extraction worker by _init_extract_worker
+_worker_reader: Optional[PyPDF2.PdfReader] = None
+
+class _PageTimeout(Exception):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise _PageTimeout()
+
+def _can_interrupt() -> bool:
+    """The page budget relies on SIGALRM, so it only applies on the main thread of a POSIX process"""
+    return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+def _extract_page(page, timeout: float) -> str:
+    """Extract one page's text, giving up after `timeout` seconds where _can_interrupt()"""
+    if timeout <= 0 or not _can_interrupt():
+        return page.extract_text() or ""
+
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return page.extract_text() or ""
+    except _PageTimeout:
+        print(f"Skipping PDF page that exceeded the {timeout}s extraction budget")
+        return ""
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _init_extract_worker(pdf_bytes: bytes) -> None:
+    global _worker_reader
+    _worker_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+
+def _extract_page_range(start: int, end: int, timeout: float) -> List[Tuple[int, str]]:
+    return [
+        (page_number + 1, _extract_page(_worker_reader.pages[page_number], timeout))
+        for page_number in range(start, end)
+    ]
+
+def iter_pdf_pages(
+    file,
+    workers: int = PDF_EXTRACT_WORKERS,
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+    page_timeout: float = PDF_PAGE_TIMEOUT,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (page number, text) in page order, starting from page 1.
+    Large documents are extracted in page ranges on a process pool, with at most
+    two ranges per worker in flight so memory stays bounded. Small ones are extracted
+    in the calling thread, unless that thread can't enforce the page budget (the
+    Streamlit script thread, ingest worker threads): then they go to the pool too.
+    """
+    pdf_bytes = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    page_count = len(reader.pages)
+
+    if workers <= 1 or page_count <= 2 * pages_per_task:
+        if page_timeout <= 0 or _can_interrupt():
+            for page_number, page in enumerate(reader.pages):
+                yield page_number + 1, _extract_page(page, page_timeout)
+            return
+        # A worker process runs extraction on its main thread, where SIGALRM works
+
+    ranges = deque(
+        (start, min(start + pages_per_task, page_count))
+        for start in range(0, page_count, pages_per_task)
+    )
+    workers = max(1, min(workers, len(ranges)))
+    # spawn: forking from Streamlit's threaded server is not safe
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_extract_worker,
+        initargs=(pdf_bytes,),
+    ) as pool:
+        in_flight = deque()
+        while ranges or in_flight:
+            while ranges and len(in_flight) < 2 * workers:
+                start, end = ranges.popleft()
+                in_flight.append(pool.submit(_extract_page_range, start, end, page_timeout))
+            yield from in_flight.popleft().result()
 
 def read_pdf(file) -> str:
     """
     Extracts text from a PDF file.
     """
-    pdf_reader = PyPDF2.PdfReader(file)
-    text = ""
-    for page in pdf_reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
-    return text
+    return "".join(text + "\n" for _, text in iter_pdf_pages(file) if text)
 
 def split_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> list:
     """
@@ -28,10 +112,30 @@ def split_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> list:
         start += chunk_size - overlap
     return chunks
 
+def iter_text_chunks(
+    pages: Iterable[Tuple[int, str]], chunk_size: int = 1000, overlap: int = 200
+) -> Iterator[str]:
+    """
+    Streaming equivalent of split_text(read_pdf(...)): yields the same chunks
+    as soon as enough page text has arrived, holding only one page plus a partial chunk.
+    """
+    step = chunk_size - overlap
+    buffer = ""
+    for _, text in pages:
+        if not text:
+            continue
+        buffer += text + "\n"
+        position = 0
+        while len(buffer) - position >= chunk_size:
+            yield buffer[position:position + chunk_size]
+            position += step
+        buffer = buffer[position:]
+    yield from split_text(buffer, chunk_size, overlap)
+
 def generate_session_id() -> str:
     """
     Generates a unique session ID.
     """
     return str(uuid.uuid4())
 
-#
\ No newline at end of file
+#
@@ -0,0 +1,65 @@
+# bench_chunking.py
+"""
+Chunking throughput over large synthetic text: the fixed-window utils.split_text
+versus the token-aware chunking.chunk_pages.
+
+    python bench/bench_chunking.py --pages 2000
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2"))
+
+from chunking import chunk_pages  # noqa: E402
+from utils import split_text  # noqa: E402
+
+_WORDS = (
+    "the index stores vectors for each chunk while retrieval ranks passages by distance "
+    "bedrock returns embeddings quickly although throttling may slow large uploads "
+    "part number AX-4410 requires torque of 12 Nm on every mounting bolt"
+).split()
+
+def synthetic_pages(pages: int, sentences_per_page: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    result = []
+    for page in range(pages):
+        paragraphs = []
+        for _ in range(max(1, sentences_per_page // 6)):
+            sentences = []
+            for _ in range(6):
+                words = rng.choice(_WORDS, size=rng.integers(6, 30))
+                sentences.append(" ".join(words).capitalize() + ".")
+            paragraphs.append(" ".join(sentences))
+        result.append((page + 1, "\n\n".join(paragraphs)))
+    return result
+
+def run(args: argparse.Namespace) -> None:
+    pages = synthetic_pages(args.pages, args.sentences)
+    text = "".join(page_text + "\n" for _, page_text in pages)
+    megabytes = len(text.encode("utf-8")) / 1e6
+    print(f"{args.pages} pages, {megabytes:.1f} MB of text")
+
+    start = time.perf_counter()
+    fixed = split_text(text)
+    elapsed = time.perf_counter() - start
+    print(f"split_text      {len(fixed):>8} chunks {elapsed:>8.3f} s {megabytes / elapsed:>8.1f} MB/s")
+
+    start = time.perf_counter()
+    chunks = list(chunk_pages(pages, args.max_tokens, args.overlap_tokens))
+    elapsed = time.perf_counter() - start
+    mean_chars = sum(len(chunk["text"]) for chunk in chunks) / len(chunks)
+    print(
+        f"chunk_pages     {len(chunks):>8} chunks {elapsed:>8.3f} s {megabytes / elapsed:>8.1f} MB/s "
+        f"(mean {mean_chars:.0f} chars)"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--sentences", type=int, default=60, help="sentences per page")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--overlap-tokens", type=int, default=32)
+    run(parser.parse_args())
@@ -0,0 +1,79 @@
+# bench_compression.py
+"""
+Recall and size of the vector compression modes in app2/index_factory.py.
+
+For each mode, with and without full-precision re-ranking, reports recall@k
+against an uncompressed flat index and the bytes a session stores (vectors.npy
+plus index.faiss, as uploaded to S3 and memory-mapped by the session cache).
+
+    python bench/bench_compression.py --count 5000 --dim 1536 --queries 200
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2"))
+
+from index_factory import build_index, search, stored_vectors  # noqa: E402
+from index_store import INDEX_FILE, VECTORS_FILE, build_index_payloads  # noqa: E402
+from bench_index import recall_at_k, synthetic_vectors  # noqa: E402
+
+def stored_bytes(vectors: np.ndarray, index, params) -> int:
+    """Size of the session files that hold vectors, as written by index_store"""
+    _, payloads = build_index_payloads({
+        "embeddings": vectors,
+        "chunks": [],
+        "faiss_index": index,
+        "index_params": params,
+    })
+    return sum(payloads[name].getbuffer().nbytes for name in (VECTORS_FILE, INDEX_FILE))
+
+def run(args: argparse.Namespace) -> None:
+    base = synthetic_vectors(args.count, args.dim, args.clusters, seed=1)
+    queries = synthetic_vectors(args.queries, args.dim, args.clusters, seed=2)
+    ids = np.arange(len(base))
+
+    flat, flat_params = build_index(base, "flat", args.metric, ids=ids)
+    _, truth = search(flat, queries, args.k, flat_params)
+    baseline = stored_bytes(base, flat, flat_params)
+
+    print(f"{args.count} vectors x {args.dim} dims, {args.index_type} index, baseline {baseline / 1e6:.1f} MB")
+    print(
+        f"{'compression':<12} {'rerank':<7} {'recall@' + str(args.k):>10} {'MB':>8} "
+        f"{'saved':>7} {'ms/query':>9}"
+    )
+    for compression in args.compressions:
+        for rerank in ([False] if compression == "none" else [True, False]):
+            index, params = build_index(
+                base, args.index_type, args.metric, ids=ids, compression=compression,
+                rerank=rerank, rerank_factor=args.rerank_factor,
+            )
+            vectors = stored_vectors(base, params)
+            start = time.perf_counter()
+            # One query at a time, matching how ChatInterface searches
+            found = np.vstack([
+                search(index, query, args.k, params, vectors=vectors)[1] for query in queries
+            ])
+            ms_per_query = (time.perf_counter() - start) * 1000 / len(queries)
+            size = stored_bytes(vectors, index, params)
+            label = params.get("compression", "none")
+            print(
+                f"{label:<12} {('yes' if params.get('rerank') else 'no'):<7} "
+                f"{recall_at_k(found, truth):>10.3f} {size / 1e6:>8.1f} "
+                f"{1 - size / baseline:>7.0%} {ms_per_query:>9.3f}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=5_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--metric", default="l2", choices=["l2", "ip", "cosine"])
+    parser.add_argument("--index-type", default="flat", choices=["flat", "hnsw", "ivf_flat"])
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--compressions", nargs="+", default=["none", "fp16", "sq8", "pq"])
+    run(parser.parse_args())
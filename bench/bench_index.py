@@ -0,0 +1,68 @@
+# bench_index.py
+"""
+Recall-vs-latency benchmark for the index types in app2/index_factory.py.
+
+    python bench/bench_index.py --count 50000 --dim 256 --queries 200
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2"))
+
+from index_factory import build_index, search  # noqa: E402
+
+def synthetic_vectors(count: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """Gaussian clusters, which is closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    return centers[labels] + 0.3 * rng.standard_normal((count, dim)).astype(np.float32)
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+def run(args: argparse.Namespace) -> None:
+    base = synthetic_vectors(args.count, args.dim, args.clusters, seed=1)
+    queries = synthetic_vectors(args.queries, args.dim, args.clusters, seed=2)
+
+    flat, flat_params = build_index(base, "flat", args.metric)
+    _, truth = search(flat, queries, args.k, flat_params)
+
+    sweeps = {
+        "flat": [{}],
+        "hnsw": [{"ef_search": ef} for ef in (16, 32, 64, 128, 256)],
+        "ivf_flat": [{"nprobe": n} for n in (1, 4, 16, 64)],
+        "ivf_pq": [{"nprobe": n} for n in (1, 4, 16, 64)],
+    }
+    print(f"{'index':<10} {'setting':<14} {'build s':>8} {'recall@' + str(args.k):>10} {'ms/query':>9}")
+    for index_type in args.types:
+        start = time.perf_counter()
+        index, params = build_index(base, index_type, args.metric)
+        build_seconds = time.perf_counter() - start
+        for overrides in sweeps[index_type]:
+            start = time.perf_counter()
+            # One query at a time, matching how ChatInterface searches
+            found = np.vstack([
+                search(index, query, args.k, params, **overrides)[1] for query in queries
+            ])
+            ms_per_query = (time.perf_counter() - start) * 1000 / len(queries)
+            setting = ",".join(f"{key}={value}" for key, value in overrides.items()) or "-"
+            print(
+                f"{index_type:<10} {setting:<14} {build_seconds:>8.2f} "
+                f"{recall_at_k(found, truth):>10.3f} {ms_per_query:>9.3f}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--metric", default="l2", choices=["l2", "ip", "cosine"])
+    parser.add_argument("--types", nargs="+", default=["flat", "hnsw", "ivf_flat", "ivf_pq"])
+    run(parser.parse_args())
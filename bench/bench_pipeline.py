@@ -0,0 +1,302 @@
+# bench_pipeline.py
+"""
+End-to-end load test of the RAG pipeline, offline. Each simulated user uploads a
+synthetic PDF and asks questions about it through the app's own code paths:
+
+    extract   utils.iter_pdf_pages (or utils.read_pdf with --chunker fixed)
+    chunk     chunking.chunk_pages (or utils.split_text)
+    embed     EmbeddingsManager.add_document, until the index is built
+    upload    the S3 upload of the new segment
+    load      EmbeddingsManager.load_embeddings from S3, local cache cleared
+    retrieve  ChatInterface._get_relevant_context
+    first_token / answer   ChatInterface.stream_response
+    save_history / load_history   ChatHistoryManager
+
+S3 and DynamoDB are moto, Bedrock and Gemini are the fakes in fakes.py with the
+latencies given on the command line. Reports latency percentiles per stage,
+throughput with --users concurrent users and peak RSS; --output writes JSON and
+--baseline compares against an earlier JSON run. --telemetry turns on the app's
+own instrumentation (telemetry.py) and adds its counters to the JSON.
+
+    pip install -r bench/requirements.txt
+    python bench/bench_pipeline.py --users 8 --questions 5 --output run.json
+    python bench/bench_pipeline.py --users 8 --questions 5 --baseline run.json
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List
+import numpy as np
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2")
+sys.path.insert(0, APP_DIR)
+
+from fakes import FakeEmbeddings, FakeLLM, synthetic_lines, synthetic_pdf  # noqa: E402
+
+class StageTimer:
+    """Thread-safe collection of wall-clock samples per stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, samples in self.samples.items():
+            values = np.asarray(samples) * 1000
+            p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+            result[stage] = {
+                "count": len(values),
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(values.max()),
+            }
+        return result
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident set size of this process and of its (PDF extraction) children"""
+    import resource
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+def configure_environment(args: argparse.Namespace, workdir: str) -> None:
+    """Settings read by config.py at import, so this runs before any app module is imported"""
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_REGION": "us-east-1",
+        "S3_BUCKET_NAME": "rag-bench",
+        "DYNAMODB_TABLE": "BenchSessions",
+        "INDEX_CACHE_DIR": os.path.join(workdir, "index_cache"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite3"),
+        "EMBEDDING_CACHE_ENABLED": str(args.embedding_cache).lower(),
+        "RESPONSE_CACHE_ENABLED": "false",
+        "INDEX_TYPE": args.index_type,
+        "INDEX_COMPRESSION": args.compression,
+        "INDEX_RERANK": str(not args.no_rerank).lower(),
+    })
+
+def questions_for(lines: List[List[str]], count: int, rng: np.random.Generator) -> List[str]:
+    """Alternates part-number lookups with questions built from a page's words"""
+    questions = []
+    for n in range(count):
+        page = lines[int(rng.integers(len(lines)))]
+        if n % 2 == 0:
+            questions.append(f"What does {page[0].split()[1]} require?")
+        else:
+            words = " ".join(page[int(rng.integers(1, len(page)))].split()[:6])
+            questions.append(f"What does the manual say about {words.lower().rstrip('.')}?")
+    return questions
+
+def simulate_user(user: int, args: argparse.Namespace, timer: StageTimer, app: Dict[str, Any]) -> int:
+    """One upload followed by --questions turns; returns the number of answered questions"""
+    from chat_interface import ChatInterface
+    from chunking import chunk_pages
+    from utils import iter_pdf_pages, read_pdf, split_text
+
+    manager = app["embeddings_manager"]
+    history = app["chat_history_manager"]
+    session_id = f"bench-{user:04d}"
+    lines = synthetic_lines(args.pages, args.lines_per_page, seed=user)
+    pdf = synthetic_pdf(lines)
+
+    if args.chunker == "fixed":
+        with timer.time("extract"):
+            text = read_pdf(io.BytesIO(pdf))
+        with timer.time("chunk"):
+            chunks = split_text(text)
+    else:
+        with timer.time("extract"):
+            pages = list(iter_pdf_pages(io.BytesIO(pdf)))
+        with timer.time("chunk"):
+            chunks = list(chunk_pages(pages))
+
+    with timer.time("embed"):
+        _, _, upload = manager.add_document(chunks, session_id, f"manual-{user}.pdf")
+    with timer.time("upload"):
+        upload.result()
+
+    # A fresh load, as when another server process first opens the session
+    shutil.rmtree(manager._local_index_dir(session_id), ignore_errors=True)
+    with timer.time("load"):
+        index = manager.load_embeddings(session_id)
+
+    chat = ChatInterface(
+        index,
+        embeddings_model=app["embeddings_model"],
+        document_id=session_id,
+        llm=FakeLLM(args.llm_first_token, args.llm_token_latency, args.llm_tokens),
+    )
+    messages: List[Dict[str, str]] = []
+    rng = np.random.default_rng(user)
+    answered = 0
+    for question in questions_for(lines, args.questions, rng):
+        with timer.time("retrieve"):
+            chat._get_relevant_context(question)
+
+        start = time.perf_counter()
+        parts = []
+        for token in chat.stream_response(question, use_cache=False):
+            if not parts:
+                timer.record("first_token", time.perf_counter() - start)
+            parts.append(token)
+        timer.record("answer", time.perf_counter() - start)
+        answered += 1
+
+        messages += [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": "".join(parts)},
+        ]
+        with timer.time("save_history"):
+            if not history.save_chat_history(session_id, manager.index_key(session_id), messages, len(messages) - 2):
+                raise RuntimeError(f"Saving chat history failed for {session_id}")
+
+    with timer.time("load_history"):
+        history.get_chat_history(session_id)
+    return answered
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    print(f"\n{'vs baseline':<14} {'p50 ms':>19} {'p95 ms':>19}")
+    for stage, stats in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before:
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms"):
+            change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            cells.append(f"{before[key]:>8.1f} → {stats[key]:>8.1f} ({change:+.0f}%)")
+        print(f"{stage:<14} " + "  ".join(cells))
+    for key in ("questions_per_second", "documents_per_second"):
+        print(f"{key}: {baseline['throughput'][key]:.2f} → {current['throughput'][key]:.2f}")
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from moto import mock_aws
+
+    workdir = tempfile.mkdtemp(prefix="rag_bench_")
+    configure_environment(args, workdir)
+    try:
+        with mock_aws():
+            import aws
+            import telemetry
+            from chat_history import ChatHistoryManager, create_tables
+            from embeddings import EmbeddingsManager
+
+            telemetry.start(exporters="", enable=args.telemetry)
+            aws.client("s3").create_bucket(Bucket=os.environ["S3_BUCKET_NAME"])
+            create_tables(aws.resource("dynamodb"), os.environ["DYNAMODB_TABLE"])
+            embeddings_model = FakeEmbeddings(args.dim, args.embed_latency, args.embed_per_text_latency)
+            app = {
+                "embeddings_model": embeddings_model,
+                "embeddings_manager": EmbeddingsManager(embeddings_model=embeddings_model),
+                "chat_history_manager": ChatHistoryManager(),
+            }
+
+            timer = StageTimer()
+            errors: List[str] = []
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.users) as pool:
+                futures = [pool.submit(simulate_user, user, args, timer, app) for user in range(args.users)]
+                answered = 0
+                for future in futures:
+                    try:
+                        answered += future.result()
+                    except Exception as e:
+                        errors.append(str(e))
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": vars(args),
+        "wall_seconds": elapsed,
+        "throughput": {
+            "questions_per_second": answered / elapsed,
+            "documents_per_second": (args.users - len(errors)) / elapsed,
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "errors": errors,
+        "stages": timer.summary(),
+        "counters": {
+            name + "".join(f"[{k}={v}]" for k, v in labels): value
+            for (name, labels), value in sorted(telemetry.registry.counters.items())
+        },
+    }
+
+def report(result: Dict[str, Any]) -> None:
+    print(f"{'stage':<14} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, stats in result["stages"].items():
+        print(
+            f"{stage:<14} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} "
+            f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}"
+        )
+    throughput = result["throughput"]
+    rss = result["peak_rss_mb"]
+    print(
+        f"\n{result['config']['users']} users in {result['wall_seconds']:.2f}s: "
+        f"{throughput['questions_per_second']:.2f} questions/s, {throughput['documents_per_second']:.2f} documents/s"
+    )
+    print(f"peak RSS {rss['self']:.0f} MB (extraction workers {rss['children']:.0f} MB)")
+    for error in result["errors"]:
+        print(f"error: {error}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated users")
+    parser.add_argument("--questions", type=int, default=5, help="questions per user")
+    parser.add_argument("--pages", type=int, default=20, help="pages per uploaded PDF")
+    parser.add_argument("--lines-per-page", type=int, default=40)
+    parser.add_argument("--chunker", default="tokens", choices=["tokens", "fixed"])
+    parser.add_argument("--index-type", default="auto", choices=["auto", "flat", "hnsw", "ivf_flat", "ivf_pq"])
+    parser.add_argument("--compression", default="none", choices=["none", "fp16", "sq8", "pq"])
+    parser.add_argument("--no-rerank", action="store_true", help="skip full-precision re-ranking of compressed indexes")
+    parser.add_argument("--dim", type=int, default=256, help="fake embedding dimension")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--embed-per-text-latency", type=float, default=0.0, help="extra seconds per embedded text")
+    parser.add_argument("--llm-first-token", type=float, default=0.3, help="seconds to the first LLM token")
+    parser.add_argument("--llm-token-latency", type=float, default=0.01, help="seconds between LLM tokens")
+    parser.add_argument("--llm-tokens", type=int, default=50)
+    parser.add_argument(
+        "--embedding-cache", action=argparse.BooleanOptionalAction, default=False,
+        help="use the local embedding cache (off: every chunk reaches the fake embedder)",
+    )
+    parser.add_argument("--telemetry", action="store_true", help="enable the app's spans and counters")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against")
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    sys.exit(1 if result["errors"] else 0)
@@ -0,0 +1,125 @@
+# bench_retrieval.py
+"""
+Latency and recall of vector, BM25 and hybrid retrieval (app2/retrieval.py) on a
+synthetic corpus. Half of the queries paraphrase a chunk (the vector search should
+find it), half ask for an identifier that occurs in exactly one chunk (only
+keyword matching can find it). Then times ChatInterface's per-turn retrieval,
+query embedding included, cold and with the query embedding cache warm, one
+question at a time and batched.
+
+    python bench/bench_retrieval.py --count 20000 --dim 256 --queries 400
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2"))
+
+from index_factory import build_index, search  # noqa: E402
+from retrieval import BM25Index, HybridRetriever  # noqa: E402
+from segments import SegmentedIndex  # noqa: E402
+from chat_interface import ChatInterface  # noqa: E402
+from embedding_cache import QueryEmbeddingCache  # noqa: E402
+from fakes import FakeEmbeddings, FakeLLM  # noqa: E402
+
+def synthetic_corpus(args: argparse.Namespace):
+    """Chunks drawn from per-topic vocabularies, each mentioning one unique part number"""
+    rng = np.random.default_rng(1)
+    topic_words = [[f"t{t}w{w}" for w in range(50)] for t in range(args.topics)]
+    centers = rng.standard_normal((args.topics, args.dim)).astype(np.float32)
+    topics = rng.integers(0, args.topics, size=args.count)
+    vectors = centers[topics] + 0.5 * rng.standard_normal((args.count, args.dim)).astype(np.float32)
+    words = [rng.choice(topic_words[topic], size=40) for topic in topics]
+    chunks = [" ".join(w) + f" part PN-{i:06d} torque spec." for i, w in enumerate(words)]
+
+    targets = rng.choice(args.count, size=args.queries, replace=False)
+    texts, query_vectors, kinds = [], [], []
+    for n, target in enumerate(targets):
+        topic = topics[target]
+        if n % 2 == 0:
+            # Paraphrase: a few of the chunk's words mixed with other topic words, vector close to the chunk
+            texts.append(" ".join(list(rng.choice(words[target], size=3)) + list(rng.choice(topic_words[topic], size=3))))
+            query_vectors.append(vectors[target] + 0.1 * rng.standard_normal(args.dim))
+            kinds.append("semantic")
+        else:
+            # Exact term: the vector only knows the topic
+            texts.append(f"what is the torque for PN-{target:06d}")
+            query_vectors.append(centers[topic] + 0.5 * rng.standard_normal(args.dim))
+            kinds.append("exact")
+    return chunks, vectors, texts, np.asarray(query_vectors, dtype=np.float32), targets, np.array(kinds)
+
+def hit_rate(found, targets, kinds, kind: str) -> float:
+    rows = [target in set(ids) for ids, target, k in zip(found, targets, kinds) if k == kind]
+    return sum(rows) / max(1, len(rows))
+
+def run(args: argparse.Namespace) -> None:
+    chunks, vectors, texts, query_vectors, targets, kinds = synthetic_corpus(args)
+
+    start = time.perf_counter()
+    bm25 = BM25Index.build(chunks)
+    bm25_seconds = time.perf_counter() - start
+    index, params = build_index(vectors, args.index_type, "l2")
+    session_index = SegmentedIndex.from_data({
+        "embeddings": vectors,
+        "chunks": chunks,
+        "faiss_index": index,
+        "index_params": params,
+        "bm25": bm25,
+    })
+    retriever = HybridRetriever(session_index)
+    print(f"{args.count} chunks, BM25 built in {bm25_seconds:.2f}s, "
+          f"{len(bm25.vocabulary)} terms, {bm25.doc_ids.size} postings")
+
+    methods = {
+        "vector": lambda: [search(index, q, args.k, params)[1][0] for q in query_vectors],
+        "bm25": lambda: [bm25.search(text, args.k) for text in texts],
+        "hybrid": lambda: [retriever.retrieve(t, q, args.k) for t, q in zip(texts, query_vectors)],
+        "hybrid batch": lambda: retriever.retrieve_batch(texts, query_vectors, args.k),
+    }
+    print(f"{'method':<13} {'semantic@' + str(args.k):>11} {'exact@' + str(args.k):>9} {'ms/query':>9}")
+    for name, method in methods.items():
+        start = time.perf_counter()
+        found = method()
+        ms_per_query = (time.perf_counter() - start) * 1000 / len(texts)
+        print(
+            f"{name:<13} {hit_rate(found, targets, kinds, 'semantic'):>11.3f} "
+            f"{hit_rate(found, targets, kinds, 'exact'):>9.3f} {ms_per_query:>9.3f}"
+        )
+
+    # Fake embeddings have the corpus's dimension but not its geometry: latency only
+    questions = texts[:args.chat_queries]
+    chat = ChatInterface(
+        session_index,
+        FakeEmbeddings(args.dim, latency=args.embed_latency),
+        "bench",
+        llm=FakeLLM(),
+        query_cache=QueryEmbeddingCache(),
+    )
+    chat.response_cache = None
+    print(f"\nChatInterface retrieval, {args.embed_latency * 1000:.0f} ms per query embedding")
+    print(f"{'mode':<17} {'ms/query':>9}")
+    for name, batched in (("turn", False), ("batch", True)):
+        chat.query_cache = QueryEmbeddingCache()
+        for state in ("cold", "cached"):
+            start = time.perf_counter()
+            if batched:
+                chat.get_relevant_contexts(questions, args.k)
+            else:
+                for question in questions:
+                    chat._get_relevant_context(question, args.k)
+            ms_per_query = (time.perf_counter() - start) * 1000 / len(questions)
+            print(f"{name + ', ' + state:<17} {ms_per_query:>9.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--chat-queries", type=int, default=50, help="questions timed through ChatInterface")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per query embedding")
+    parser.add_argument("--index-type", default="flat", choices=["flat", "hnsw", "ivf_flat", "ivf_pq"])
+    run(parser.parse_args())
@@ -0,0 +1,89 @@
+# bench_startup.py
+"""
+Cold-start cost of the Streamlit app: time to import app2/main.py in a fresh
+interpreter, the slowest imports, and the time to create the shared AWS clients.
+Exits non-zero when the median import time exceeds --max-seconds, so it can
+guard against startup regressions in CI.
+
+    python bench/bench_startup.py --runs 5 --max-seconds 2.0
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2")
+
+_IMPORT_MAIN = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+_CREATE_CLIENTS = """
+import json, time
+import aws
+t = time.perf_counter()
+from embeddings import EmbeddingsManager
+from chat_history import ChatHistoryManager
+embeddings_manager = EmbeddingsManager()
+chat_history_manager = ChatHistoryManager()
+constructed = time.perf_counter() - t
+embeddings_manager.s3_client
+embeddings_manager.embeddings_model
+chat_history_manager.table
+print(json.dumps({"managers": constructed, "clients": aws.creation_seconds()}))
+"""
+
+def _run(code: str, *flags: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    # Client creation never calls AWS, but botocore wants credentials and a region to exist
+    env.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    env.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    env.setdefault("DYNAMODB_TABLE", "ChatSessions")
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=APP_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+
+def slowest_imports(count: int):
+    """(cumulative seconds, module) of the top-level imports that dominate `import main`"""
+    stderr = _run("import main", "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Depth 1 (two spaces of indent) are the modules main imports directly
+        if name.startswith(" " * 3) and not name.startswith(" " * 4):
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+def run(args: argparse.Namespace) -> int:
+    timings = [float(_run(_IMPORT_MAIN).stdout.strip().splitlines()[-1]) for _ in range(args.runs)]
+    median = statistics.median(timings)
+    print(f"import main: median {median:.3f}s, min {min(timings):.3f}s, max {max(timings):.3f}s ({args.runs} runs)")
+
+    print("slowest direct imports:")
+    for seconds, name in slowest_imports(args.top):
+        print(f"  {seconds:>7.3f}s  {name}")
+
+    import json
+    start = time.perf_counter()
+    clients = json.loads(_run(_CREATE_CLIENTS).stdout.strip().splitlines()[-1])
+    print(f"manager construction: {clients['managers']:.3f}s (clients deferred)")
+    for name, seconds in clients["clients"].items():
+        print(f"  {name}: {seconds:.3f}s")
+    print(f"client benchmark wall time: {time.perf_counter() - start:.2f}s")
+
+    if args.max_seconds and median > args.max_seconds:
+        print(f"FAIL: median import time {median:.3f}s exceeds budget of {args.max_seconds:.3f}s")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, default=0.0, help="fail above this median import time")
+    sys.exit(run(parser.parse_args()))
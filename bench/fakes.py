@@ -0,0 +1,103 @@
+# fakes.py
+"""
+Deterministic local stand-ins for Bedrock and Gemini, and a synthetic PDF, so the
+pipeline can be benchmarked offline. Latencies are simulated with sleeps.
+"""
+import hashlib
+import time
+from typing import Iterator, List, Sequence
+import numpy as np
+
+_WORDS = (
+    "the index stores vectors for each chunk while retrieval ranks passages by distance "
+    "bedrock returns embeddings quickly although throttling may slow large uploads "
+    "maintenance schedule inspection bearing housing gasket pressure valve coolant "
+    "filter replace every hours according to manufacturer guidance and safety notes"
+).split()
+
+class FakeEmbeddings:
+    """
+    Same interface as langchain's BedrockEmbeddings. Vectors are seeded by a hash of
+    the text, so identical texts always embed identically across runs and processes.
+    """
+
+    def __init__(self, dim: int = 256, latency: float = 0.05, per_text_latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.model_id = f"fake-embeddings-{dim}"
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32).tolist()
+
+    def embed_documents(self, texts: Sequence[str]) -> List[List[float]]:
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency + self.per_text_latency)
+        return self._vector(text)
+
+class FakeLLM:
+    """Streams a fixed number of tokens after a time-to-first-token delay"""
+
+    def __init__(self, first_token_latency: float = 0.3, token_latency: float = 0.01, tokens: int = 50):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        time.sleep(self.first_token_latency)
+        for i in range(self.tokens):
+            if i:
+                time.sleep(self.token_latency)
+            yield f" token{i}"
+
+    def invoke(self, prompt: str) -> str:
+        return "".join(self.stream(prompt))
+
+def synthetic_lines(pages: int, lines_per_page: int, seed: int = 0) -> List[List[str]]:
+    """Pages of random sentences; line 0 of each page names a part number unique to it"""
+    rng = np.random.default_rng(seed)
+    result = []
+    for page in range(pages):
+        lines = [f"Part PN-{seed:04d}-{page:04d} requires inspection."]
+        for _ in range(lines_per_page - 1):
+            words = rng.choice(_WORDS, size=rng.integers(8, 14))
+            lines.append(" ".join(words).capitalize() + ".")
+        result.append(lines)
+    return result
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def synthetic_pdf(pages: List[List[str]]) -> bytes:
+    """A minimal PDF with one Helvetica text line per entry, readable by PyPDF2"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for lines in pages:
+        content = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        stream = content.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(page_refs), len(page_refs))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(output)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# Offline defaults, set before app modules read config.py
+_WORKDIR = tempfile.mkdtemp(prefix="rag-tests-")
+os.environ.update({
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_REGION": "us-east-1",
+    "S3_BUCKET_NAME": "rag-tests",
+    "DYNAMODB_TABLE": "TestSessions",
+    "EMBEDDING_CACHE_ENABLED": "false",
+    "RESPONSE_CACHE_ENABLED": "false",
+    "INDEX_CACHE_DIR": os.path.join(_WORKDIR, "index_cache"),
+    "INGEST_QUEUE_PATH": os.path.join(_WORKDIR, "ingest_jobs.sqlite3"),
+})
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app2"))
@@ -0,0 +1,164 @@
+import time
+import boto3
+import pytest
+from moto import mock_aws
+import chat_history
+from chat_history import ChatHistoryManager, create_tables
+from config import DYNAMODB_MESSAGES_TABLE
+
+def message(i, role="user"):
+    return {"role": role, "content": f"message {i}", "timestamp": f"2026-01-01T00:00:{i:02d}"}
+
+@pytest.fixture
+def dynamodb():
+    with mock_aws():
+        resource = boto3.resource("dynamodb", region_name="us-east-1")
+        create_tables(resource, "TestSessions")
+        yield resource
+
+def stored_seqs(dynamodb, session_id):
+    items = dynamodb.Table(DYNAMODB_MESSAGES_TABLE).scan()["Items"]
+    return sorted(int(item["seq"]) for item in items if item["session_id"] == session_id)
+
+def test_append_reload_append(dynamodb):
+    manager = ChatHistoryManager(dynamodb)
+    messages = [message(0), message(1, "assistant")]
+    assert manager.save_chat_history("s1", "key", messages)
+    messages += [message(2), message(3, "assistant")]
+    assert manager.save_chat_history("s1", "key", messages, stored=2)
+
+    reloaded = ChatHistoryManager(dynamodb)
+    item = reloaded.get_chat_history("s1")
+    assert [m["content"] for m in item["messages"]] == [m["content"] for m in messages]
+    assert item["message_count"] == item["stored_messages"] == 4
+
+    conversation = item["messages"] + [message(4)]
+    assert reloaded.save_chat_history("s1", "key", conversation, item["stored_messages"])
+    assert stored_seqs(dynamodb, "s1") == [0, 1, 2, 3, 4]
+    assert [m["content"] for m in ChatHistoryManager(dynamodb).get_chat_history("s1")["messages"]] == [
+        f"message {i}" for i in range(5)
+    ]
+
+def test_missing_messages_never_get_their_seq_reused(dynamodb):
+    manager = ChatHistoryManager(dynamodb)
+    manager.save_chat_history("s1", "key", [message(i) for i in range(4)])
+    # An item gone from the messages table (expired or deleted by hand)
+    dynamodb.Table(DYNAMODB_MESSAGES_TABLE).delete_item(Key={"session_id": "s1", "seq": 0})
+
+    reloaded = ChatHistoryManager(dynamodb)
+    item = reloaded.get_chat_history("s1")
+    reloaded.save_chat_history("s1", "key", item["messages"] + [message(9)], item["stored_messages"])
+    assert stored_seqs(dynamodb, "s1") == [1, 2, 3, 4]
+    assert ChatHistoryManager(dynamodb).get_chat_history("s1")["messages"][-1]["content"] == "message 9"
+
+def test_messages_outlive_the_session_item(dynamodb, monkeypatch):
+    manager = ChatHistoryManager(dynamodb)
+    manager.save_chat_history("s1", "key", [message(0)])
+    # Later saves push the session's ttl past what the first message was stamped with
+    later = time.time() + chat_history.MESSAGE_TTL_MARGIN_SECONDS * 2
+
+    class Later(chat_history.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return chat_history.datetime.fromtimestamp(later)
+    monkeypatch.setattr(chat_history, "datetime", Later)
+    manager.save_chat_history("s1", "key", [message(0), message(1)], stored=1)
+
+    session_ttl = int(dynamodb.Table("TestSessions").get_item(Key={"session_id": "s1"})["Item"]["ttl"])
+    items = dynamodb.Table(DYNAMODB_MESSAGES_TABLE).scan()["Items"]
+    assert len(items) == 2
+    assert all(int(item["ttl"]) >= session_ttl for item in items)
+
+def test_legacy_session_is_migrated_on_save(dynamodb):
+    dynamodb.Table("TestSessions").put_item(Item={
+        "session_id": "old",
+        "s3_key": "key",
+        "last_updated": "2026-01-01T00:00:00",
+        "messages": [
+            {"M": {"message": {"S": "hello"}, "role": {"S": "user"}, "timestamp": {"S": "t0"}}},
+            {"M": {"message": {"S": "hi"}, "role": {"S": "assistant"}, "timestamp": {"S": "t1"}}},
+        ],
+    })
+    manager = ChatHistoryManager(dynamodb)
+    item = manager.get_chat_history("old")
+    assert [m["content"] for m in item["messages"]] == ["hello", "hi"]
+    assert item["stored_messages"] == 0
+
+    manager.save_chat_history("old", "key", item["messages"] + [message(2)], item["stored_messages"])
+    stored = dynamodb.Table("TestSessions").get_item(Key={"session_id": "old"})["Item"]
+    assert "messages" not in stored
+    assert stored["message_count"] == 3
+    assert stored_seqs(dynamodb, "old") == [0, 1, 2]
+    assert [m["content"] for m in ChatHistoryManager(dynamodb).get_chat_history("old")["messages"]] == [
+        "hello", "hi", "message 2"
+    ]
+
+def test_tabs_sharing_a_manager_each_keep_their_messages(dynamodb):
+    manager = ChatHistoryManager(dynamodb)
+    manager.save_chat_history("s1", "key", [message(0), message(1)])
+
+    tab_a = manager.get_chat_history("s1")
+    tab_b = manager.get_chat_history("s1")
+    assert manager.save_chat_history("s1", "key", tab_a["messages"] + [message(2)], tab_a["stored_messages"])
+    assert manager.save_chat_history("s1", "key", tab_b["messages"] + [message(3)], tab_b["stored_messages"])
+
+    stored = ChatHistoryManager(dynamodb).get_chat_history("s1")["messages"]
+    assert [m["content"] for m in stored] == [f"message {i}" for i in range(4)]
+    assert stored_seqs(dynamodb, "s1") == [0, 1, 2, 3]
+
+def test_write_behind_queue_appends_what_each_tab_enqueues(dynamodb):
+    from persistence import WriteBehindQueue
+    queue = WriteBehindQueue(ChatHistoryManager(dynamodb))
+    queue.enqueue("s1", "key", [message(0), message(1)])
+    queue.enqueue("s1", "key", [message(2)])
+    queue.flush(10)
+    queue.enqueue("s1", "key", [message(3)])
+    queue.close(10)
+    stored = ChatHistoryManager(dynamodb).get_chat_history("s1")["messages"]
+    assert [m["content"] for m in stored] == [f"message {i}" for i in range(4)]
+
+def save_sessions(manager, count):
+    for i in range(count):
+        manager.save_chat_history(f"s{i}", "key", [message(i)])
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_sessions_are_listed_newest_first_a_page_at_a_time(dynamodb, monkeypatch, shards):
+    monkeypatch.setattr(chat_history, "SESSION_OWNER_SHARDS", shards)
+    manager = ChatHistoryManager(dynamodb)
+    save_sessions(manager, 5)
+
+    first, cursor = manager.list_sessions_page(2)
+    second, cursor = manager.list_sessions_page(2, before=cursor)
+    third, cursor = manager.list_sessions_page(2, before=cursor)
+    assert [s["session_id"] for s in first + second + third] == ["s4", "s3", "s2", "s1", "s0"]
+    assert cursor is None
+
+def test_listing_falls_back_to_a_scan_without_the_index(monkeypatch):
+    with mock_aws():
+        resource = boto3.resource("dynamodb", region_name="us-east-1")
+        resource.create_table(
+            TableName="TestSessions",
+            KeySchema=[{"AttributeName": "session_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "session_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table = resource.Table("TestSessions")
+        for i in range(3):
+            table.put_item(Item={"session_id": f"s{i}", "last_updated": time_iso(i)})
+
+        sessions = ChatHistoryManager(resource).list_sessions(10)
+        assert [s["session_id"] for s in sessions] == ["s2", "s1", "s0"]
+
+def test_backfill_lists_sessions_saved_before_the_index(dynamodb):
+    table = dynamodb.Table("TestSessions")
+    for i in range(3):
+        table.put_item(Item={"session_id": f"old{i}", "last_updated": time_iso(i)})
+    manager = ChatHistoryManager(dynamodb)
+    assert manager.list_sessions(10) == []
+
+    assert manager.backfill_owners() == 3
+    assert [s["session_id"] for s in manager.list_sessions(10)] == ["old2", "old1", "old0"]
+    assert manager.backfill_owners() == 0
+
+def time_iso(i):
+    return chat_history.datetime.fromtimestamp(time.time() - 60 + i).isoformat()
@@ -0,0 +1,68 @@
+import time
+import numpy as np
+import pytest
+import telemetry
+from chat_interface import ChatInterface
+from embedding_cache import QueryEmbeddingCache
+from index_factory import build_index
+
+class SlowEmbeddings:
+    """Deterministic vectors, slow enough that concurrent embed_query calls overlap"""
+    model_id = "fake"
+
+    def __init__(self):
+        self.queries = []
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        with telemetry.span("fake.embed_query"):
+            telemetry.count("fake_embeddings")
+            time.sleep(0.02)
+        vector = np.zeros(16, dtype=np.float32)
+        for word in text.lower().split():
+            vector[sum(map(ord, word)) % 16] += 1
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+class LLM:
+    def invoke(self, prompt):
+        return "summary"
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(telemetry, "_enabled", True)
+
+def make_chat(embeddings):
+    texts = ["red widgets weigh two kilograms", "blue gadgets cost five dollars", "green gizmos are round"]
+    package = {
+        "embeddings": np.array(embeddings.embed_documents(texts), dtype=np.float32),
+        "chunks": texts,
+        "session_id": "doc",
+    }
+    package["faiss_index"], package["index_params"] = build_index(package["embeddings"], "flat")
+    embeddings.queries.clear()
+    return ChatInterface(package, embeddings, "doc", llm=LLM(), query_cache=QueryEmbeddingCache())
+
+def test_batched_queries_are_embedded_concurrently_with_telemetry_on(enabled):
+    embeddings = SlowEmbeddings()
+    chat = make_chat(embeddings)
+    queries = ["red widgets", "blue gadgets", "green gizmos", "Red  Widgets"]
+
+    with telemetry.request("question") as request:
+        contexts = chat.get_relevant_contexts(queries, k=1)
+
+    assert [context.splitlines()[0] for context in contexts][:3] == [
+        "red widgets weigh two kilograms", "blue gadgets cost five dollars", "green gizmos are round"
+    ]
+    assert contexts[3] == contexts[0]
+    # Normalized duplicates are embedded once, and worker-thread work lands in the request
+    assert sorted(map(QueryEmbeddingCache.normalize, embeddings.queries)) == [
+        "blue gadgets", "green gizmos", "red widgets"
+    ]
+    assert request.trace.counters["fake_embeddings"] == 3
+
+    embeddings.queries.clear()
+    chat.get_relevant_contexts(queries[:2], k=1)
+    assert embeddings.queries == []
@@ -0,0 +1,33 @@
+import tiktoken
+from chunking import TokenChunker, _token_splitter, load_token_counter
+
+def document(pages):
+    return "".join(text + "\n" for _, text in pages)
+
+def test_whitespace_free_run_is_split_within_budget():
+    run = "x" * 50_000
+    pages = [(1, "A short sentence. " + run + " The end."), (2, "Second page text.")]
+    chunker = TokenChunker(max_tokens=64, overlap_tokens=8)
+    chunks = list(chunker.chunk_pages(pages))
+    count = load_token_counter()
+
+    text = document(pages)
+    assert all(count([chunk["text"]])[0] <= 64 for chunk in chunks)
+    assert all(text[chunk["start"]:chunk["end"]] == chunk["text"] for chunk in chunks)
+    # Every character of the run lands in some chunk
+    covered = set()
+    for chunk in chunks:
+        covered.update(range(chunk["start"], chunk["end"]))
+    run_start = text.index(run)
+    assert set(range(run_start, run_start + len(run))) <= covered
+    assert chunks[-1]["text"].endswith("Second page text.")
+
+def test_token_splitter_cuts_between_tokens():
+    # One token per byte, so offsets and multi-byte characters are easy to follow
+    encoding = tiktoken.Encoding(
+        "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([b]): b for b in range(256)}, special_tokens={}
+    )
+    split = _token_splitter(encoding)
+    assert split("abcdefghij", 4) == [4, 8]
+    # "é" is two bytes: the cut after 3 tokens falls inside it and moves to its start
+    assert split("abé" + "d" * 4, 3) == [2, 5]
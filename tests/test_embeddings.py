@@ -0,0 +1,95 @@
+import threading
+import numpy as np
+import pytest
+import embeddings
+from embedding_cache import EmbeddingCache
+from embeddings import EmbeddingsManager
+
+class FakeBedrock:
+    """Records every text sent; raises a throttling error on the listed call numbers"""
+
+    def __init__(self, dim=8, throttle_calls=(), fail_calls=()):
+        self.dim = dim
+        self.model_id = "fake-model"
+        self.throttle_calls = set(throttle_calls)
+        self.fail_calls = set(fail_calls)
+        self.sent = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def vector(self, text):
+        return [float(len(text))] + [float(ord(c)) for c in text[:self.dim - 1].ljust(self.dim - 1)]
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+            self.sent.extend(texts)
+        if call in self.throttle_calls:
+            raise ValueError("Error raised by inference endpoint: ThrottlingException")
+        if call in self.fail_calls:
+            raise ValueError("Error raised by inference endpoint: ValidationException")
+        return [self.vector(text) for text in texts]
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_BACKOFF_BASE", 0.0)
+
+def make_manager(model, cache=None, **kwargs):
+    return EmbeddingsManager(embeddings_model=model, s3_client=object(), embedding_cache=cache, **kwargs)
+
+def test_rows_follow_chunk_order_and_repeats_are_embedded_once():
+    model = FakeBedrock()
+    texts = [f"chunk {i % 30}" for i in range(60)]
+    matrix = make_manager(model, batch_size=4, max_in_flight=3).embed_chunks(texts)
+
+    assert matrix.dtype == np.float32
+    np.testing.assert_array_equal(matrix, np.array([model.vector(t) for t in texts], dtype=np.float32))
+    assert sorted(model.sent) == sorted(set(texts))
+
+def test_throttled_request_is_retried_alone():
+    model = FakeBedrock(throttle_calls={3, 4})
+    texts = [f"text {i}" for i in range(6)]
+    matrix = make_manager(model, batch_size=6, max_in_flight=1).embed_chunks(texts)
+
+    np.testing.assert_array_equal(matrix, np.array([model.vector(t) for t in texts], dtype=np.float32))
+    # The third text was throttled twice; no other text was sent again
+    assert model.sent == texts[:3] + [texts[2]] * 2 + texts[3:]
+
+def test_non_throttling_errors_are_not_retried():
+    model = FakeBedrock(fail_calls={2})
+    with pytest.raises(ValueError, match="ValidationException"):
+        make_manager(model, batch_size=4, max_in_flight=1).embed_chunks(["a", "b", "c"])
+    assert model.sent == ["a", "b"]
+
+def test_retries_give_up_after_max_retries():
+    model = FakeBedrock(throttle_calls={1, 2, 3})
+    with pytest.raises(ValueError, match="Throttling"):
+        make_manager(model, max_retries=2).embed_chunks(["a"])
+    assert model.sent == ["a"] * 3
+
+def test_only_cache_misses_are_sent(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "cache.sqlite3"))
+    first = FakeBedrock()
+    expected = make_manager(first, cache).embed_chunks(["a", "b", "c"])
+    assert sorted(first.sent) == ["a", "b", "c"]
+
+    second = FakeBedrock()
+    matrix = make_manager(second, cache).embed_chunks(["c", "d", "a", "b"])
+    assert second.sent == ["d"]
+    np.testing.assert_array_equal(matrix[[2, 3, 0]], expected)
+    np.testing.assert_array_equal(matrix[1], np.array(second.vector("d"), dtype=np.float32))
+
+def test_importing_the_app_modules_defers_heavy_dependencies():
+    import os
+    import subprocess
+    import sys
+    app_dir = os.path.dirname(embeddings.__file__)
+    code = (
+        "import sys, embeddings, chat_interface, response_cache, segments; "
+        "print(','.join(m for m in ('faiss', 'botocore', 'boto3', 'langchain') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=app_dir, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from index_factory import build_index, search
+
+@pytest.mark.parametrize("index_type, compression", [("ivf_pq", "none"), ("ivf_flat", "pq"), ("flat", "pq")])
+def test_pq_indexes_build_from_a_handful_of_vectors(index_type, compression):
+    vectors = np.random.default_rng(0).normal(size=(5, 32)).astype(np.float32)
+    index, params = build_index(vectors, index_type, "l2", ids=np.arange(5), compression=compression)
+    assert (params["index_type"], params["compression"]) == ("flat", "sq8")
+    _, labels = search(index, vectors[:1], 3, params, vectors=vectors)
+    assert labels[0][0] == 0
+
+def test_ivf_pq_caps_its_parameters_by_the_vector_count():
+    vectors = np.random.default_rng(0).normal(size=(40, 32)).astype(np.float32)
+    index, params = build_index(vectors, "ivf_pq", "l2", ids=np.arange(40), nlist=64, pq_nbits=8)
+    assert params["nlist"] <= 40 and 2 ** params["pq_nbits"] <= 40
+    assert index.ntotal == 40
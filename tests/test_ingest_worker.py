@@ -0,0 +1,150 @@
+import io
+import json
+import threading
+import time
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+from embeddings import EmbeddingsManager, ManifestConflict
+from index_factory import build_index
+from ingest_worker import IngestWorker, PermanentIngestError
+from job_queue import DONE, FAILED, QUEUED, JobQueue, LeaseLost
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=0.3)
+
+def _package(seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(4, 8)).astype(np.float32)
+    index, params = build_index(vectors, "flat", "l2", ids=np.arange(4))
+    return {"embeddings": vectors, "chunks": ["a", "b", "c", "d"], "faiss_index": index, "index_params": params}
+
+def test_an_ingested_document_can_be_queued_again(job_queue):
+    job_id = job_queue.submit("s1", "a.pdf", "sha", "key")
+    assert job_queue.submit("s1", "a.pdf", "sha", "key") == job_id
+    job_queue.claim("first")
+    job_queue.complete(job_id, "first", {})
+    assert job_queue.get(job_id)["status"] == DONE
+    assert job_queue.submit("s1", "a.pdf", "sha", "key") != job_id
+
+def test_only_permanent_errors_fail_a_job_without_retries(job_queue):
+    worker = IngestWorker(job_queue, embeddings_manager=None, worker_id="first")
+    # The permanent one first: a requeued job would be claimed again before the next
+    for error, status in (
+        (PermanentIngestError("No text found in the PDF"), FAILED),
+        (ValueError("Error raised by inference endpoint: ThrottlingException"), QUEUED),
+    ):
+        job_id = job_queue.submit("s1", "a.pdf", str(status), "key")
+
+        def process(job):
+            raise error
+        worker.process = process
+        worker._delete_checkpoints = lambda job: None
+        assert worker.run_once()
+        assert job_queue.get(job_id)["status"] == status
+
+def test_a_reclaimed_job_cannot_be_renewed(job_queue):
+    job_id = job_queue.submit("s1", "a.pdf", "sha", "key")
+    job_queue.claim("first")
+    time.sleep(0.4)
+    assert job_queue.claim("second")["id"] == job_id
+    with pytest.raises(LeaseLost):
+        job_queue.renew(job_id, "first")
+
+def test_heartbeat_keeps_a_long_job_leased(job_queue):
+    job_queue.submit("s1", "a.pdf", "sha", "key")
+    worker = IngestWorker(job_queue, embeddings_manager=None, worker_id="first")
+    job = job_queue.claim("first")
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=worker._heartbeat, args=(job, stop))
+    heartbeat.start()
+    try:
+        time.sleep(1.0)
+        assert job_queue.claim("second") is None
+    finally:
+        stop.set()
+        heartbeat.join()
+
+def test_manifest_is_not_written_without_the_lease():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="rag-tests")
+        manager = EmbeddingsManager(embeddings_model=object(), s3_client=s3, embedding_cache=None)
+        vectors = np.random.default_rng(0).normal(size=(4, 8)).astype(np.float32)
+        index, params = build_index(vectors, "flat", "l2", ids=np.arange(4))
+        package = {"embeddings": vectors, "chunks": ["a", "b", "c", "d"], "faiss_index": index, "index_params": params}
+
+        def lost():
+            raise LeaseLost("job")
+        _, _, upload = manager.add_data_package(package, "s1", "a.pdf", before_commit=lost)
+        with pytest.raises(LeaseLost):
+            upload.result()
+        assert not manager.has_index("s1")
+
+        _, _, upload = manager.add_data_package(package, "s2", "a.pdf", before_commit=lambda: None)
+        upload.result()
+        assert manager.has_index("s2")
+
+def test_a_stale_index_cannot_overwrite_the_session():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="rag-tests")
+        manager = EmbeddingsManager(embeddings_model=object(), s3_client=s3, embedding_cache=None)
+        manager.add_data_package(_package(), "s1", "a.pdf")[2].result()
+
+        web = manager.load_embeddings("s1")
+        worker = manager.load_embeddings("s1")
+        manager.add_data_package(_package(1), "s1", "b.pdf", worker, before_commit=lambda: None)[2].result()
+        # A copy of an index with a write in flight expects that write, not the loaded manifest
+        pending = manager.load_embeddings("s1")
+        _, _, upload = manager.add_data_package(_package(2), "s1", "c.pdf", pending, before_commit=lambda: None)
+        copy = pending.copy()
+        upload.result()
+        manager.delete_document(copy, next(iter(copy.documents))).result()
+        while copy.compacting:
+            time.sleep(0.01)
+
+        _, _, upload = manager.add_data_package(_package(3), "s1", "d.pdf", web, before_commit=lambda: None)
+        with pytest.raises(ManifestConflict):
+            upload.result()
+        names = {document["name"] for document in manager.load_embeddings("s1").documents.values()}
+        assert names == {"b.pdf", "c.pdf"}
+        # The rejected segment's files are removed with it
+        rejected = f"session_s1/index/{web.segments[-1]['prefix']}/"
+        assert "Contents" not in s3.list_objects_v2(Bucket="rag-tests", Prefix=rejected)
+
+def test_worker_reloads_the_session_when_another_writer_changed_it(job_queue):
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="rag-tests")
+        manager = EmbeddingsManager(embeddings_model=object(), s3_client=s3, embedding_cache=None)
+        manager.add_data_package(_package(), "s1", "a.pdf")[2].result()
+
+        job_id = job_queue.submit("s1", "b.pdf", "sha-b", "key")
+        worker = IngestWorker(job_queue, manager, worker_id="first")
+        job = job_queue.claim("first")
+        chunks = [{"text": f"chunk {i}", "page": 1, "start": 0, "end": 7} for i in range(4)]
+        buffer = io.BytesIO()
+        np.save(buffer, _package(1)["embeddings"])
+        worker._save_checkpoint(job, "chunk", "chunks.json", json.dumps(chunks).encode("utf-8"))
+        worker._save_checkpoint(job, "embed", "embeddings.npy", buffer.getvalue())
+        job = job_queue.get(job_id)
+
+        key = "session_s1/index/manifest.json"
+        writes = []
+
+        def check_lease(job):
+            if not writes:
+                # Another process rewrites the manifest after this worker loaded it
+                manifest = json.loads(s3.get_object(Bucket="rag-tests", Key=key)["Body"].read())
+                manifest["revision"] = "other-writer"
+                s3.put_object(Bucket="rag-tests", Key=key, Body=json.dumps(manifest).encode("utf-8"))
+            writes.append(job["id"])
+        worker._check_lease = check_lease
+
+        result = worker.process(job)
+        assert len(writes) == 2
+        session_index = manager.load_embeddings("s1")
+        assert session_index.documents[result["document_id"]]["name"] == "b.pdf"
+        assert {document["name"] for document in session_index.documents.values()} == {"a.pdf", "b.pdf"}
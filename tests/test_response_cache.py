@@ -0,0 +1,67 @@
+import numpy as np
+from chat_interface import ChatInterface
+from embedding_cache import QueryEmbeddingCache
+from index_factory import build_index
+from response_cache import ResponseCache
+
+class Embeddings:
+    model_id = "fake"
+
+    def embed_query(self, text):
+        vector = np.zeros(16, dtype=np.float32)
+        for word in text.lower().split():
+            vector[hash(word) % 16] += 1
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+class LLM:
+    def __init__(self):
+        self.prompts = []
+
+    def stream(self, prompt):
+        self.prompts.append(prompt)
+        yield f"answer {len(self.prompts)}"
+
+    def invoke(self, prompt):
+        return "".join(self.stream(prompt))
+
+def make_chat(cache, llm):
+    embeddings = Embeddings()
+    texts = ["The first widget weighs 2 kg.", "The second widget weighs 5 kg."]
+    package = {
+        "embeddings": np.array(embeddings.embed_documents(texts), dtype=np.float32),
+        "chunks": texts,
+        "session_id": "doc",
+    }
+    package["faiss_index"], package["index_params"] = build_index(package["embeddings"], "flat")
+    return ChatInterface(
+        package, embeddings, "doc", response_cache=cache, llm=llm, query_cache=QueryEmbeddingCache()
+    )
+
+def test_lookup_requires_matching_context():
+    cache = ResponseCache(threshold=0.9)
+    vector = np.ones(4, dtype=np.float32)
+    cache.store("doc", vector, "first", 1.0, context="a")
+    cache.store("doc", vector, "second", 1.0, context="b")
+    assert cache.lookup("doc", vector, "a") == "first"
+    assert cache.lookup("doc", vector, "b") == "second"
+    assert cache.lookup("doc", vector, "c") is None
+
+def test_follow_up_is_not_answered_from_another_conversation():
+    cache = ResponseCache(threshold=0.95)
+    first_llm, second_llm = LLM(), LLM()
+    alice, bob = make_chat(cache, first_llm), make_chat(cache, second_llm)
+
+    alice.generate_response("How much does the first widget weigh?")
+    alice.generate_response("What about the second one?")
+    bob.generate_response("Tell me about widget colors")
+    # Same follow-up, different history: must reach the LLM
+    bob.generate_response("What about the second one?")
+    assert len(second_llm.prompts) == 2
+
+    # An opening question with no history is shared across conversations
+    carol_llm = LLM()
+    make_chat(cache, carol_llm).generate_response("How much does the first widget weigh?")
+    assert carol_llm.prompts == []
@@ -0,0 +1,36 @@
+import numpy as np
+from index_factory import build_index
+from segments import SegmentedIndex
+
+def package(seed, rows=8, dim=16):
+    vectors = np.random.default_rng(seed).normal(size=(rows, dim)).astype(np.float32)
+    index, params = build_index(vectors, "flat", "l2", ids=np.arange(rows))
+    return {
+        "embeddings": vectors,
+        "chunks": [f"doc {seed} chunk {i}" for i in range(rows)],
+        "faiss_index": index,
+        "index_params": params,
+    }
+
+def found(index, vector):
+    return set(index.search(vector[None, :], 8)[1][0].tolist()) - {-1}
+
+def test_copy_leaves_the_shared_index_untouched():
+    shared = SegmentedIndex("s1", [], {})
+    first, _ = shared.add_segment(package(1), "one.pdf")
+    second, _ = shared.add_segment(package(2), "two.pdf")
+    query = shared.embeddings[0]
+    before = found(shared, query)
+
+    copy = shared.copy()
+    assert copy.delete_document(first)
+    copy.add_segment(package(3), "three.pdf")
+
+    assert [document_id for document_id, _ in shared.live_documents()] == [first, second]
+    assert shared.count == 16
+    assert found(shared, query) == before
+    assert shared.segments[0]["faiss_index"].ntotal == 8
+
+    assert {document["name"] for _, document in copy.live_documents()} == {"two.pdf", "three.pdf"}
+    assert copy.count == 24
+    assert found(copy, query).isdisjoint(range(8))
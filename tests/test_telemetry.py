@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import pytest
+import telemetry
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(telemetry, "_enabled", True)
+
+def test_in_context_wrapper_can_be_mapped_over_a_pool(enabled):
+    with telemetry.request("question") as request:
+        def work(value):
+            with telemetry.span("work"):
+                telemetry.count("items")
+                time.sleep(0.01)
+            return value * 2
+        wrapped = telemetry.in_context(work)
+        with ThreadPoolExecutor(4) as pool:
+            assert list(pool.map(wrapped, range(16))) == [value * 2 for value in range(16)]
+    assert request.trace.counters["items"] == 16
+
+def test_write_behind_queue_depth_and_lag_are_exported():
+    from persistence import WriteBehindQueue
+
+    class BlockedHistory:
+        def __init__(self):
+            self.release = threading.Event()
+
+        def save_chat_history(self, session_id, s3_key, messages):
+            self.release.wait(5)
+            return True
+
+    history = BlockedHistory()
+    queue = WriteBehindQueue(history)
+    queue.enqueue("s1", "key", [{"role": "user", "content": "hi"}])
+    queue.enqueue("s2", "key", [{"role": "user", "content": "hi"}])
+    time.sleep(0.05)
+    metrics = telemetry.registry.render_prometheus()
+    history.release.set()
+    queue.close(5)
+
+    assert "# TYPE rag_chat_persist_queue_depth gauge" in metrics
+    assert "rag_chat_persist_queue_depth 2" in metrics
+    lag = next(line for line in metrics.splitlines() if line.startswith("rag_chat_persist_lag_seconds "))
+    assert float(lag.split()[1]) > 0
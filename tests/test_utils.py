@@ -0,0 +1,42 @@
+import io
+import threading
+import PyPDF2
+import utils
+from utils import iter_pdf_pages
+
+def blank_pdf(pages):
+    writer = PyPDF2.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+class RecordingPool(utils.ProcessPoolExecutor):
+    created = []
+
+    def __init__(self, *args, **kwargs):
+        RecordingPool.created.append(kwargs["max_workers"])
+        super().__init__(*args, **kwargs)
+
+def extract_on_thread(data, **kwargs):
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(iter_pdf_pages(io.BytesIO(data), **kwargs)))
+    thread.start()
+    thread.join()
+    return result
+
+def test_small_pdfs_off_the_main_thread_use_a_worker_process(monkeypatch):
+    monkeypatch.setattr(utils, "ProcessPoolExecutor", RecordingPool)
+    RecordingPool.created.clear()
+    data = blank_pdf(3)
+
+    assert list(iter_pdf_pages(io.BytesIO(data), workers=4, pages_per_task=8)) == [(1, ""), (2, ""), (3, "")]
+    assert RecordingPool.created == []
+
+    assert extract_on_thread(data, workers=4, pages_per_task=8) == [(1, ""), (2, ""), (3, "")]
+    assert RecordingPool.created == [1]
+
+    # Without a page budget there is nothing to enforce, so the thread extracts itself
+    assert extract_on_thread(data, workers=4, pages_per_task=8, page_timeout=0) == [(1, ""), (2, ""), (3, "")]
+    assert RecordingPool.created == [1]